@@ -0,0 +1,455 @@
+"""
+Conversion between aiotdlib messages and messages of the bot
+
+Decoders are registered by the class of the telegram message content
+and encoders by the class of the bot message, so that dispatch is a single
+dict lookup and new message types only need a pair of registered functions.
+
+Validation of aiotdlib input objects is costly, so encoded media files
+are cached by remote file id and only the caption is replaced on reuse.
+
+Importing aiotdlib takes seconds, so this module
+is loaded only by commands that talk to telegram
+"""
+
+import logging
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Any, TypeVar
+
+from aiotdlib.api import (
+    Contact,
+    FormattedText,
+    InputFileRemote,
+    InputMessageAnimation,
+    InputMessageContact,
+    InputMessageDocument,
+    InputMessageLocation,
+    InputMessagePhoto,
+    InputMessageSticker,
+    InputMessageText,
+    InputMessageVideo,
+    InputMessageVoiceNote,
+    Location,
+    Message,
+    MessageAnimation,
+    MessageBasicGroupChatCreate,
+    MessageChatAddMembers,
+    MessageChatChangePhoto,
+    MessageChatChangeTitle,
+    MessageChatDeleteMember,
+    MessageChatDeletePhoto,
+    MessageChatJoinByLink,
+    MessageChatJoinByRequest,
+    MessageChatSetMessageAutoDeleteTime,
+    MessageContact,
+    MessageDocument,
+    MessageForumTopicCreated,
+    MessageForumTopicEdited,
+    MessageForumTopicIsClosedToggled,
+    MessageForumTopicIsHiddenToggled,
+    MessageLocation,
+    MessagePhoto,
+    MessagePinMessage,
+    MessageReplyToMessage,
+    MessageSticker,
+    MessageSupergroupChatCreate,
+    MessageText,
+    MessageVideo,
+    MessageVoiceNote,
+    TextEntity,
+)
+
+from shroombot.metrics import FILE_CACHE_HITS, FILE_CACHE_MISSES
+from shroombot.server import (
+    MyAnimationMessage,
+    MyContactMessage,
+    MyDocumentMessage,
+    MyLocationMessage,
+    MyMessageType,
+    MyPhotoMessage,
+    MyStickerMessage,
+    MyTextMessage,
+    MyVideoMessage,
+    MyVoiceMessage,
+)
+
+logger = logging.getLogger(__name__)
+
+InputMessageContent = (
+    InputMessageText
+    | InputMessagePhoto
+    | InputMessageDocument
+    | InputMessageSticker
+    | InputMessageVideo
+    | InputMessageAnimation
+    | InputMessageVoiceNote
+    | InputMessageLocation
+    | InputMessageContact
+)
+
+Decoder = Callable[[Any], MyMessageType]
+Encoder = Callable[[Any], InputMessageContent]
+
+# Class of the telegram message content -> decoder into the bot message
+DECODERS: dict[type, Decoder] = {}
+
+# Class of the bot message -> encoder into the telegram input message content
+ENCODERS: dict[type, Encoder] = {}
+
+# Service messages of chats and forum topics that are not forwarded
+IGNORED: frozenset[type] = frozenset(
+    [
+        MessageForumTopicCreated,
+        MessageForumTopicEdited,
+        MessageForumTopicIsClosedToggled,
+        MessageForumTopicIsHiddenToggled,
+        MessagePinMessage,
+        MessageChatAddMembers,
+        MessageChatDeleteMember,
+        MessageChatJoinByLink,
+        MessageChatJoinByRequest,
+        MessageChatChangeTitle,
+        MessageChatChangePhoto,
+        MessageChatDeletePhoto,
+        MessageChatSetMessageAutoDeleteTime,
+        MessageBasicGroupChatCreate,
+        MessageSupergroupChatCreate,
+    ]
+)
+
+
+@dataclass
+class FileCache:
+    """
+    Encoded media contents without caption by (message class, remote file id)
+    """
+
+    capacity: int = 10_000
+    items: OrderedDict[tuple[type, str], Any] = field(default_factory=OrderedDict)
+
+    def get(self, key: tuple[type, str]) -> Any | None:
+        content = self.items.get(key)
+        if content is None:
+            FILE_CACHE_MISSES.inc()
+            return None
+
+        FILE_CACHE_HITS.inc()
+        self.items.move_to_end(key)
+        return content
+
+    def put(self, key: tuple[type, str], content: Any):
+        self.items[key] = content
+        self.items.move_to_end(key)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+FILE_CACHE = FileCache()
+
+_D = TypeVar("_D", bound=Decoder)
+_E = TypeVar("_E", bound=Encoder)
+
+
+def register_decoder(content_class: type) -> Callable[[_D], _D]:
+    def _register(decoder: _D) -> _D:
+        DECODERS[content_class] = decoder
+        return decoder
+
+    return _register
+
+
+def register_encoder(message_class: type) -> Callable[[_E], _E]:
+    def _register(encoder: _E) -> _E:
+        ENCODERS[message_class] = encoder
+        return encoder
+
+    return _register
+
+
+def is_ignored(content: Any) -> bool:
+    return content.__class__ in IGNORED
+
+
+def decode_content(content: Any, chat_id: int, thread_id: int) -> MyMessageType | None:
+    """
+    Message of the bot from the content of a telegram message,
+    None for service messages that are not forwarded
+    """
+    content_class = content.__class__
+    if content_class in IGNORED:
+        return None
+
+    decoder = DECODERS.get(content_class)
+    if decoder is not None:
+        return decoder(content)
+
+    logger.warning(
+        "Encountered unsupported message type %s. Chat %d thread %d",
+        content_class.__name__,
+        chat_id,
+        thread_id,
+    )
+    return MyTextMessage(
+        f"<unsupported type {content_class.__name__}>",
+    )
+
+
+def encode_message(message: MyMessageType) -> InputMessageContent:
+    """
+    Telegram input message content to send the message of the bot
+    """
+    encoder = ENCODERS.get(message.__class__)
+    if encoder is None:
+        raise TypeError(f"Can not send message of type {type(message).__name__}")
+    return encoder(message)
+
+
+def reply_to_id(message: Message) -> int | None:
+    """
+    Id of the message in the same chat the message replies to
+    """
+    reply_to = message.reply_to
+    if isinstance(reply_to, MessageReplyToMessage) and reply_to.chat_id == (
+        message.chat_id
+    ):
+        return reply_to.message_id
+    return None
+
+
+def as_fmt(text: str, entities: list[TextEntity]) -> FormattedText:
+    return FormattedText(
+        text=text, entities=entities
+    )  # pyright: ignore[reportCallIssue]
+
+
+def as_maybe_fmt(text: str | None) -> FormattedText | None:
+    if text is None:
+        return None
+    return FormattedText(text=text, entities=[])  # pyright: ignore[reportCallIssue]
+
+
+def _remote(file_id: str) -> InputFileRemote:
+    return InputFileRemote(id=file_id)  # pyright: ignore[reportCallIssue]
+
+
+def _encode_media(message: Any, build: Callable[[], Any]) -> InputMessageContent:
+    """
+    Content of a media message, built without caption once per file
+    """
+    key = (message.__class__, message.id)
+
+    content = FILE_CACHE.get(key)
+    if content is None:
+        content = build()
+        FILE_CACHE.put(key, content)
+
+    caption = getattr(message, "caption", None)
+    if caption is None:
+        return content
+    # Copy is not validated again
+    return content.copy(update={"caption": as_maybe_fmt(caption)})
+
+
+@register_decoder(MessageText)
+def _decode_text(content: MessageText) -> MyMessageType:
+    return MyTextMessage(text=content.text.text, entities=content.text.entities)
+
+
+@register_encoder(MyTextMessage)
+def _encode_text(message: MyTextMessage) -> InputMessageContent:
+    return InputMessageText(
+        text=as_fmt(message.text, message.entities)
+    )  # pyright: ignore[reportCallIssue]
+
+
+@register_decoder(MessagePhoto)
+def _decode_photo(content: MessagePhoto) -> MyMessageType:
+    # Sizes go from the smallest thumbnail up, but order is not guaranteed
+    size = max(content.photo.sizes, key=lambda item: item.width * item.height)
+    return MyPhotoMessage(
+        id=size.photo.remote.id,
+        caption=content.caption.text,
+        width=size.width,
+        height=size.height,
+    )
+
+
+@register_encoder(MyPhotoMessage)
+def _encode_photo(message: MyPhotoMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessagePhoto(
+            photo=_remote(message.id),
+            width=message.width,
+            height=message.height,
+            added_sticker_file_ids=[],
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageDocument)
+def _decode_document(content: MessageDocument) -> MyMessageType:
+    return MyDocumentMessage(
+        id=content.document.document.remote.id,
+        caption=content.caption.text,
+    )
+
+
+@register_encoder(MyDocumentMessage)
+def _encode_document(message: MyDocumentMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessageDocument(
+            document=_remote(message.id),
+            disable_content_type_detection=True,
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageSticker)
+def _decode_sticker(content: MessageSticker) -> MyMessageType:
+    sticker = content.sticker
+    return MyStickerMessage(
+        id=sticker.sticker.remote.id,
+        emoji=sticker.emoji,
+        width=sticker.width,
+        height=sticker.height,
+    )
+
+
+@register_encoder(MyStickerMessage)
+def _encode_sticker(message: MyStickerMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessageSticker(
+            sticker=_remote(message.id),
+            width=message.width,
+            height=message.height,
+            emoji=message.emoji,
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageVideo)
+def _decode_video(content: MessageVideo) -> MyMessageType:
+    video = content.video
+    return MyVideoMessage(
+        id=video.video.remote.id,
+        caption=content.caption.text,
+        width=video.width,
+        height=video.height,
+        duration=video.duration,
+    )
+
+
+@register_encoder(MyVideoMessage)
+def _encode_video(message: MyVideoMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessageVideo(
+            video=_remote(message.id),
+            added_sticker_file_ids=[],
+            duration=message.duration,
+            width=message.width,
+            height=message.height,
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageAnimation)
+def _decode_animation(content: MessageAnimation) -> MyMessageType:
+    animation = content.animation
+    return MyAnimationMessage(
+        id=animation.animation.remote.id,
+        caption=content.caption.text,
+        width=animation.width,
+        height=animation.height,
+        duration=animation.duration,
+    )
+
+
+@register_encoder(MyAnimationMessage)
+def _encode_animation(message: MyAnimationMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessageAnimation(
+            animation=_remote(message.id),
+            added_sticker_file_ids=[],
+            duration=message.duration,
+            width=message.width,
+            height=message.height,
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageVoiceNote)
+def _decode_voice(content: MessageVoiceNote) -> MyMessageType:
+    voice_note = content.voice_note
+    return MyVoiceMessage(
+        id=voice_note.voice.remote.id,
+        caption=content.caption.text,
+        duration=voice_note.duration,
+        waveform=voice_note.waveform,
+    )
+
+
+@register_encoder(MyVoiceMessage)
+def _encode_voice(message: MyVoiceMessage) -> InputMessageContent:
+    return _encode_media(
+        message,
+        lambda: InputMessageVoiceNote(
+            voice_note=_remote(message.id),
+            duration=message.duration,
+            waveform=message.waveform,
+        ),  # pyright: ignore[reportCallIssue]
+    )
+
+
+@register_decoder(MessageLocation)
+def _decode_location(content: MessageLocation) -> MyMessageType:
+    return MyLocationMessage(
+        latitude=content.location.latitude,
+        longitude=content.location.longitude,
+    )
+
+
+@register_encoder(MyLocationMessage)
+def _encode_location(message: MyLocationMessage) -> InputMessageContent:
+    return InputMessageLocation(
+        location=Location(
+            latitude=message.latitude,
+            longitude=message.longitude,
+            horizontal_accuracy=0,
+        ),  # pyright: ignore[reportCallIssue]
+        live_period=0,
+    )  # pyright: ignore[reportCallIssue]
+
+
+@register_decoder(MessageContact)
+def _decode_contact(content: MessageContact) -> MyMessageType:
+    contact = content.contact
+    return MyContactMessage(
+        phone_number=contact.phone_number,
+        first_name=contact.first_name,
+        last_name=contact.last_name,
+        vcard=contact.vcard,
+    )
+
+
+@register_encoder(MyContactMessage)
+def _encode_contact(message: MyContactMessage) -> InputMessageContent:
+    return InputMessageContact(
+        contact=Contact(
+            phone_number=message.phone_number,
+            first_name=message.first_name,
+            last_name=message.last_name,
+            vcard=message.vcard,
+            # Contact is sent as plain card, not linked to the telegram user
+            user_id=0,
+        )  # pyright: ignore[reportCallIssue]
+    )  # pyright: ignore[reportCallIssue]
@@ -0,0 +1,112 @@
+"""
+Testing of decoding and encoding of telegram messages
+"""
+
+from aiotdlib.api import (
+    MessageForumTopicCreated,
+    MessageGame,
+    MessagePinMessage,
+    MessageText,
+)
+from prometheus_client import REGISTRY
+
+from shroombot.adapter import (
+    DECODERS,
+    FILE_CACHE,
+    FileCache,
+    decode_content,
+    encode_message,
+    is_ignored,
+    register_decoder,
+)
+from shroombot.benchmark_codec import run_codec_benchmark, sample_contents
+from shroombot.server import (
+    MyLocationMessage,
+    MyPhotoMessage,
+    MyTextMessage,
+    MyVideoMessage,
+)
+
+
+def test_decode_encode_all_types():
+    for content in sample_contents():
+        message = decode_content(content, 1, 0)
+        assert message is not None, content
+
+        # Content of the same kind is sent back
+        encoded = encode_message(message)
+        assert encoded.ID.removeprefix("inputM") == content.ID.removeprefix("m")
+
+    video = decode_content(sample_contents()[4], 1, 0)
+    assert video == MyVideoMessage(
+        id="video", caption="caption", width=640, height=480, duration=10
+    )
+
+
+def test_photo_largest_size():
+    photo = decode_content(sample_contents()[1], 1, 0)
+
+    assert photo == MyPhotoMessage(
+        id="photo", caption="caption", width=1280, height=853
+    )
+
+    encoded = encode_message(photo)
+    assert (encoded.width, encoded.height) == (1280, 853)
+
+
+def _cache_hits() -> float:
+    return REGISTRY.get_sample_value("shroombot_file_cache_hits_total") or 0
+
+
+def test_file_cache():
+    FILE_CACHE.clear()
+    hits = _cache_hits()
+
+    first = encode_message(MyPhotoMessage("file", "one", 10, 10))
+    second = encode_message(MyPhotoMessage("file", "two", 10, 10))
+    bare = encode_message(MyPhotoMessage("file", None, 10, 10))
+
+    # File is shared, captions are not
+    assert first.photo is second.photo is bare.photo
+    assert (first.caption.text, second.caption.text) == ("one", "two")
+    assert bare.caption is None
+    assert _cache_hits() == hits + 2
+
+    cache = FileCache(capacity=2)
+    cache.put((MyPhotoMessage, "a"), 1)
+    cache.put((MyPhotoMessage, "b"), 2)
+    assert cache.get((MyPhotoMessage, "a")) == 1
+    cache.put((MyPhotoMessage, "c"), 3)
+
+    # Least recently used is evicted
+    assert list(cache.items) == [(MyPhotoMessage, "a"), (MyPhotoMessage, "c")]
+
+
+def test_decode_service_and_unsupported():
+    assert is_ignored(MessagePinMessage.construct(message_id=1))
+    assert decode_content(MessageForumTopicCreated.construct(), 1, 0) is None
+
+    assert decode_content(MessageGame.construct(), 1, 0) == MyTextMessage(
+        "<unsupported type MessageGame>"
+    )
+
+
+def test_register_decoder():
+    original = DECODERS[MessageText]
+    try:
+
+        @register_decoder(MessageText)
+        def _decode(_content: MessageText) -> MyLocationMessage:
+            return MyLocationMessage(0.0, 0.0)
+
+        content = sample_contents()[0]
+        assert decode_content(content, 1, 0) == MyLocationMessage(0.0, 0.0)
+    finally:
+        DECODERS[MessageText] = original
+
+
+def test_codec_benchmark():
+    report = run_codec_benchmark(num_iterations=10)
+
+    assert set(report.decode) == set(report.encode)
+    assert "MessageVoiceNote" in report.decode
@@ -1,28 +1,58 @@
 """
 Class that allows to get thread id based on chat id and vise-versa
 
-stores the data encrypted to disk
+stores the data encrypted to disk.
+
+The data lives in two files: a snapshot with all mappings
+and an append-only journal next to it with one encrypted record
+per registered mapping. The journal is periodically compacted into the snapshot.
+
+Both use the binary format from mapping_format,
+snapshots in the old json format are still loaded and migrated on startup.
 """
 
 import asyncio
 import json
+import logging
 import os
-from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from array import array
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import Any, Self
 
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import InvalidToken
 from pydantic import BaseModel
 
+from shroombot.keyring import EncryptionKey, RotationStep, get_cipher
+from shroombot.mapping_format import (
+    RECORD,
+    decode_columns,
+    decode_record,
+    encode_columns,
+    encode_record,
+    is_binary,
+)
+from shroombot.mapping_index import MappingIndex
+from shroombot.metrics import JOURNAL_WRITE_SECONDS, REGISTER_SECONDS
+
+logger = logging.getLogger(__name__)
 
-def load_encrypted_json_file(file_path: str, encryption_key: bytes) -> dict:
-    # Initialize the Fernet cipher with the given key
-    cipher = Fernet(encryption_key)
+
+def load_encrypted_file(file_path: str, encryption_key: EncryptionKey) -> bytes:
+    # Any of the keys decrypts, the newest one encrypts
+    cipher = get_cipher(encryption_key)
 
     # Read the encrypted data from the file
     with open(file_path, "rb") as file:
         encrypted_data = file.read()
 
     # Decrypt the data
-    decrypted_data = cipher.decrypt(encrypted_data)
+    return cipher.decrypt(encrypted_data)
+
+
+def load_encrypted_json_file(file_path: str, encryption_key: EncryptionKey) -> dict:
+    decrypted_data = load_encrypted_file(file_path, encryption_key)
 
     # Convert the decrypted data (bytes) to string and load as JSON
     json_data = json.loads(decrypted_data.decode("utf-8"))
@@ -30,19 +60,86 @@ def load_encrypted_json_file(file_path: str, encryption_key: bytes) -> dict:
     return json_data
 
 
-def save_encrypted_json_file(file_path: str, data: dict, encryption_key: bytes):
-    # Initialize the Fernet cipher with the given key
-    cipher = Fernet(encryption_key)
+def backup_path(file_path: str, idx: int) -> str:
+    return f"{file_path}.{idx}"
+
+
+def existing_snapshots(file_path: str) -> list[str]:
+    """
+    Paths of the snapshot and its backups that exist, newest first
+    """
+    directory, name = os.path.split(os.path.abspath(file_path))
+
+    backups = []
+    for entry in os.listdir(directory):
+        suffix = entry[len(name) + 1 :]
+        if entry.startswith(name + ".") and suffix.isdigit():
+            backups.append(int(suffix))
+
+    paths = [file_path] + [backup_path(file_path, idx) for idx in sorted(backups)]
+
+    return [path for path in paths if os.path.exists(path)]
+
+
+def fsync_dir(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_encrypted_file(
+    file_path: str, data: bytes, encryption_key: EncryptionKey, backups: int = 0
+):
+    """
+    Atomically replace the file with encrypted data,
+    keeping given number of previous versions as backups
+    """
+    # Any of the keys decrypts, the newest one encrypts
+    cipher = get_cipher(encryption_key)
+
+    encrypted_data = cipher.encrypt(data)
+
+    # Write the encrypted data to a temporary file next to the target,
+    # so that a crash never leaves the target truncated
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(encrypted_data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    if backups > 0 and os.path.exists(file_path):
+        for idx in range(backups - 1, 0, -1):
+            if os.path.exists(backup_path(file_path, idx)):
+                os.replace(backup_path(file_path, idx), backup_path(file_path, idx + 1))
+        os.replace(file_path, backup_path(file_path, 1))
 
+    os.replace(temp_path, file_path)
+
+    fsync_dir(os.path.dirname(os.path.abspath(file_path)))
+
+
+def save_encrypted_json_file(
+    file_path: str, data: dict, encryption_key: EncryptionKey, backups: int = 0
+):
     # Convert the dictionary to a JSON string
     json_data = json.dumps(data)
 
-    # Encrypt the JSON string (encode it to bytes first)
-    encrypted_data = cipher.encrypt(json_data.encode("utf-8"))
+    save_encrypted_file(file_path, json_data.encode("utf-8"), encryption_key, backups)
 
-    # Write the encrypted data to the file
-    with open(file_path, "wb") as file:
-        file.write(encrypted_data)
+
+def save_snapshot(
+    file_path: str,
+    columns: tuple[array, array],
+    encryption_key: EncryptionKey,
+    compress: bool = True,
+    backups: int = 0,
+):
+    chats, topics = columns
+    save_encrypted_file(
+        file_path, encode_columns(chats, topics, compress), encryption_key, backups
+    )
 
 
 # Example usage:
@@ -56,6 +153,103 @@ def save_encrypted_json_file(file_path: str, data: dict, encryption_key: bytes):
 # save_encrypted_json_file('path_to_save_file', decrypted_data, encryption_key)
 
 
+def append_encrypted_lines(
+    file_path: str, payloads: list[bytes], encryption_key: EncryptionKey
+):
+    """
+    Append encrypted payloads to the file with a single write.
+
+    Every payload is encrypted separately. Fernet tokens are url-safe base64,
+    so payloads are newline-delimited
+    """
+    cipher = get_cipher(encryption_key)
+
+    data = b"".join(cipher.encrypt(payload) + b"\n" for payload in payloads)
+
+    with open(file_path, "ab") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def load_encrypted_lines(file_path: str, encryption_key: EncryptionKey) -> list[bytes]:
+    """
+    Read and decrypt all payloads of the file.
+
+    Incomplete trailing payload (crash during append) is dropped from the file
+    """
+    cipher = get_cipher(encryption_key)
+
+    with open(file_path, "rb") as file:
+        content = file.read()
+
+    lines = content.split(b"\n")
+
+    # Last element is either empty or a payload that was not fully written
+    if lines[-1]:
+        with open(file_path, "r+b") as file:
+            file.truncate(len(content) - len(lines[-1]))
+
+    return [cipher.decrypt(line) for line in lines[:-1]]
+
+
+def rotate_encrypted_lines(file_path: str, encryption_key: EncryptionKey):
+    """
+    Atomically re-encrypt all payloads of the file with the newest key
+    """
+    cipher = get_cipher(encryption_key)
+
+    with open(file_path, "rb") as file:
+        lines = file.read().split(b"\n")
+
+    # Incomplete trailing payload is dropped, as on load
+    data = b"".join(cipher.rotate(line) + b"\n" for line in lines[:-1])
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, file_path)
+    fsync_dir(os.path.dirname(os.path.abspath(file_path)))
+
+
+def append_encrypted_records(
+    file_path: str, records: list[tuple[int, int]], encryption_key: EncryptionKey
+):
+    """
+    Append encrypted (chat id, topic id) records to the journal file
+    """
+    append_encrypted_lines(
+        file_path,
+        [encode_record(chat_id, topic_id) for chat_id, topic_id in records],
+        encryption_key,
+    )
+
+
+def _decode_journal_record(data: bytes) -> tuple[int, int]:
+    # Binary records have a fixed size. Journals written before binary format
+    # hold json records, which are always longer
+    if len(data) == RECORD.size:
+        return decode_record(data)
+
+    record = json.loads(data.decode("utf-8"))
+    return record["chat_id"], record["topic_id"]
+
+
+def load_encrypted_records(
+    file_path: str, encryption_key: EncryptionKey
+) -> list[tuple[int, int]]:
+    """
+    Read all records of the journal file
+    """
+    return [
+        _decode_journal_record(line)
+        for line in load_encrypted_lines(file_path, encryption_key)
+    ]
+
+
 class MappingItem(BaseModel):
     chat_id: int
     topic_id: int
@@ -79,45 +273,280 @@ def is_file_empty(file_path: str) -> bool:
     return os.stat(file_path).st_size == 0
 
 
+def _decode_snapshot(data: bytes) -> tuple[MappingIndex, bool]:
+    if is_binary(data):
+        return MappingIndex.from_columns(*decode_columns(data)), False
+
+    index = MappingIndex()
+    for mapping in EncryptedData.parse_raw(data).mappings:
+        index.add(mapping.chat_id, mapping.topic_id)
+    index.merge()
+
+    return index, True
+
+
+async def load_snapshot(
+    file_path: str, encryption_key: EncryptionKey
+) -> tuple[MappingIndex, bool]:
+    """
+    Load newest snapshot that can be decrypted.
+
+    Returns index of the mappings
+    and whether snapshot is in the old json format
+    """
+    error = None
+
+    for path in existing_snapshots(file_path):
+        # Snapshots are replaced atomically, an empty one was cut short
+        # (an empty file without backups is still a start from scratch)
+        if is_file_empty(path):
+            logger.error("Snapshot %s is empty", path)
+            continue
+
+        try:
+            data = await asyncio.to_thread(load_encrypted_file, path, encryption_key)
+            index, legacy = await asyncio.to_thread(_decode_snapshot, data)
+        except (InvalidToken, ValueError) as exc:
+            logger.error("Could not decrypt snapshot %s", path)
+            error = exc
+            continue
+
+        if path != file_path:
+            logger.warning("Loaded mappings from backup snapshot %s", path)
+
+        return index, legacy
+
+    if error is not None:
+        raise CouldNotDecrypt() from error
+
+    return MappingIndex(), False
+
+
+def journal_path(file_path: str) -> str:
+    return file_path + ".journal"
+
+
+def compacting_journal_path(file_path: str) -> str:
+    return file_path + ".journal.compacting"
+
+
+def rotate_journal(file_path: str):
+    """
+    Move current journal aside so that it can be compacted.
+
+    If previous compaction did not finish, its journal is extended instead
+    """
+    current = journal_path(file_path)
+    compacting = compacting_journal_path(file_path)
+
+    if not os.path.exists(current):
+        return
+
+    if not os.path.exists(compacting):
+        os.replace(current, compacting)
+        return
+
+    with open(current, "rb") as src, open(compacting, "ab") as dst:
+        dst.write(src.read())
+    os.remove(current)
+
+
+def load_journals(
+    file_path: str, encryption_key: EncryptionKey
+) -> list[tuple[int, int]]:
+    """
+    Records of the journals, oldest first
+    """
+    records = []
+    # Journal being compacted (if compaction was interrupted)
+    # is older than the current one
+    for path in (compacting_journal_path(file_path), journal_path(file_path)):
+        if os.path.exists(path):
+            records.extend(load_encrypted_records(path, encryption_key))
+    return records
+
+
+async def load_journal_records(
+    file_path: str, encryption_key: EncryptionKey
+) -> list[tuple[int, int]]:
+    try:
+        return await asyncio.to_thread(load_journals, file_path, encryption_key)
+    except (InvalidToken, ValueError) as exc:
+        raise CouldNotDecrypt() from exc
+
+
+async def load_mappings(file_path: str, encryption_key: EncryptionKey) -> MappingIndex:
+    """
+    Load mappings of the snapshot and journal files, the files are not changed
+    """
+    index, _ = await load_snapshot(file_path, encryption_key)
+
+    for chat_id, topic_id in await load_journal_records(file_path, encryption_key):
+        index.add(chat_id, topic_id)
+
+    return index
+
+
+def has_mappings(file_path: str) -> bool:
+    """
+    Whether there is a snapshot or journal to load mappings from
+    """
+    return bool(existing_snapshots(file_path)) or any(
+        os.path.exists(path)
+        for path in (journal_path(file_path), compacting_journal_path(file_path))
+    )
+
+
+class MappingStore(ABC):
+    """
+    Persisted chat id <-> topic id mappings, lookups may need to wait for storage
+    """
+
+    @abstractmethod
+    async def find_topic_id(self, chat_id: int) -> int | None:
+        ...
+
+    @abstractmethod
+    async def find_chat_id(self, topic_id: int) -> int | None:
+        ...
+
+    @abstractmethod
+    async def get_or_create_topic_id(
+        self, chat_id: int, create_topic: Callable[[], Awaitable[int]]
+    ) -> int:
+        ...
+
+    @abstractmethod
+    async def register_chat_topic_link(
+        self, chat_id: int, topic_id: int, wait: bool = True
+    ):
+        ...
+
+    @abstractmethod
+    async def columns(self) -> tuple[array, array]:
+        """
+        Chat ids and their topic ids
+        """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def rotation_steps(self) -> list[RotationStep]:
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+
+async def open_mapping_store(
+    file_path: str, encryption_key: EncryptionKey, storage: str = "file"
+) -> MappingStore:
+    """
+    Mappings in the snapshot file, or in sqlite database or paged file next to it
+    """
+    if storage == "file":
+        return await Anonymizer.from_file(file_path, encryption_key)
+    if storage == "sqlite":
+        # pylint: disable-next=import-outside-toplevel,cyclic-import
+        from shroombot.sqlite_store import SqliteMappingStore
+
+        return await SqliteMappingStore.from_file(
+            sqlite_path(file_path), encryption_key, migrate_from=file_path
+        )
+    if storage == "paged":
+        # pylint: disable-next=import-outside-toplevel,cyclic-import
+        from shroombot.paged_store import PagedAnonymizer
+
+        return await PagedAnonymizer.from_file(
+            paged_path(file_path), encryption_key, migrate_from=file_path
+        )
+    raise ValueError(f"Unknown storage {storage}")
+
+
+def sqlite_path(file_path: str) -> str:
+    return file_path + ".sqlite"
+
+
+def paged_path(file_path: str) -> str:
+    return file_path + ".paged"
+
+
 @dataclass
-class Anonymizer:
+class Anonymizer(MappingStore):
     """
     Maps chat ids (that can be linked to users)
     to topics in a supergroup
     """
 
-    topic_x_chat: dict[int, int]
-    chat_x_topic: dict[int, int]
+    index: MappingIndex
     lock: asyncio.Lock
     file_path: str
-    encryption_key: bytes
+    encryption_key: EncryptionKey
+
+    # Compact journal into the snapshot after this many records
+    compact_every: int = 1000
+    # Number of previous snapshots to keep
+    backups: int = 2
+    # Compress snapshot before encryption
+    compress: bool = True
+    journal_records: int = 0
+    compaction: asyncio.Task | None = field(default=None, repr=False)
+    # Topics that are being created right now
+    pending_topics: dict[int, asyncio.Future[int]] = field(
+        default_factory=dict, repr=False
+    )
+
+    # Registrations are written to disk together at most once per interval
+    # or as soon as this many are pending
+    flush_interval: float = 0.05
+    flush_batch: int = 100
+    pending: list[tuple[int, int]] = field(default_factory=list, repr=False)
+    # Resolved when currently pending registrations are on disk
+    flushed: asyncio.Future[None] | None = field(default=None, repr=False)
+    flush_now: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    flusher: asyncio.Task | None = field(default=None, repr=False)
 
     @staticmethod
-    async def from_file(file_path: str, encryption_key: bytes) -> "Anonymizer":
-        topic_x_chat = dict()
-        chat_x_topic = dict()
-
-        if os.path.exists(file_path):
-            if not is_file_empty(file_path):
-                try:
-                    data = await asyncio.to_thread(
-                        load_encrypted_json_file, file_path, encryption_key
-                    )
-                except (InvalidToken, ValueError) as exc:
-                    raise CouldNotDecrypt() from exc
+    async def from_file(
+        file_path: str, encryption_key: EncryptionKey, **options: Any
+    ) -> "Anonymizer":
+        """
+        Load mappings from the snapshot and journal.
+
+        Options are passed to the constructor (compact_every, backups, ...)
+        """
+        index, legacy = await load_snapshot(file_path, encryption_key)
+        anonymizer = await Anonymizer.with_journal(
+            index, file_path, encryption_key, **options
+        )
 
-                data = EncryptedData.parse_obj(data)
+        if legacy:
+            # Migrate to the binary format
+            anonymizer.compaction = asyncio.create_task(anonymizer.compact())
 
-                for mapping in data.mappings:
-                    topic_x_chat[mapping.topic_id] = mapping.chat_id
-                    chat_x_topic[mapping.chat_id] = mapping.topic_id
+        return anonymizer
 
-        return Anonymizer(
-            topic_x_chat=topic_x_chat,
-            chat_x_topic=chat_x_topic,
+    @classmethod
+    async def with_journal(
+        cls, index: Any, file_path: str, encryption_key: EncryptionKey, **options: Any
+    ) -> Self:
+        """
+        Store with the journal records added to the loaded index
+        """
+        records = await load_journal_records(file_path, encryption_key)
+        for chat_id, topic_id in records:
+            index.add(chat_id, topic_id)
+
+        return cls(
+            index=index,
             lock=asyncio.Lock(),
             file_path=file_path,
             encryption_key=encryption_key,
+            journal_records=len(records),
+            **options,
         )
 
     def get_topic_id(self, chat_id: int) -> int | None:
@@ -125,26 +554,207 @@ class Anonymizer:
         Return topic id based on chat id
         """
 
-        return self.chat_x_topic.get(chat_id)
+        return self.index.get_topic_id(chat_id)
+
+    async def find_topic_id(self, chat_id: int) -> int | None:
+        return self.index.get_topic_id(chat_id)
+
+    async def find_chat_id(self, topic_id: int) -> int | None:
+        return self.index.get_chat_id(topic_id)
+
+    async def columns(self) -> tuple[array, array]:
+        return self.index.columns()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    async def get_or_create_topic_id(
+        self, chat_id: int, create_topic: Callable[[], Awaitable[int]]
+    ) -> int:
+        """
+        Return topic id of the chat, creating and registering topic if not known.
+
+        Concurrent calls for the same chat share one topic creation
+        """
+        topic_id = self.index.get_topic_id(chat_id)
+        if topic_id is not None:
+            return topic_id
+
+        pending = self.pending_topics.get(chat_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        pending = asyncio.get_running_loop().create_future()
+        self.pending_topics[chat_id] = pending
+
+        try:
+            topic_id = await create_topic()
+            await self.register_chat_topic_link(chat_id, topic_id)
+        except BaseException as exc:
+            pending.set_exception(exc)
+            # Mark as retrieved, the exception is raised to the caller below
+            pending.exception()
+            raise
+        else:
+            pending.set_result(topic_id)
+        finally:
+            del self.pending_topics[chat_id]
+
+        return topic_id
+
+    async def register_chat_topic_link(
+        self, chat_id: int, topic_id: int, wait: bool = True
+    ):
+        """
+        Link chat and topic.
+
+        The link is visible right away, and written to disk with other pending
+        registrations. If wait is set, returns only after the link is on disk
+        """
+        with REGISTER_SECONDS.time():
+            flushed = self._register(chat_id, topic_id)
+
+            if wait:
+                await asyncio.shield(flushed)
+
+    def _register(self, chat_id: int, topic_id: int) -> asyncio.Future[None]:
+        self.index.add(chat_id, topic_id)
+
+        self.pending.append((chat_id, topic_id))
+
+        if self.flushed is None:
+            self.flushed = asyncio.get_running_loop().create_future()
+
+        if len(self.pending) >= self.flush_batch:
+            self.flush_now.set()
+
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_loop())
+
+        return self.flushed
+
+    async def flush(self):
+        """
+        Write pending registrations to disk right away
+        """
+        if self.flushed is None:
+            return
+
+        flushed = self.flushed
+        self.flush_now.set()
+        await asyncio.shield(flushed)
+
+    async def close(self):
+        """
+        Flush pending registrations and wait for compaction to finish
+        """
+        await self.flush()
+        if self.compaction is not None:
+            await self.compaction
+
+    async def _flush_loop(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), self.flush_interval)
+            except TimeoutError:
+                pass
+            self.flush_now.clear()
+
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        records, self.pending = self.pending, []
+        flushed, self.flushed = self.flushed, None
+
+        if flushed is None:
+            return
+
+        if not records:
+            flushed.set_result(None)
+            return
+
+        try:
+            async with self.lock:
+                with JOURNAL_WRITE_SECONDS.time():
+                    await asyncio.to_thread(
+                        append_encrypted_records,
+                        journal_path(self.file_path),
+                        records,
+                        self.encryption_key,
+                    )
+                self.journal_records += len(records)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.exception("Could not write mappings, retrying")
+
+            # Retry with the next flush
+            self.pending = records + self.pending
+            if self.flushed is None:
+                self.flushed = asyncio.get_running_loop().create_future()
+
+            flushed.set_exception(exc)
+            # Mark as retrieved, there may be no one waiting
+            flushed.exception()
+            return
 
-    async def register_chat_topic_link(self, chat_id: int, topic_id: int):
+        flushed.set_result(None)
+
+        if self.journal_records >= self.compact_every and (
+            self.compaction is None or self.compaction.done()
+        ):
+            self.compaction = asyncio.create_task(self.compact())
+
+    async def compact(self):
+        """
+        Write all mappings to the snapshot and drop the journal
+        """
         async with self.lock:
-            self.chat_x_topic[chat_id] = topic_id
-            self.topic_x_chat[topic_id] = chat_id
+            mappings = self._start_compaction()
+
+            # New records go to a fresh journal while mappings are written
+            await asyncio.to_thread(rotate_journal, self.file_path)
+            self.journal_records = 0
+
+        try:
+            await self._write_compacted(mappings)
+        except Exception:
+            logger.exception("Could not compact mapping journal")
+            raise
+
+        compacting = compacting_journal_path(self.file_path)
+        if os.path.exists(compacting):
+            os.remove(compacting)
+
+    def _start_compaction(self) -> Any:
+        return self.index.columns()
+
+    async def _write_compacted(self, mappings: Any):
+        await asyncio.to_thread(
+            save_snapshot,
+            self.file_path,
+            mappings,
+            self.encryption_key,
+            self.compress,
+            self.backups,
+        )
+
+    def rotation_steps(self) -> list[RotationStep]:
+        """
+        Every compaction writes the snapshot with the newest key and pushes out
+        the oldest backup, so the snapshot and all backups are re-encrypted
+        after one more compaction than there are backups
+        """
+        return [self._compact_now] * (self.backups + 1)
 
-            mappings = list()
-            for m_chat_id, m_topic_id in self.chat_x_topic.items():
-                mappings.append(MappingItem(chat_id=m_chat_id, topic_id=m_topic_id))
+    async def _compact_now(self):
+        # Compactions must not run concurrently
+        if self.compaction is not None and not self.compaction.done():
+            await asyncio.gather(self.compaction, return_exceptions=True)
 
-            await asyncio.to_thread(
-                save_encrypted_json_file,
-                self.file_path,
-                EncryptedData(mappings=mappings).dict(),
-                self.encryption_key,
-            )
+        self.compaction = asyncio.create_task(self.compact())
+        await self.compaction
 
     def get_chat_id(self, topic_id: int) -> int | None:
         """
         Return chat id based on topic id
         """
-        return self.topic_x_chat.get(topic_id)
+        return self.index.get_chat_id(topic_id)
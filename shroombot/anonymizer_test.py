@@ -2,13 +2,26 @@
 Testing if anonymizer correctly works and loads/saves data from/to disk
 """
 
+import asyncio
 import os
 from tempfile import TemporaryDirectory
 
 import pytest
 from cryptography.fernet import Fernet
 
-from shroombot.anonymizer import Anonymizer, CouldNotDecrypt
+from shroombot.anonymizer import (
+    Anonymizer,
+    CouldNotDecrypt,
+    append_encrypted_lines,
+    append_encrypted_records,
+    existing_snapshots,
+    is_file_empty,
+    journal_path,
+    load_encrypted_file,
+    open_mapping_store,
+    save_encrypted_json_file,
+)
+from shroombot.mapping_format import is_binary
 
 
 @pytest.mark.asyncio
@@ -51,3 +64,241 @@ async def test_anonymizer():
 
         with pytest.raises(CouldNotDecrypt):
             anonymizer = await Anonymizer.from_file(file_path, b"123")
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_journal_compaction():
+    encryption_key = Fernet.generate_key()
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        anonymizer = await Anonymizer.from_file(
+            file_path, encryption_key, compact_every=3
+        )
+
+        for chat_id in range(5):
+            await anonymizer.register_chat_topic_link(chat_id, chat_id + 100)
+
+        assert anonymizer.compaction is not None
+        await anonymizer.compaction
+
+        # Snapshot holds compacted records, journal holds the rest
+        assert not is_file_empty(file_path)
+        assert anonymizer.journal_records < 3
+
+        # Simulate crash in the middle of journal append
+        with open(journal_path(file_path), "ab") as file:
+            file.write(b"gAAAA")
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+
+        for chat_id in range(5):
+            assert anonymizer.get_topic_id(chat_id) == chat_id + 100
+            assert anonymizer.get_chat_id(chat_id + 100) == chat_id
+
+        # Journal must remain appendable after crash
+        await anonymizer.register_chat_topic_link(5, 105)
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.get_topic_id(5) == 105
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_journal_records_starting_with_brace():
+    encryption_key = Fernet.generate_key()
+
+    # Encoded records start with b"{", as json records do
+    chat_ids = [ord("{"), 0x17B, -(2**63) + 0x7B, 0x7B7B7B7B7B7B7B7B]
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        # Journal written before the binary format
+        append_encrypted_lines(
+            journal_path(file_path), [b'{"chat_id": 1, "topic_id": 2}'], encryption_key
+        )
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        for chat_id in chat_ids:
+            await anonymizer.register_chat_topic_link(chat_id, ord("{"))
+        await anonymizer.close()
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.get_topic_id(1) == 2
+        for chat_id in chat_ids:
+            assert anonymizer.get_topic_id(chat_id) == ord("{")
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_loads_legacy_snapshot():
+    encryption_key = Fernet.generate_key()
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        save_encrypted_json_file(
+            file_path,
+            {"mappings": [{"chat_id": 1, "topic_id": 2}]},
+            encryption_key,
+        )
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+
+        assert anonymizer.get_topic_id(1) == 2
+        assert anonymizer.get_chat_id(2) == 1
+
+        # Snapshot is migrated to the binary format
+        assert anonymizer.compaction is not None
+        await anonymizer.compaction
+        assert is_binary(load_encrypted_file(file_path, encryption_key))
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.compaction is None
+        assert anonymizer.get_topic_id(1) == 2
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_group_commit(monkeypatch):
+    encryption_key = Fernet.generate_key()
+
+    writes = []
+
+    def _append(file_path: str, records: list[dict], key: bytes):
+        writes.append(len(records))
+        append_encrypted_records(file_path, records, key)
+
+    monkeypatch.setattr("shroombot.anonymizer.append_encrypted_records", _append)
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        anonymizer = await Anonymizer.from_file(
+            file_path, encryption_key, flush_interval=10, flush_batch=20
+        )
+
+        # Batch is full: written without waiting for the interval
+        await asyncio.gather(
+            *(anonymizer.register_chat_topic_link(idx, idx + 100) for idx in range(20))
+        )
+        assert writes == [20]
+
+        # Not durable yet, but visible right away
+        await anonymizer.register_chat_topic_link(20, 120, wait=False)
+        assert anonymizer.get_topic_id(20) == 120
+        assert writes == [20]
+
+        await anonymizer.close()
+        assert writes == [20, 1]
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        for idx in range(21):
+            assert anonymizer.get_topic_id(idx) == idx + 100
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_snapshot_backups():
+    encryption_key = Fernet.generate_key()
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        for idx in range(4):
+            save_encrypted_json_file(
+                file_path,
+                {"mappings": [{"chat_id": idx, "topic_id": idx + 100}]},
+                encryption_key,
+                backups=2,
+            )
+
+        assert existing_snapshots(file_path) == [
+            file_path,
+            file_path + ".1",
+            file_path + ".2",
+        ]
+
+        # Snapshot corrupted: newest backup is used
+        with open(file_path, "wb") as file:
+            file.write(b"corrupted")
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.get_topic_id(2) == 102
+
+        # Snapshot lost while rotating backups
+        os.remove(file_path)
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.get_topic_id(2) == 102
+
+
+@pytest.mark.asyncio
+async def test_anonymizer_empty_snapshot():
+    encryption_key = Fernet.generate_key()
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "test.bin")
+
+        # Empty file without backups has no mappings
+        with open(file_path, "wb"):
+            pass
+
+        anonymizer = await Anonymizer.from_file(
+            file_path, encryption_key, compact_every=1
+        )
+        assert len(anonymizer) == 0
+        await anonymizer.register_chat_topic_link(1, 101)
+        await anonymizer.close()
+        await anonymizer.register_chat_topic_link(2, 102)
+        await anonymizer.close()
+
+        assert existing_snapshots(file_path)[:2] == [file_path, file_path + ".1"]
+
+        # Snapshot truncated to zero length: the backup is used
+        with open(file_path, "wb"):
+            pass
+
+        anonymizer = await Anonymizer.from_file(file_path, encryption_key)
+        assert anonymizer.get_topic_id(1) == 101
+
+        with open(file_path + ".1", "wb") as file:
+            file.write(b"corrupted")
+
+        with pytest.raises(CouldNotDecrypt):
+            await Anonymizer.from_file(file_path, encryption_key)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage", ["file", "sqlite", "paged"])
+async def test_mapping_store_migrates_and_persists(storage: str):
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin")
+        key = Fernet.generate_key()
+
+        anonymizer = await Anonymizer.from_file(file_path, key)
+        for chat_id in range(1, 11):
+            await anonymizer.register_chat_topic_link(chat_id, chat_id + 100)
+        await anonymizer.close()
+
+        store = await open_mapping_store(file_path, key, storage=storage)
+        assert len(store) == 10
+        assert await store.find_topic_id(5) == 105
+        assert await store.find_chat_id(105) == 5
+        assert await store.find_topic_id(11) is None
+
+        # Chat gets a new topic, others are added
+        await store.register_chat_topic_link(5, 205)
+        await store.register_chat_topic_link(11, 111)
+        await store.close()
+
+        # Mappings are not migrated again
+        store = await open_mapping_store(file_path, key, storage=storage)
+        assert len(store) == 11
+        assert await store.find_topic_id(5) == 205
+        assert await store.find_chat_id(205) == 5
+        assert await store.find_chat_id(111) == 11
+
+        expected = [(idx, idx + 100) for idx in range(1, 12)]
+        expected[4] = (5, 205)
+        chats, topics = await store.columns()
+        assert sorted(zip(chats, topics)) == expected
+        await store.close()
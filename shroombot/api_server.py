@@ -2,17 +2,23 @@
 Serving of the API
 """
 
+import hmac
 import logging
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from typing import Any
 from uuid import uuid4
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Request
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from prometheus_client import Counter
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 
+from shroombot.loop_monitor import LOOP_MONITOR
+from shroombot.profiling import Profiler, ProfilerBusy
+
 logger = logging.getLogger(__name__)
 
 
@@ -28,7 +34,95 @@ INSTANCE_ID = str(uuid4())[:8]
 RESULT_COUNTER.labels(INSTANCE_ID).reset()
 
 
-def make_app(root_path: str):
+def debug_authorization(debug_token: str) -> Callable[[str], None]:
+    """
+    Dependency that rejects requests without the debug token
+    """
+
+    def _authorized(authorization: str = Header("")):
+        expected = f"Bearer {debug_token}".encode()
+        if not hmac.compare_digest(authorization.encode(), expected):
+            raise HTTPException(401, "Invalid debug token")
+
+    return _authorized
+
+
+def make_profiling_router(debug_token: str) -> APIRouter:
+    """
+    Profiling of the live process, requests must carry the debug token
+    """
+    router = APIRouter(
+        prefix="/debug/profile",
+        dependencies=[Depends(debug_authorization(debug_token))],
+        include_in_schema=False,
+    )
+    profiler = Profiler()
+
+    @router.get("/cpu", response_class=PlainTextResponse)
+    async def cpu(seconds: float = 10.0, mode: str = "collapsed") -> str:
+        """
+        Collapsed stacks of sampled profile or pstats of deterministic profile
+        """
+        try:
+            if mode == "collapsed":
+                return await profiler.cpu_sampled(seconds)
+            if mode == "pstats":
+                return await profiler.cpu_deterministic(seconds)
+        except ProfilerBusy as exc:
+            raise HTTPException(409, str(exc)) from exc
+        raise HTTPException(400, f"Unknown mode {mode}")
+
+    @router.post("/memory/start")
+    async def memory_start(nframes: int = 10) -> str:
+        profiler.memory_start(nframes)
+        return "OK"
+
+    @router.post("/memory/stop")
+    async def memory_stop() -> str:
+        profiler.memory_stop()
+        return "OK"
+
+    @router.get("/memory/top")
+    async def memory_top(limit: int = 20) -> list[str]:
+        try:
+            return await profiler.memory_top(limit)
+        except RuntimeError as exc:
+            raise HTTPException(409, str(exc)) from exc
+
+    @router.get("/memory/diff")
+    async def memory_diff(limit: int = 20) -> list[str]:
+        """
+        Growth since the last top, the first diff only takes the baseline
+        """
+        try:
+            return await profiler.memory_diff(limit)
+        except RuntimeError as exc:
+            raise HTTPException(409, str(exc)) from exc
+
+    return router
+
+
+def make_loop_monitor_router(debug_token: str) -> APIRouter:
+    """
+    Callbacks that blocked the event loop, requests must carry the debug token
+    """
+    router = APIRouter(
+        prefix="/debug",
+        dependencies=[Depends(debug_authorization(debug_token))],
+        include_in_schema=False,
+    )
+
+    @router.get("/slow-callbacks")
+    async def slow_callbacks(limit: int = 10) -> list[dict]:
+        """
+        Stacks of the code that blocked the event loop the longest
+        """
+        return [item.as_dict() for item in LOOP_MONITOR.worst(limit)]
+
+    return router
+
+
+def make_app(root_path: str, debug_token: str = ""):
     app = FastAPI(root_path=root_path)
 
     app.add_middleware(
@@ -53,12 +147,24 @@ def make_app(root_path: str):
         ],
         skip_paths=[
             f"{root_path}{path}"
-            for path in ["/health", "/metrics", "/", "/docs", "/openapi.json"]
+            for path in [
+                "/health",
+                "/metrics",
+                "/",
+                "/docs",
+                "/openapi.json",
+                "/debug/slow-callbacks",
+            ]
         ],
     )
 
     app.add_route("/metrics", handle_metrics)
 
+    # Debug endpoints are off unless a token is configured
+    if debug_token:
+        app.include_router(make_profiling_router(debug_token))
+        app.include_router(make_loop_monitor_router(debug_token))
+
     # Health check endpoint
     @app.get("/health", include_in_schema=False)
     async def health() -> str:
@@ -102,14 +208,25 @@ def make_app(root_path: str):
     return app
 
 
-async def run_api_server(bind: str, root_path: str):
-    host, port = bind.split(":")
+class _Server(uvicorn.Server):
+    """
+    Signals are handled by the lifecycle of the application
+    """
+
+    @contextmanager
+    def capture_signals(self) -> Iterator[None]:
+        yield
+
 
-    port = int(port)
+def make_api_server(bind: str, root_path: str, debug_token: str = "") -> uvicorn.Server:
+    host, port = bind.split(":")
 
-    app = make_app(root_path)
-    config = uvicorn.Config(app, host, port, log_config=None, access_log=False)
-    api_server = uvicorn.Server(config)
+    app = make_app(root_path, debug_token)
+    config = uvicorn.Config(app, host, int(port), log_config=None, access_log=False)
     logging.info("Serving on http://%s:%s", host, port)
 
-    await api_server.serve()
+    return _Server(config)
+
+
+async def run_api_server(bind: str, root_path: str):
+    await make_api_server(bind, root_path).serve()
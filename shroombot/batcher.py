@@ -0,0 +1,186 @@
+"""
+Aggregation of messages that arrive together
+
+Parts of a media album (and optionally consecutive text messages)
+are collected for a short window and processed as a single batch,
+so that they are mirrored with one send instead of one per message.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from shroombot.server import MyMessageType, MyTextMessage, merge_text_messages
+
+# Album group of merged text messages
+TEXT_GROUP = 0
+
+
+@dataclass
+class _Batch:
+    group: int
+    messages: list[MyMessageType] = field(default_factory=list)
+    message_ids: list[int] | None = field(default_factory=list)
+    # Message the first message of the batch replies to
+    reply_to: int | None = None
+    timer: asyncio.Task | None = None
+
+
+@dataclass
+class _KeyLock:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Number of tasks holding or waiting for the lock
+    users: int = 0
+
+
+@dataclass
+class MessageBatcher:
+    """
+    Collects messages per chat and thread and submits them in batches.
+
+    Order of messages of a chat is preserved: a message that can not be added
+    to the pending batch flushes it first. Submits of a chat and thread
+    are serialized, a slow submit does not hold up other chats
+    """
+
+    # Called with chat id, thread id, messages of the batch, their ids
+    # and id of the message the batch replies to
+    submit: Callable[
+        [int, int, list[MyMessageType], list[int] | None, int | None],
+        Awaitable[None],
+    ]
+    # Seconds to wait for the rest of the batch
+    window: float = 0.5
+    # Whether consecutive text messages are merged into one
+    merge_text: bool = False
+    # Telegram albums hold at most 10 messages
+    max_batch: int = 10
+    # Telegram limit of a text message length
+    max_text_length: int = 4096
+
+    batches: dict[tuple[int, int], _Batch] = field(default_factory=dict)
+    locks: dict[tuple[int, int], _KeyLock] = field(default_factory=dict)
+
+    async def add(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        thread_id: int,
+        message: MyMessageType,
+        album_id: int = 0,
+        message_id: int | None = None,
+        reply_to: int | None = None,
+    ):
+        async with self._locked((chat_id, thread_id)):
+            await self._add(chat_id, thread_id, message, album_id, message_id, reply_to)
+
+    @asynccontextmanager
+    async def _locked(self, key: tuple[int, int]) -> AsyncIterator[None]:
+        key_lock = self.locks.get(key)
+        if key_lock is None:
+            key_lock = self.locks[key] = _KeyLock()
+
+        key_lock.users += 1
+        try:
+            async with key_lock.lock:
+                yield
+        finally:
+            key_lock.users -= 1
+            if not key_lock.users:
+                del self.locks[key]
+
+    async def _add(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        thread_id: int,
+        message: MyMessageType,
+        album_id: int,
+        message_id: int | None,
+        reply_to: int | None,
+    ):
+        key = (chat_id, thread_id)
+
+        group = None
+        if album_id:
+            group = album_id
+        elif self.merge_text and isinstance(message, MyTextMessage):
+            group = TEXT_GROUP
+
+        batch = self.batches.get(key)
+        if batch is not None and (
+            batch.group != group
+            or len(batch.messages) >= self.max_batch
+            or not self._fits_text(batch, message)
+        ):
+            await self._flush(key)
+            batch = None
+
+        if group is None:
+            await self.submit(
+                chat_id,
+                thread_id,
+                [message],
+                None if message_id is None else [message_id],
+                reply_to,
+            )
+            return
+
+        if batch is None:
+            batch = _Batch(group=group, reply_to=reply_to)
+            self.batches[key] = batch
+            batch.timer = asyncio.create_task(self._flush_later(key, batch))
+
+        batch.messages.append(message)
+        if batch.message_ids is not None:
+            if message_id is None:
+                batch.message_ids = None
+            else:
+                batch.message_ids.append(message_id)
+
+    def _fits_text(self, batch: _Batch, message: MyMessageType) -> bool:
+        if batch.group != TEXT_GROUP or not isinstance(message, MyTextMessage):
+            return True
+
+        length = sum(
+            len(item.text) + 1
+            for item in batch.messages
+            if isinstance(item, MyTextMessage)
+        )
+        return length + len(message.text) <= self.max_text_length
+
+    async def flush_all(self):
+        """
+        Submit all pending batches right away
+        """
+        for key in list(self.batches):
+            async with self._locked(key):
+                await self._flush(key)
+
+    async def _flush_later(self, key: tuple[int, int], batch: _Batch):
+        await asyncio.sleep(self.window)
+        async with self._locked(key):
+            if self.batches.get(key) is batch:
+                await self._flush(key)
+
+    async def _flush(self, key: tuple[int, int]):
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+
+        if batch.timer is not None and batch.timer is not asyncio.current_task():
+            batch.timer.cancel()
+
+        messages = batch.messages
+        message_ids = batch.message_ids
+        if batch.group == TEXT_GROUP and len(messages) > 1:
+            # Merged message has no single source, edits of the parts
+            # can not be mirrored, so it is not linked
+            message_ids = None
+            messages = [
+                merge_text_messages(
+                    [item for item in messages if isinstance(item, MyTextMessage)]
+                )
+            ]
+
+        chat_id, thread_id = key
+        await self.submit(chat_id, thread_id, messages, message_ids, batch.reply_to)
@@ -0,0 +1,143 @@
+"""
+Testing aggregation of albums and message bursts
+"""
+
+import asyncio
+
+import pytest
+from aiotdlib.api import TextEntity, TextEntityTypeBold
+
+from shroombot.batcher import MessageBatcher
+from shroombot.server import (
+    MyMessageType,
+    MyPhotoMessage,
+    MyTextMessage,
+    merge_text_messages,
+)
+
+
+@pytest.mark.asyncio
+async def test_batcher_album():
+    submitted: list[tuple[int, int, list[MyMessageType]]] = []
+
+    async def _submit(
+        chat_id: int,
+        thread_id: int,
+        messages: list[MyMessageType],
+        _message_ids: list[int] | None,
+        _reply_to: int | None,
+    ):
+        submitted.append((chat_id, thread_id, messages))
+
+    batcher = MessageBatcher(_submit, window=0.01)
+
+    photos = [MyPhotoMessage(id=str(idx), caption=None) for idx in range(3)]
+
+    for photo in photos:
+        await batcher.add(1, 0, photo, album_id=42)
+
+    assert not submitted
+
+    # Non-album message flushes the album first to keep the order
+    await batcher.add(1, 0, MyTextMessage("after"))
+
+    assert submitted == [(1, 0, photos), (1, 0, [MyTextMessage("after")])]
+
+    # Album is flushed after the window
+    await batcher.add(2, 0, photos[0], album_id=43)
+    await asyncio.sleep(0.05)
+
+    assert submitted[-1] == (2, 0, [photos[0]])
+    assert not batcher.batches
+
+
+@pytest.mark.asyncio
+async def test_batcher_slow_chat_does_not_block_others():
+    submitted: list[tuple[int, list[MyMessageType]]] = []
+    unblocked = asyncio.Event()
+
+    async def _submit(
+        chat_id: int,
+        _thread_id: int,
+        messages: list[MyMessageType],
+        _message_ids: list[int] | None,
+        _reply_to: int | None,
+    ):
+        if chat_id == 1:
+            await unblocked.wait()
+        submitted.append((chat_id, messages))
+
+    batcher = MessageBatcher(_submit, window=0.01)
+
+    slow = asyncio.create_task(batcher.add(1, 0, MyTextMessage("slow")))
+    later = asyncio.create_task(batcher.add(1, 0, MyTextMessage("later")))
+    await asyncio.sleep(0)
+
+    await asyncio.wait_for(batcher.add(2, 0, MyTextMessage("fast")), 1)
+    assert submitted == [(2, [MyTextMessage("fast")])]
+
+    # Messages of the slow chat keep their order
+    unblocked.set()
+    await asyncio.gather(slow, later)
+    assert submitted[1:] == [
+        (1, [MyTextMessage("slow")]),
+        (1, [MyTextMessage("later")]),
+    ]
+    assert not batcher.locks
+
+
+@pytest.mark.asyncio
+async def test_batcher_merge_text():
+    submitted: list[list[MyMessageType]] = []
+
+    async def _submit(
+        _chat_id: int,
+        _thread_id: int,
+        messages: list[MyMessageType],
+        _message_ids: list[int] | None,
+        _reply_to: int | None,
+    ):
+        submitted.append(messages)
+
+    batcher = MessageBatcher(_submit, window=10, merge_text=True)
+
+    await batcher.add(1, 0, MyTextMessage("hello"))
+    await batcher.add(1, 0, MyTextMessage("world"))
+    await batcher.flush_all()
+
+    assert submitted == [[MyTextMessage("hello\nworld")]]
+
+
+@pytest.mark.asyncio
+async def test_batcher_message_ids():
+    submitted: list[tuple[list[int] | None, int | None]] = []
+
+    async def _submit(
+        _chat_id: int,
+        _thread_id: int,
+        _messages: list[MyMessageType],
+        message_ids: list[int] | None,
+        reply_to: int | None,
+    ):
+        submitted.append((message_ids, reply_to))
+
+    batcher = MessageBatcher(_submit, window=10)
+
+    photo = MyPhotoMessage(id="1", caption=None)
+    await batcher.add(1, 0, photo, album_id=42, message_id=10, reply_to=5)
+    await batcher.add(1, 0, photo, album_id=42, message_id=11)
+    await batcher.add(1, 0, MyTextMessage("text"), message_id=12)
+
+    assert submitted == [([10, 11], 5), ([12], None)]
+
+
+def test_merge_text_messages():
+    bold = TextEntity(offset=0, length=2, type=TextEntityTypeBold())
+
+    merged = merge_text_messages(
+        [MyTextMessage("🍄", [bold]), MyTextMessage("ab", [bold])]
+    )
+
+    assert merged.text == "🍄\nab"
+    # Mushroom takes two utf-16 code units
+    assert [entity.offset for entity in merged.entities] == [0, 3]
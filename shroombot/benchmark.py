@@ -0,0 +1,252 @@
+"""
+Load generation and benchmark of the message processing hot path
+
+Drives process_incomming_message with synthetic traffic
+through a mock telegram api with injected latency.
+
+Other benchmarks are in their own modules (benchmark_index, benchmark_shards,
+benchmark_codec, benchmark_replay), so that running one does not import
+what the others need
+"""
+
+import asyncio
+import functools
+import os
+import random
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from tempfile import TemporaryDirectory
+
+from cryptography.fernet import Fernet
+from prometheus_client import REGISTRY
+
+from shroombot.anonymizer import Anonymizer
+from shroombot.dispatcher import Dispatcher
+from shroombot.server import (
+    MyMessageType,
+    MyTextMessage,
+    NameRandomizer,
+    ServerData,
+    TelegramApi,
+    conversation_key,
+    process_incomming_message,
+)
+
+
+def make_latency(mean: float, jitter: float = 0.5) -> Callable[[], float]:
+    """
+    Latency distribution uniform around the mean, jitter is relative to the mean
+    """
+
+    def _latency() -> float:
+        return max(0.0, random.uniform(mean * (1 - jitter), mean * (1 + jitter)))
+
+    return _latency
+
+
+class LatencyTelegramApi(TelegramApi):
+    """
+    Telegram api that only waits for the simulated round-trip,
+    calls fail with the given probability
+    """
+
+    def __init__(self, latency: Callable[[], float], error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.num_topics = 0
+        self.num_calls = 0
+
+    async def _round_trip(self):
+        self.num_calls += 1
+        await asyncio.sleep(self.latency())
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError("Injected telegram error")
+
+    async def send_message(
+        self, chat_id: int, message: MyMessageType, reply_to: int | None = None
+    ) -> int | None:
+        await self._round_trip()
+        return self.num_calls
+
+    async def send_topic_message(
+        self,
+        chat_id: int,
+        topic_id: int,
+        message: MyMessageType,
+        reply_to: int | None = None,
+    ) -> int | None:
+        await self._round_trip()
+        return self.num_calls
+
+    async def edit_message(self, chat_id: int, message_id: int, message: MyMessageType):
+        await self._round_trip()
+
+    async def create_topic(self, chat_id: int, title: str) -> int:
+        await self._round_trip()
+        self.num_topics += 1
+        return self.num_topics
+
+
+class CountingRandomizer(NameRandomizer):
+    def __init__(self):
+        self.count = 0
+
+    def get_random_topic_name(self) -> str:
+        self.count += 1
+        return f"Topic {self.count}"
+
+
+def percentile(values: list[float], value: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * value))]
+
+
+@dataclass
+class BenchmarkConfig:
+    # Users that already have a topic before the benchmark starts
+    num_users: int = 1000
+    num_messages: int = 10000
+    # Probability that a user message comes from a new user
+    new_user_ratio: float = 0.1
+    # Probability that a message is an admin reply to one of the users
+    admin_reply_rate: float = 0.3
+    # Mean latency of a telegram round-trip in seconds
+    latency: float = 0.01
+    # Process messages through the dispatcher or one by one
+    concurrent: bool = True
+    seed: int = 0
+
+
+@dataclass
+class BenchmarkReport:
+    num_messages: int
+    elapsed: float
+    latencies: list[float] = field(repr=False)
+    # Journal writes of the registrations and time spent in them
+    persistence_calls: int
+    persistence_time: float
+    telegram_calls: int
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.num_messages / self.elapsed
+
+    def percentile(self, value: float) -> float:
+        return percentile(self.latencies, value)
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                f"messages:          {self.num_messages}",
+                f"elapsed:           {self.elapsed:.3f}s",
+                f"throughput:        {self.messages_per_second:.1f} msg/s",
+                f"latency p50:       {self.percentile(0.5) * 1000:.2f}ms",
+                f"latency p99:       {self.percentile(0.99) * 1000:.2f}ms",
+                f"telegram calls:    {self.telegram_calls}",
+                f"persistence calls: {self.persistence_calls}",
+                f"persistence time:  {self.persistence_time:.3f}s",
+            ]
+        )
+
+
+def generate_traffic(
+    config: BenchmarkConfig, admin_chat_id: int
+) -> list[tuple[int, int]]:
+    """
+    Generate (chat id, thread id) pairs of incomming messages.
+
+    Existing users have chat and topic ids from 1 to num_users,
+    new users get chat ids above that
+    """
+    rnd = random.Random(config.seed)
+
+    traffic: list[tuple[int, int]] = []
+    num_new = 0
+
+    for _ in range(config.num_messages):
+        if config.num_users and rnd.random() < config.admin_reply_rate:
+            traffic.append((admin_chat_id, rnd.randint(1, config.num_users)))
+        elif not config.num_users or rnd.random() < config.new_user_ratio:
+            num_new += 1
+            traffic.append((config.num_users + num_new, 0))
+        else:
+            traffic.append((rnd.randint(1, config.num_users), 0))
+
+    return traffic
+
+
+def _journal_writes() -> tuple[float, float]:
+    """
+    Number of journal writes and seconds spent in them so far
+    """
+    count = REGISTRY.get_sample_value("shroombot_journal_write_seconds_count")
+    total = REGISTRY.get_sample_value("shroombot_journal_write_seconds_sum")
+    return count or 0.0, total or 0.0
+
+
+async def run_benchmark(  # pylint: disable=too-many-locals
+    config: BenchmarkConfig,
+) -> BenchmarkReport:
+    admin_chat_id = -1
+
+    traffic = generate_traffic(config, admin_chat_id)
+    random.seed(config.seed)
+
+    with TemporaryDirectory() as temp_dir:
+        anonymizer = await Anonymizer.from_file(
+            os.path.join(temp_dir, "mapping.bin"), Fernet.generate_key()
+        )
+
+        for user_id in range(1, config.num_users + 1):
+            await anonymizer.register_chat_topic_link(user_id, user_id, wait=False)
+        await anonymizer.close()
+
+        telegram = LatencyTelegramApi(make_latency(config.latency))
+        telegram.num_topics = config.num_users
+        data = ServerData(
+            telegram=telegram,
+            anonymizer=anonymizer,
+            randomizer=CountingRandomizer(),
+            admin_chat_id=admin_chat_id,
+        )
+
+        latencies: list[float] = []
+
+        async def _handle(chat_id: int, thread_id: int, submitted: float):
+            await process_incomming_message(
+                data, chat_id, thread_id, MyTextMessage("Benchmark message")
+            )
+            latencies.append(time.perf_counter() - submitted)
+
+        dispatcher = Dispatcher()
+
+        # Only journal writes count, not setup or waiting for the group commit
+        writes_before = _journal_writes()
+        started = time.perf_counter()
+
+        for chat_id, thread_id in traffic:
+            job = functools.partial(_handle, chat_id, thread_id, time.perf_counter())
+            if config.concurrent:
+                await dispatcher.submit(conversation_key(data, chat_id, thread_id), job)
+            else:
+                await job()
+
+        await dispatcher.join()
+
+        elapsed = time.perf_counter() - started
+
+        await anonymizer.close()
+
+        writes_after = _journal_writes()
+
+    return BenchmarkReport(
+        num_messages=len(latencies),
+        elapsed=elapsed,
+        latencies=latencies,
+        persistence_calls=int(writes_after[0] - writes_before[0]),
+        persistence_time=writes_after[1] - writes_before[1],
+        telegram_calls=telegram.num_calls,
+    )
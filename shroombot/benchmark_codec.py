@@ -0,0 +1,123 @@
+"""
+Microbenchmarks of decoding and encoding of telegram messages
+"""
+
+import functools
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+
+def sample_contents() -> list[Any]:
+    """
+    Telegram message contents of every supported type
+    """
+    # pylint: disable=import-outside-toplevel
+    from aiotdlib import api
+
+    def _file(file_id: str) -> Any:
+        return api.File.construct(remote=api.RemoteFile.construct(id=file_id))
+
+    caption = api.FormattedText.construct(text="caption", entities=[])
+
+    return [
+        api.MessageText.construct(
+            text=api.FormattedText.construct(text="Hello", entities=[])
+        ),
+        api.MessagePhoto.construct(
+            photo=api.Photo.construct(
+                sizes=[
+                    api.PhotoSize.construct(photo=_file("thumb"), width=90, height=60),
+                    api.PhotoSize.construct(
+                        photo=_file("photo"), width=1280, height=853
+                    ),
+                ]
+            ),
+            caption=caption,
+        ),
+        api.MessageDocument.construct(
+            document=api.Document.construct(document=_file("document")),
+            caption=caption,
+        ),
+        api.MessageSticker.construct(
+            sticker=api.Sticker.construct(
+                sticker=_file("sticker"), emoji="🍄", width=512, height=512
+            )
+        ),
+        api.MessageVideo.construct(
+            video=api.Video.construct(
+                video=_file("video"), width=640, height=480, duration=10
+            ),
+            caption=caption,
+        ),
+        api.MessageAnimation.construct(
+            animation=api.Animation.construct(
+                animation=_file("animation"), width=320, height=240, duration=3
+            ),
+            caption=caption,
+        ),
+        api.MessageVoiceNote.construct(
+            voice_note=api.VoiceNote.construct(
+                voice=_file("voice"), duration=5, waveform=b"wave"
+            ),
+            caption=caption,
+        ),
+        api.MessageLocation.construct(
+            location=api.Location.construct(latitude=59.9, longitude=30.3)
+        ),
+        api.MessageContact.construct(
+            contact=api.Contact.construct(
+                phone_number="+10000000000",
+                first_name="Shroom",
+                last_name="",
+                vcard="",
+            )
+        ),
+    ]
+
+
+@dataclass
+class CodecBenchmarkReport:
+    # Content type -> seconds per call
+    decode: dict[str, float]
+    encode: dict[str, float]
+
+    def format(self) -> str:
+        return "\n".join(
+            f"{name:<18} decode {self.decode[name] * 1e9:8.0f}ns"
+            f"  encode {self.encode[name] * 1e9:8.0f}ns"
+            for name in self.decode
+        )
+
+
+def _per_call(func: Callable[[], object], num_iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(num_iterations):
+        func()
+    return (time.perf_counter() - started) / num_iterations
+
+
+def run_codec_benchmark(num_iterations: int = 10_000) -> CodecBenchmarkReport:
+    """
+    Time of decoding telegram contents and encoding messages back, per type
+    """
+    # pylint: disable=import-outside-toplevel
+    from shroombot.adapter import decode_content, encode_message
+
+    decode: dict[str, float] = {}
+    encode: dict[str, float] = {}
+
+    for content in sample_contents():
+        name = content.__class__.__name__
+        message = decode_content(content, 0, 0)
+        assert message is not None
+
+        decode[name] = _per_call(
+            functools.partial(decode_content, content, 0, 0), num_iterations
+        )
+        encode[name] = _per_call(
+            functools.partial(encode_message, message), num_iterations
+        )
+
+    return CodecBenchmarkReport(decode=decode, encode=encode)
@@ -0,0 +1,91 @@
+"""
+Benchmark of memory and lookup time of the mapping index
+compared with plain dicts
+"""
+
+import random
+import time
+import tracemalloc
+from array import array
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from shroombot.mapping_index import MappingIndex
+
+
+@dataclass
+class IndexBenchmarkReport:
+    num_mappings: int
+    dict_memory: int
+    index_memory: int
+    dict_lookup: float
+    index_lookup: float
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                f"mappings:          {self.num_mappings}",
+                f"dict memory:       {self.dict_memory / 2**20:.1f}MiB",
+                f"index memory:      {self.index_memory / 2**20:.1f}MiB",
+                f"dict lookup:       {self.dict_lookup * 1e9:.0f}ns",
+                f"index lookup:      {self.index_lookup * 1e9:.0f}ns",
+            ]
+        )
+
+
+def _traced_memory(build: Callable[[], object]) -> tuple[object, int]:
+    tracemalloc.start()
+    try:
+        result = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def run_index_benchmark(  # pylint: disable=too-many-locals
+    num_mappings: int = 1_000_000, num_lookups: int = 100_000, seed: int = 0
+) -> IndexBenchmarkReport:
+    """
+    Compare memory and lookup time of MappingIndex with a pair of dicts
+    """
+    rnd = random.Random(seed)
+
+    # Chat ids of telegram users are large and sparse, topic ids grow
+    chat_ids = rnd.sample(range(10**9, 10**10), num_mappings)
+    chats = array("q", sorted(chat_ids))
+    topics = array("q", range(2, num_mappings + 2))
+
+    def _build_dicts():
+        return (
+            dict(zip(chats, topics)),
+            dict(zip(topics, chats)),
+        )
+
+    dicts, dict_memory = _traced_memory(_build_dicts)
+    index, index_memory = _traced_memory(
+        lambda: MappingIndex.from_columns(array("q", chats), array("q", topics))
+    )
+
+    assert isinstance(dicts, tuple) and isinstance(index, MappingIndex)
+    chat_x_topic, topic_x_chat = dicts
+
+    lookups = [rnd.choice(chat_ids) for _ in range(num_lookups)]
+
+    started = time.perf_counter()
+    for chat_id in lookups:
+        topic_x_chat.get(chat_x_topic.get(chat_id))
+    dict_lookup = (time.perf_counter() - started) / num_lookups
+
+    started = time.perf_counter()
+    for chat_id in lookups:
+        index.get_chat_id(index.get_topic_id(chat_id))  # type: ignore
+    index_lookup = (time.perf_counter() - started) / num_lookups
+
+    return IndexBenchmarkReport(
+        num_mappings=num_mappings,
+        dict_memory=dict_memory,
+        index_memory=index_memory,
+        dict_lookup=dict_lookup,
+        index_lookup=index_lookup,
+    )
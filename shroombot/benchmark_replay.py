@@ -0,0 +1,170 @@
+"""
+Replay of recorded traffic traces with injected latency and errors
+"""
+
+import asyncio
+import functools
+import os
+import random
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from tempfile import TemporaryDirectory
+
+from cryptography.fernet import Fernet
+
+from shroombot.anonymizer import Anonymizer
+from shroombot.benchmark import (
+    CountingRandomizer,
+    LatencyTelegramApi,
+    make_latency,
+    percentile,
+)
+from shroombot.dispatcher import Dispatcher
+from shroombot.server import (
+    MyAnimationMessage,
+    MyContactMessage,
+    MyDocumentMessage,
+    MyLocationMessage,
+    MyMessageType,
+    MyPhotoMessage,
+    MyStickerMessage,
+    MyTextMessage,
+    MyVideoMessage,
+    MyVoiceMessage,
+    ServerData,
+    conversation_key,
+    process_incomming_message,
+)
+from shroombot.trace import TraceEvent
+
+_SYNTHETIC: dict[str, Callable[[str], MyMessageType]] = {
+    "MyTextMessage": lambda text: MyTextMessage(text or "."),
+    "MyPhotoMessage": lambda text: MyPhotoMessage("replay", text or None, 1280, 853),
+    "MyStickerMessage": lambda text: MyStickerMessage("replay", "🍄", 512, 512),
+    "MyDocumentMessage": lambda text: MyDocumentMessage("replay", text or None),
+    "MyVideoMessage": lambda text: MyVideoMessage("replay", text or None, 1280, 720),
+    "MyAnimationMessage": lambda text: MyAnimationMessage("replay", text or None),
+    "MyVoiceMessage": lambda text: MyVoiceMessage("replay", text or None, 5),
+    "MyLocationMessage": lambda text: MyLocationMessage(55.75, 37.62),
+    "MyContactMessage": lambda text: MyContactMessage("+10000000000", "Replay"),
+}
+
+
+def synthetic_message(event: TraceEvent) -> MyMessageType:
+    """
+    Message of the recorded type and size, text for types without a stand-in
+    """
+    build = _SYNTHETIC.get(event.message_type, _SYNTHETIC["MyTextMessage"])
+    return build("x" * event.size)
+
+
+@dataclass
+class ReplayReport:
+    num_messages: int
+    num_errors: int
+    elapsed: float
+    # Time from the recorded arrival to the end of processing
+    latencies: list[float] = field(repr=False)
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.num_messages / self.elapsed
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                f"messages:          {self.num_messages}",
+                f"errors:            {self.num_errors}",
+                f"elapsed:           {self.elapsed:.3f}s",
+                f"throughput:        {self.messages_per_second:.1f} msg/s",
+                f"latency p50:       {percentile(self.latencies, 0.5) * 1000:.2f}ms",
+                f"latency p99:       {percentile(self.latencies, 0.99) * 1000:.2f}ms",
+                f"latency p999:      {percentile(self.latencies, 0.999) * 1000:.2f}ms",
+            ]
+        )
+
+
+async def run_replay(  # pylint: disable=too-many-arguments,too-many-locals
+    events: list[TraceEvent],
+    speed: float = 1.0,
+    latency: float = 0.01,
+    error_rate: float = 0.0,
+    seed: int = 0,
+) -> ReplayReport:
+    """
+    Process recorded traffic at its recorded pace multiplied by speed,
+    or as fast as possible when speed is 0.
+
+    Every conversation of the trace already has a topic
+    """
+    admin_chat_id = -1
+    random.seed(seed)
+
+    users = sorted({event.chat for event in events if event.chat})
+    threads = sorted({event.thread for event in events if event.thread})
+
+    with TemporaryDirectory() as temp_dir:
+        anonymizer = await Anonymizer.from_file(
+            os.path.join(temp_dir, "mapping.bin"), Fernet.generate_key()
+        )
+
+        for topic_id, chat_id in enumerate(users, start=1):
+            await anonymizer.register_chat_topic_link(chat_id, topic_id, wait=False)
+        # Users of the topics admins answered in are not linked to the trace
+        for idx, topic_id in enumerate(threads):
+            await anonymizer.register_chat_topic_link(-2 - idx, topic_id, wait=False)
+
+        telegram = LatencyTelegramApi(make_latency(latency), error_rate)
+        telegram.num_topics = len(users)
+        data = ServerData(
+            telegram=telegram,
+            anonymizer=anonymizer,
+            randomizer=CountingRandomizer(),
+            admin_chat_id=admin_chat_id,
+        )
+
+        latencies: list[float] = []
+        num_errors = 0
+
+        async def _handle(event: TraceEvent, arrival: float):
+            nonlocal num_errors
+            chat_id = event.chat or admin_chat_id
+            try:
+                await process_incomming_message(
+                    data, chat_id, event.thread, synthetic_message(event)
+                )
+            except Exception:  # pylint: disable=broad-exception-caught
+                num_errors += 1
+                return
+            latencies.append(time.perf_counter() - arrival)
+
+        dispatcher = Dispatcher()
+
+        started = time.perf_counter()
+        first = events[0].offset if events else 0.0
+
+        for event in events:
+            arrival = time.perf_counter()
+            if speed > 0:
+                arrival = started + (event.offset - first) / speed
+                if arrival > time.perf_counter():
+                    await asyncio.sleep(arrival - time.perf_counter())
+
+            await dispatcher.submit(
+                conversation_key(data, event.chat or admin_chat_id, event.thread),
+                functools.partial(_handle, event, arrival),
+            )
+
+        await dispatcher.join()
+
+        elapsed = time.perf_counter() - started
+
+        await anonymizer.close()
+
+    return ReplayReport(
+        num_messages=len(events),
+        num_errors=num_errors,
+        elapsed=elapsed,
+        latencies=latencies,
+    )
@@ -0,0 +1,138 @@
+"""
+Benchmark of throughput of the sharded mode with different numbers of workers
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from tempfile import TemporaryDirectory
+from typing import Any
+
+from cryptography.fernet import Fernet
+
+from shroombot.benchmark import CountingRandomizer
+from shroombot.server import MyTextMessage
+from shroombot.sharding import ShardedFront, WorkerConfig
+from shroombot.telegram import EncodingTelegramApi, TelegramRequest
+
+
+class BusyTelegramApi(EncodingTelegramApi):
+    """
+    Telegram api that burns cpu time instead of waiting,
+    stand-in for tdlib serialization of a request
+    """
+
+    def __init__(self, cost: float):
+        self.cost = cost
+        self.num_topics = 0
+        self.num_calls = 0
+
+    async def execute(self, request: TelegramRequest) -> Any:
+        self.num_calls += 1
+        deadline = time.process_time() + self.cost
+        while time.process_time() < deadline:
+            pass
+
+        if request.returns == "topic_id":
+            self.num_topics += 1
+            return self.num_topics
+        if request.returns == "message_ids":
+            return []
+        return None
+
+
+@dataclass
+class ShardBenchmarkReport:
+    num_workers: int
+    num_messages: int
+    elapsed: float
+    # Calls executed by the front process for the workers
+    telegram_calls: int
+    # Cpu seconds spent by the front and by every worker
+    front_cpu: float
+    worker_cpu: list[float]
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.num_messages / self.elapsed
+
+    @property
+    def capacity(self) -> float:
+        """
+        Messages per second with a cpu for every process,
+        bound by the busiest process
+        """
+        return self.num_messages / max(self.front_cpu, *self.worker_cpu)
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                f"workers:           {self.num_workers}",
+                f"messages:          {self.num_messages}",
+                f"elapsed:           {self.elapsed:.3f}s",
+                f"throughput:        {self.messages_per_second:.1f} msg/s",
+                f"telegram calls:    {self.telegram_calls}",
+                f"front cpu:         {self.front_cpu:.3f}s",
+                "worker cpu:        "
+                + " ".join(f"{cpu:.3f}s" for cpu in self.worker_cpu),
+                f"capacity:          {self.capacity:.1f} msg/s",
+            ]
+        )
+
+
+async def run_shard_benchmark(  # pylint: disable=too-many-arguments
+    num_workers: int,
+    num_messages: int = 2000,
+    num_users: int = 100,
+    cost: float = 0.001,
+    context: str = "spawn",
+) -> ShardBenchmarkReport:
+    """
+    Throughput of the sharded mode.
+
+    Telegram requests of the workers go through the front process as in
+    production, cost is the cpu time the front spends on every request
+    (tdlib serialization). Workers do the rest of the work: spooling,
+    anonymization and encoding. Throughput depends on the number of cpus,
+    capacity is what it would be with a cpu for every process
+    """
+    telegram = BusyTelegramApi(cost)
+
+    with TemporaryDirectory() as temp_dir:
+        configs = [
+            WorkerConfig(
+                shard=shard,
+                num_shards=num_workers,
+                mapping_file=os.path.join(temp_dir, "mapping.bin"),
+                encryption_key=Fernet.generate_key(),
+                admin_chat_id=-1,
+                randomizer=CountingRandomizer,
+            )
+            for shard in range(num_workers)
+        ]
+
+        front = await ShardedFront.start(telegram, configs, context)
+        await front.start_processing()
+
+        started = time.perf_counter()
+        front_started = time.process_time()
+
+        for idx in range(num_messages):
+            await front.submit(
+                idx % num_users + 1, 0, [MyTextMessage("Benchmark message")]
+            )
+
+        # Workers finish queued messages before stopping
+        await front.close()
+
+        elapsed = time.perf_counter() - started
+        front_cpu = time.process_time() - front_started
+
+    return ShardBenchmarkReport(
+        num_workers=num_workers,
+        num_messages=num_messages,
+        elapsed=elapsed,
+        telegram_calls=telegram.num_calls,
+        front_cpu=front_cpu,
+        worker_cpu=[worker.cpu_time for worker in front.workers],
+    )
@@ -0,0 +1,43 @@
+"""
+Testing of the benchmark harness on a small workload
+"""
+
+import pytest
+
+from shroombot.benchmark import BenchmarkConfig, generate_traffic, run_benchmark
+from shroombot.benchmark_index import run_index_benchmark
+
+
+def test_generate_traffic():
+    config = BenchmarkConfig(num_users=10, num_messages=1000, admin_reply_rate=0.5)
+
+    traffic = generate_traffic(config, admin_chat_id=-1)
+
+    assert len(traffic) == 1000
+
+    admin = [thread_id for chat_id, thread_id in traffic if chat_id == -1]
+    assert 400 < len(admin) < 600
+    assert all(1 <= thread_id <= 10 for thread_id in admin)
+
+
+@pytest.mark.asyncio
+async def test_benchmark_concurrent_is_faster():
+    config = BenchmarkConfig(num_users=20, num_messages=200, latency=0.002)
+
+    concurrent = await run_benchmark(config)
+
+    config.concurrent = False
+    sequential = await run_benchmark(config)
+
+    assert concurrent.num_messages == sequential.num_messages == 200
+    # Registrations of concurrent messages are written together
+    assert 0 < concurrent.persistence_calls <= sequential.persistence_calls
+    assert concurrent.persistence_time > 0
+    assert concurrent.messages_per_second > sequential.messages_per_second
+    assert concurrent.percentile(0.5) <= concurrent.percentile(0.99)
+
+
+def test_index_benchmark_memory():
+    report = run_index_benchmark(num_mappings=50_000, num_lookups=1000)
+
+    assert report.index_memory * 3 < report.dict_memory
@@ -0,0 +1,106 @@
+"""
+Concurrent dispatch of incomming messages
+
+Jobs with the same key (same conversation) run one after another in order
+of submission, jobs with different keys run in parallel.
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+Job = Callable[[], Awaitable[None]]
+
+
+@dataclass
+class _KeyQueue:
+    queue: asyncio.Queue[Job]
+    worker: asyncio.Task | None = None
+    # Number of submitters waiting for a free slot in the queue
+    submitters: int = 0
+
+
+@dataclass
+class Dispatcher:
+    """
+    Runs jobs on a pool of asyncio workers keyed by conversation.
+
+    Submission blocks (backpressure) when either queue of the key
+    or the total number of pending jobs is full.
+    """
+
+    # Maximum number of queued jobs for a single key
+    max_key_pending: int = 100
+    # Maximum number of queued jobs overall
+    max_pending: int = 10000
+
+    queues: dict[Hashable, _KeyQueue] = field(default_factory=dict)
+    pending: asyncio.Semaphore = field(init=False)
+    idle: asyncio.Event = field(default_factory=asyncio.Event)
+    num_pending: int = 0
+
+    def __post_init__(self):
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.idle.set()
+
+    async def submit(self, key: Hashable, job: Job):
+        """
+        Queue job for execution after all jobs previously submitted with the same key
+        """
+        await self.pending.acquire()
+
+        key_queue = self.queues.get(key)
+        if key_queue is None:
+            key_queue = _KeyQueue(queue=asyncio.Queue(self.max_key_pending))
+            self.queues[key] = key_queue
+
+        self.num_pending += 1
+        self.idle.clear()
+
+        key_queue.submitters += 1
+        try:
+            await key_queue.queue.put(job)
+        except BaseException:
+            self._job_done()
+            raise
+        finally:
+            key_queue.submitters -= 1
+
+        if key_queue.worker is None:
+            key_queue.worker = asyncio.create_task(self._work(key, key_queue))
+
+    def queue_depth(self, key: Hashable) -> int:
+        key_queue = self.queues.get(key)
+        if key_queue is None:
+            return 0
+        return key_queue.queue.qsize()
+
+    async def join(self):
+        """
+        Wait until all submitted jobs are done
+        """
+        await self.idle.wait()
+
+    def _job_done(self):
+        self.num_pending -= 1
+        self.pending.release()
+        if self.num_pending == 0:
+            self.idle.set()
+
+    async def _work(self, key: Hashable, key_queue: _KeyQueue):
+        # Worker lives while its key has queued or incomming jobs
+        while not key_queue.queue.empty() or key_queue.submitters:
+            job = await key_queue.queue.get()
+            try:
+                await job()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.error("Dispatched job for %s failed", key)
+            finally:
+                self._job_done()
+
+        key_queue.worker = None
+        del self.queues[key]
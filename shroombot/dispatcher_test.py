@@ -0,0 +1,62 @@
+"""
+Testing ordering and concurrency of the dispatcher
+"""
+
+import asyncio
+
+import pytest
+
+from shroombot.dispatcher import Dispatcher
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_order_and_parallelism():
+    dispatcher = Dispatcher(max_key_pending=2, max_pending=4)
+
+    processed: dict[str, list[int]] = {"a": [], "b": []}
+    running = 0
+    max_running = 0
+
+    def make_job(key: str, idx: int):
+        async def _job():
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            processed[key].append(idx)
+            running -= 1
+
+        return _job
+
+    for idx in range(10):
+        await dispatcher.submit("a", make_job("a", idx))
+        await dispatcher.submit("b", make_job("b", idx))
+
+        # Backpressure keeps queues bounded
+        assert dispatcher.queue_depth("a") <= 2
+        assert dispatcher.num_pending <= 4
+
+    await dispatcher.join()
+
+    assert processed == {"a": list(range(10)), "b": list(range(10))}
+    assert max_running == 2
+    assert not dispatcher.queues
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_failed_job():
+    dispatcher = Dispatcher()
+
+    processed = []
+
+    async def _fail():
+        raise RuntimeError("Failed")
+
+    async def _ok():
+        processed.append(1)
+
+    await dispatcher.submit("a", _fail)
+    await dispatcher.submit("a", _ok)
+    await dispatcher.join()
+
+    assert processed == [1]
@@ -0,0 +1,57 @@
+"""
+Encryption keys of the persisted data and their rotation
+
+Several keys can be configured, newest first: data is encrypted
+with the newest key, and decrypted with any of them. Rotation re-encrypts
+persisted data with the newest key in small steps while the bot keeps working,
+once it finishes, older keys can be removed from the configuration
+"""
+
+import asyncio
+import functools
+import logging
+from collections.abc import Awaitable, Callable
+
+from cryptography.fernet import Fernet, MultiFernet
+
+logger = logging.getLogger(__name__)
+
+# One key or several keys, newest first
+EncryptionKey = bytes | tuple[bytes, ...]
+
+# Re-encrypts a bounded part of the data
+RotationStep = Callable[[], Awaitable[None]]
+
+
+def key_tuple(encryption_key: EncryptionKey) -> tuple[bytes, ...]:
+    if isinstance(encryption_key, bytes):
+        return (encryption_key,)
+    return encryption_key
+
+
+@functools.lru_cache(maxsize=16)
+def _cipher(keys: tuple[bytes, ...]) -> MultiFernet:
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def get_cipher(encryption_key: EncryptionKey) -> MultiFernet:
+    """
+    Cipher of the keys, built once per set of keys
+    """
+    return _cipher(key_tuple(encryption_key))
+
+
+async def rotate_keys(steps: list[RotationStep], stopped: asyncio.Event) -> bool:
+    """
+    Run rotation steps one by one until done or stopped,
+    returns whether all steps ran
+    """
+    for idx, step in enumerate(steps):
+        if stopped.is_set():
+            logger.info("Key rotation stopped after %d of %d steps", idx, len(steps))
+            return False
+
+        await step()
+
+    logger.info("Key rotation finished, data is encrypted with the newest key")
+    return True
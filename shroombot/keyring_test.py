@@ -0,0 +1,82 @@
+"""
+Testing of key rotation of the persisted data
+"""
+
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+from cryptography.fernet import Fernet
+
+from shroombot.anonymizer import Anonymizer, CouldNotDecrypt, existing_snapshots
+from shroombot.keyring import get_cipher, rotate_keys
+from shroombot.message_index import MessageIndex, MessageLink
+
+
+def test_cipher_cached():
+    old, new = Fernet.generate_key(), Fernet.generate_key()
+
+    assert get_cipher((new, old)) is get_cipher((new, old))
+    assert get_cipher(old) is get_cipher((old,))
+
+    token = get_cipher(old).encrypt(b"data")
+    assert get_cipher((new, old)).decrypt(token) == b"data"
+
+
+@pytest.mark.asyncio
+async def test_rotate_keys_online():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin")
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+
+        anonymizer = await Anonymizer.from_file(file_path, old, compact_every=2)
+        messages = await MessageIndex.from_file(
+            file_path + ".messages", old, segment_size=2
+        )
+        for idx in range(1, 6):
+            await anonymizer.register_chat_topic_link(idx, idx)
+            messages.add(MessageLink(idx, idx, idx, idx, False))
+            await messages.flush()
+        await anonymizer.close()
+        await messages.close()
+
+        anonymizer = await Anonymizer.from_file(file_path, (new, old))
+        messages = await MessageIndex.from_file(file_path + ".messages", (new, old))
+
+        steps = anonymizer.rotation_steps() + messages.rotation_steps()
+
+        # Registrations keep going during rotation
+        stopped = asyncio.Event()
+        rotation = asyncio.create_task(rotate_keys(steps, stopped))
+        for idx in range(6, 10):
+            await anonymizer.register_chat_topic_link(idx, idx)
+        assert await rotation
+
+        await anonymizer.close()
+        await messages.close()
+
+        # Old key is not needed anymore
+        anonymizer = await Anonymizer.from_file(file_path, new)
+        messages = await MessageIndex.from_file(file_path + ".messages", new)
+        assert [anonymizer.get_topic_id(idx) for idx in range(1, 10)] == list(
+            range(1, 10)
+        )
+        assert messages.admin_to_user(5) == MessageLink(5, 5, 5, 5, False)
+
+        for path in existing_snapshots(file_path):
+            with pytest.raises(CouldNotDecrypt):
+                await Anonymizer.from_file(path, old)
+
+
+@pytest.mark.asyncio
+async def test_rotation_stops_between_steps():
+    done = []
+
+    async def _step():
+        done.append(True)
+        stopped.set()
+
+    stopped = asyncio.Event()
+    assert not await rotate_keys([_step, _step], stopped)
+    assert len(done) == 1
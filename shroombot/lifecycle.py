@@ -0,0 +1,145 @@
+"""
+Lifecycle of the application: supervised services and graceful shutdown
+
+Services (api server, telegram client) run as tasks. Shutdown starts
+on SIGTERM or SIGINT, or when any service exits, and goes in stages:
+
+1. Intake is stopped, new messages are spooled for the next start
+2. In-flight work is drained, bounded by a deadline
+3. Persistence is flushed, always, even if draining timed out
+4. Services are stopped
+
+A second signal skips the rest of draining.
+"""
+
+import asyncio
+import logging
+import signal
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+Hook = Callable[[], Awaitable[None]]
+
+SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+@dataclass
+class Lifecycle:  # pylint: disable=too-many-instance-attributes
+    # Seconds to wait for in-flight work on shutdown
+    drain_timeout: float = 30.0
+    # Seconds to wait for cancelled services to finish
+    stop_timeout: float = 5.0
+
+    services: dict[str, Hook] = field(default_factory=dict)
+    intake_stops: list[Hook] = field(default_factory=list)
+    drains: list[Hook] = field(default_factory=list)
+    closers: list[Hook] = field(default_factory=list)
+
+    stopping: asyncio.Event = field(default_factory=asyncio.Event)
+    forced: asyncio.Event = field(default_factory=asyncio.Event)
+    # Whether any service failed
+    failed: bool = False
+
+    @property
+    def accepting(self) -> bool:
+        return not self.stopping.is_set()
+
+    def service(self, name: str, run: Hook):
+        """
+        Long running task, shutdown starts once it exits
+        """
+        self.services[name] = run
+
+    def on_stop_intake(self, hook: Hook):
+        self.intake_stops.append(hook)
+
+    def on_drain(self, hook: Hook):
+        """
+        Wait for in-flight work, hooks run in order within the drain deadline
+        """
+        self.drains.append(hook)
+
+    def on_close(self, hook: Hook):
+        """
+        Flush persistence, hooks run in order after draining
+        """
+        self.closers.append(hook)
+
+    def stop(self, reason: str = "requested"):
+        if self.stopping.is_set():
+            logger.warning("Stopping again (%s), skipping the rest of draining", reason)
+            self.forced.set()
+            return
+
+        logger.info("Stopping: %s", reason)
+        self.stopping.set()
+
+    async def run(self) -> int:
+        """
+        Run services until shutdown, returns exit code
+        """
+        loop = asyncio.get_running_loop()
+        for sig in SIGNALS:
+            loop.add_signal_handler(sig, self.stop, signal.Signals(sig).name)
+
+        tasks = {
+            asyncio.create_task(run(), name=name): name
+            for name, run in self.services.items()
+        }
+        for task in tasks:
+            task.add_done_callback(self._service_done)
+
+        try:
+            await self.stopping.wait()
+            await self._shutdown(tasks)
+        finally:
+            for sig in SIGNALS:
+                loop.remove_signal_handler(sig)
+
+        return 1 if self.failed else 0
+
+    def _service_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc is not None:
+            logger.error("Service %s failed", task.get_name(), exc_info=exc)
+            self.failed = True
+
+        if not self.stopping.is_set():
+            self.stop(f"service {task.get_name()} exited")
+
+    async def _shutdown(self, tasks: dict[asyncio.Task, str]):
+        await self._run_hooks("stop intake", self.intake_stops)
+
+        drain = asyncio.create_task(self._run_hooks("drain", self.drains))
+        forced = asyncio.create_task(self.forced.wait())
+        done, _ = await asyncio.wait(
+            [drain, forced],
+            timeout=self.drain_timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        forced.cancel()
+        if drain not in done:
+            logger.warning("In-flight work did not finish in time, dropping it")
+            drain.cancel()
+
+        await self._run_hooks("close", self.closers)
+
+        for task in tasks:
+            task.cancel()
+        _, pending = await asyncio.wait(tasks, timeout=self.stop_timeout)
+        for task in pending:
+            logger.warning("Service %s did not stop", tasks[task])
+
+        logger.info("Stopped")
+
+    async def _run_hooks(self, stage: str, hooks: list[Hook]):
+        for hook in hooks:
+            try:
+                await hook()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Shutdown stage %s failed", stage)
@@ -0,0 +1,71 @@
+"""
+Testing of the graceful shutdown
+"""
+
+import asyncio
+import os
+import signal
+
+import pytest
+
+from shroombot.lifecycle import Lifecycle
+
+
+@pytest.mark.asyncio
+async def test_lifecycle_sigterm():
+    lifecycle = Lifecycle(drain_timeout=1)
+    events: list[str] = []
+
+    async def _service():
+        try:
+            await asyncio.Event().wait()
+        finally:
+            events.append("service stopped")
+
+    async def _stop_intake():
+        events.append(f"intake stopped, accepting={lifecycle.accepting}")
+
+    async def _drain():
+        await asyncio.sleep(0.01)
+        events.append("drained")
+
+    async def _close():
+        events.append("closed")
+
+    lifecycle.service("service", _service)
+    lifecycle.on_stop_intake(_stop_intake)
+    lifecycle.on_drain(_drain)
+    lifecycle.on_close(_close)
+
+    asyncio.get_running_loop().call_later(0.01, os.kill, os.getpid(), signal.SIGTERM)
+
+    assert await lifecycle.run() == 0
+    assert events == [
+        "intake stopped, accepting=False",
+        "drained",
+        "closed",
+        "service stopped",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_lifecycle_drain_deadline_and_failure():
+    lifecycle = Lifecycle(drain_timeout=0.05)
+    closed = []
+
+    async def _failing():
+        raise RuntimeError("Service failed")
+
+    async def _stuck():
+        await asyncio.sleep(10)
+
+    async def _close():
+        closed.append(True)
+
+    lifecycle.service("failing", _failing)
+    lifecycle.on_drain(_stuck)
+    lifecycle.on_close(_close)
+
+    # Persistence is flushed even if work did not finish in time
+    assert await asyncio.wait_for(lifecycle.run(), 1) == 1
+    assert closed == [True]
@@ -0,0 +1,129 @@
+"""
+Monitor of the event loop lag and slow callbacks
+
+Bot, telegram client and api server share one event loop, so any blocking call
+stalls every user at once. The monitor wakes up at a fixed interval and records
+how late it woke up. A watchdog thread samples the stack of the loop thread
+when the loop did not wake up in time, so that the blocking code can be found
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+
+from shroombot.metrics import LOOP_LAG
+
+# Frames kept from the innermost one
+_STACK_DEPTH = 30
+
+
+@dataclass
+class SlowCallback:
+    stack: list[str]
+    count: int = 0
+    max_seconds: float = 0.0
+    total_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "max_seconds": round(self.max_seconds, 6),
+            "total_seconds": round(self.total_seconds, 6),
+            "stack": self.stack,
+        }
+
+
+@dataclass
+class LoopMonitor:  # pylint: disable=too-many-instance-attributes
+    # Seconds between wake ups
+    interval: float = 0.1
+    # Stalls longer than this are sampled
+    threshold: float = 0.1
+    # Number of distinct stacks kept
+    capacity: int = 100
+
+    offenders: dict[tuple, SlowCallback] = field(default_factory=dict, repr=False)
+    # When the monitor is expected to wake up next, monotonic
+    expected: float = 0.0
+    # Stack of the current stall, sampled by the watchdog
+    sampled: tuple[tuple, list[str]] | None = field(default=None, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    async def run(self):
+        """
+        Measure lag until cancelled
+        """
+        loop_thread = threading.get_ident()
+        stopped = threading.Event()
+        self.expected = time.monotonic() + self.interval
+
+        watchdog = threading.Thread(
+            target=self._watch,
+            args=(loop_thread, stopped),
+            name="loop-watchdog",
+            daemon=True,
+        )
+        watchdog.start()
+
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._woke_up(max(0.0, now - self.expected))
+                self.expected = now + self.interval
+        finally:
+            stopped.set()
+
+    def _woke_up(self, lag: float):
+        LOOP_LAG.observe(lag)
+
+        with self.lock:
+            sampled, self.sampled = self.sampled, None
+
+        if sampled is None or lag < self.threshold:
+            return
+
+        key, stack = sampled
+        offender = self.offenders.get(key)
+        if offender is None:
+            if len(self.offenders) >= self.capacity:
+                least = min(self.offenders, key=lambda k: self.offenders[k].max_seconds)
+                del self.offenders[least]
+            offender = self.offenders[key] = SlowCallback(stack)
+
+        offender.count += 1
+        offender.max_seconds = max(offender.max_seconds, lag)
+        offender.total_seconds += lag
+
+    def _watch(self, loop_thread: int, stopped: threading.Event):
+        sampled_for = 0.0
+        while not stopped.wait(self.threshold / 2):
+            expected = self.expected
+            if time.monotonic() - expected < self.threshold or sampled_for == expected:
+                continue
+
+            frame = sys._current_frames().get(  # pylint: disable=protected-access
+                loop_thread
+            )
+            if frame is None:
+                continue
+
+            frames = traceback.extract_stack(frame, limit=_STACK_DEPTH)
+            key = tuple((item.filename, item.lineno, item.name) for item in frames)
+            with self.lock:
+                self.sampled = (key, frames.format())
+            sampled_for = expected
+
+    def worst(self, num: int = 10) -> list[SlowCallback]:
+        """
+        Stacks of the longest stalls
+        """
+        return sorted(
+            self.offenders.values(), key=lambda item: item.max_seconds, reverse=True
+        )[:num]
+
+
+LOOP_MONITOR = LoopMonitor()
@@ -0,0 +1,53 @@
+"""
+Testing that the loop monitor catches blocking code
+"""
+
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+
+from shroombot.api_server import debug_authorization, make_app
+from shroombot.loop_monitor import LoopMonitor
+
+
+def _blocking_call():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_records_slow_callback():
+    before = REGISTRY.get_sample_value("shroombot_loop_lag_seconds_count") or 0
+
+    monitor = LoopMonitor(interval=0.01, threshold=0.1)
+    task = asyncio.create_task(monitor.run())
+
+    await asyncio.sleep(0.05)
+    _blocking_call()
+    await asyncio.sleep(0.05)
+
+    task.cancel()
+
+    (offender,) = monitor.worst()
+    assert offender.count == 1
+    assert offender.max_seconds >= 0.2
+    assert "_blocking_call" in offender.stack[-1]
+
+    after = REGISTRY.get_sample_value("shroombot_loop_lag_seconds_count")
+    assert after > before
+
+
+def test_slow_callbacks_need_debug_token():
+    def paths(app) -> set[str]:
+        return {route.path for route in app.routes}
+
+    assert "/debug/slow-callbacks" not in paths(make_app(""))
+    assert "/debug/slow-callbacks" in paths(make_app("", debug_token="secret"))
+
+    authorized = debug_authorization("secret")
+    authorized("Bearer secret")
+    with pytest.raises(HTTPException) as info:
+        authorized("Bearer wrong")
+    assert info.value.status_code == 401
@@ -11,17 +11,11 @@ Implementation of the application CLI and logging setup
 
 
 import logging
+from collections.abc import Awaitable, Callable
 from pathlib import Path
+from typing import Any, NamedTuple
 
 import typer
-from aiotdlib.api import MessageDocument, MessagePhoto, MessageSticker
-
-from shroombot.server import (
-    MyDocumentMessage,
-    MyPhotoMessage,
-    MyStickerMessage,
-    MyTextMessage,
-)
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +23,33 @@ logger = logging.getLogger(__name__)
 app = typer.Typer()
 
 
+class Pipeline(NamedTuple):
+    """
+    Message processing, in this process or in sharded workers
+    """
+
+    submit: Callable[..., Awaitable[None]]
+    # Record messages for processing after restart
+    hold: Callable[..., Awaitable[None]]
+    edit: Callable[..., Awaitable[None]]
+    # Record edits for processing after restart
+    hold_edit: Callable[..., Awaitable[None]]
+    # Record final id of a sent message
+    sent: Callable[..., Awaitable[None]]
+    # Wait for in-flight work
+    drain: Callable[[], Awaitable[None]]
+    # Flush persistence
+    close: Callable[[], Awaitable[None]]
+    # Re-encrypt persisted data with the newest key until done or stopped
+    rotate: Callable[[Any], Awaitable[None]]
+    # Process spooled messages, once telegram is connected
+    start: Callable[[], Awaitable[None]]
+    # Restart processes of the pipeline, runs as a service
+    supervise: Callable[[], Awaitable[None]] | None = None
+
+
 @app.command()
-def run(  # pylint: disable=too-many-locals
+def run(  # pylint: disable=too-many-locals,too-many-statements
     chat_mapping_file: str,
     files_dir: str,
     api_id: int = typer.Argument(..., envvar="API_ID"),
@@ -39,30 +58,60 @@ def run(  # pylint: disable=too-many-locals
     admin_chat: str = typer.Argument(..., envvar="ADMIN_CHAT"),
     bind: str = typer.Option(..., envvar="BOT_API_SERVER_BIND"),
     root_path: str = typer.Option("", envvar="BOT_API_ROOT_PATH"),
-    encryption_key: str = typer.Argument(..., envvar="ENCRYPTION_KEY"),
+    encryption_key: str = typer.Argument(
+        ...,
+        envvar="ENCRYPTION_KEY",
+        help="Base64 encoded key, or comma-separated keys newest first to rotate",
+    ),
     formatter: str = typer.Option("standard", envvar="LOG_FORMATTER"),
+    max_chat_pending: int = typer.Option(100, envvar="BOT_MAX_CHAT_PENDING"),
+    max_pending: int = typer.Option(10000, envvar="BOT_MAX_PENDING"),
+    batch_window: float = typer.Option(0.5, envvar="BOT_BATCH_WINDOW"),
+    merge_text: bool = typer.Option(False, envvar="BOT_MERGE_TEXT"),
+    message_index_size: int = typer.Option(100_000, envvar="BOT_MESSAGE_INDEX_SIZE"),
+    workers: int = typer.Option(
+        0, envvar="BOT_WORKERS", help="Worker processes, 0 processes in this one"
+    ),
+    drain_timeout: float = typer.Option(
+        20.0, envvar="BOT_DRAIN_TIMEOUT", help="Seconds to finish messages on stop"
+    ),
+    slow_callback: float = typer.Option(
+        0.1, envvar="BOT_SLOW_CALLBACK", help="Seconds of blocked loop to record"
+    ),
+    storage: str = typer.Option(
+        "file", envvar="BOT_STORAGE", help="Mapping storage: file, sqlite or paged"
+    ),
+    debug_token: str = typer.Option(
+        "", envvar="BOT_DEBUG_TOKEN", help="Enables profiling endpoints"
+    ),
+    trace_file: str = typer.Option(
+        "", envvar="BOT_TRACE_FILE", help="Record anonymized traffic trace to file"
+    ),
 ):
     import asyncio
     import base64
     import logging.config as logging_config
+    import time
 
     from aiotdlib.api import (
-        MessageForumTopicCreated,
-        MessageForumTopicIsHiddenToggled,
-        MessageText,
+        UpdateMessageContent,
+        UpdateMessageSendSucceeded,
         UpdateNewMessage,
     )
     from aiotdlib.api.api import API
     from aiotdlib.client import Client
 
-    from shroombot.anonymizer import Anonymizer
-    from shroombot.server import process_incomming_message
+    from shroombot.adapter import decode_content, is_ignored, reply_to_id
+    from shroombot.batcher import MessageBatcher
+    from shroombot.lifecycle import Lifecycle
+    from shroombot.loop_monitor import LOOP_MONITOR
+    from shroombot.metrics import ADMIN_TO_USER, MAPPINGS, STAGE_SECONDS, USER_TO_ADMIN
+    from shroombot.sharding import ShardedFront, WorkerConfig
     from shroombot.shroomgen import ShroomNameRandomizer, default_shroom_names
     from shroombot.telegram import LiveTelegramApi, get_chat_id
+    from shroombot.trace import TraceRecorder
 
-    from . import api_server, server
-
-    randomizer = ShroomNameRandomizer(default_shroom_names())
+    from . import api_server
 
     # Configure logging
     logging_config.dictConfig(_get_logging_config(logging.INFO, formatter))
@@ -75,77 +124,406 @@ def run(  # pylint: disable=too-many-locals
             files_directory=Path(files_dir),
         )
 
-        anonymizer = await Anonymizer.from_file(
-            chat_mapping_file, base64.b64decode(encryption_key)
-        )
+        keys = tuple(base64.b64decode(part) for part in encryption_key.split(","))
+        key = keys[0] if len(keys) == 1 else keys
+        admin_chat_id = -1002232979097
+        telegram = LiveTelegramApi(client)
+
+        if workers:
+            front = await ShardedFront.start(
+                telegram,
+                [
+                    WorkerConfig(
+                        shard=shard,
+                        num_shards=workers,
+                        mapping_file=chat_mapping_file,
+                        encryption_key=key,
+                        admin_chat_id=admin_chat_id,
+                        max_chat_pending=max_chat_pending,
+                        max_pending=max_pending,
+                        message_index_size=message_index_size,
+                        storage=storage,
+                    )
+                    for shard in range(workers)
+                ],
+            )
 
-        server_data = server.ServerData(
-            telegram=LiveTelegramApi(client),
-            anonymizer=anonymizer,
-            randomizer=randomizer,
-            admin_chat_id=-1002232979097,
+            # Workers flush persistence when stopped
+            pipeline = Pipeline(
+                front.submit,
+                front.hold,
+                front.edit,
+                front.hold_edit,
+                front.sent,
+                front.drain,
+                front.close,
+                front.rotate,
+                front.start_processing,
+                front.supervise,
+            )
+
+            MAPPINGS.set_function(lambda: len(front.topic_shards))
+        else:
+            # Topic names are not repeated, also after restart
+            randomizer = ShroomNameRandomizer.from_file(
+                chat_mapping_file + ".names", default_shroom_names()
+            )
+            pipeline = await _local_pipeline(
+                chat_mapping_file,
+                key,
+                telegram,
+                randomizer,
+                admin_chat_id,
+                max_chat_pending,
+                max_pending,
+                message_index_size,
+                storage,
+            )
+
+        batcher = MessageBatcher(
+            pipeline.submit, window=batch_window, merge_text=merge_text
         )
 
+        lifecycle = Lifecycle(drain_timeout=drain_timeout)
+
+        recorder = TraceRecorder(trace_file, admin_chat_id) if trace_file else None
+
         async def message_handler(_, update: UpdateNewMessage):
             message = update.message
 
-            content = message.content
-
-            if isinstance(content, MessageText):
-                content = MyTextMessage(
-                    text=content.text.text,
-                    entities=content.text.entities,
-                )
-            elif isinstance(content, MessageForumTopicIsHiddenToggled):
+            # Service messages are dropped before any work is done
+            if is_ignored(message.content):
                 return
-            elif isinstance(content, MessageForumTopicCreated):
+
+            started = time.perf_counter()
+
+            content = decode_content(
+                message.content, message.chat_id, message.message_thread_id
+            )
+            if content is None:
                 return
-            elif isinstance(content, MessageDocument):
-                content = MyDocumentMessage(
-                    id=content.document.document.remote.id,
-                    caption=content.caption.text,
-                )
-            elif isinstance(content, MessagePhoto):
-                content = MyPhotoMessage(
-                    id=content.photo.sizes[0].photo.remote.id,
-                    caption=content.caption.text,
-                )
-            elif isinstance(content, MessageSticker):
-                content = MyStickerMessage(
-                    id=content.sticker.sticker.remote.id,
-                    emoji=content.sticker.emoji,
+
+            STAGE_SECONDS.labels(
+                "decode",
+                content.__class__.__name__,
+                ADMIN_TO_USER if message.chat_id == admin_chat_id else USER_TO_ADMIN,
+            ).observe(time.perf_counter() - started)
+
+            if recorder is not None:
+                recorder.record(message.chat_id, message.message_thread_id, content)
+
+            if not lifecycle.accepting:
+                logger.info(
+                    "Message %d of chat %d arrived during shutdown, spooled",
+                    message.id,
+                    message.chat_id,
                 )
-            else:
-                logger.warning(
-                    "Encountered unsupported message type %s. Chat %d thread %d",
-                    content.__class__.__name__,
+                await pipeline.hold(
                     message.chat_id,
                     message.message_thread_id,
+                    [content],
+                    [message.id],
+                    reply_to_id(message),
                 )
-                content = MyTextMessage(
-                    f"<unsupported type {content.__class__.__name__}>",
-                )
+                return
 
-            await process_incomming_message(
-                server_data,
+            await batcher.add(
                 message.chat_id,
                 message.message_thread_id,
                 content,
+                message.media_album_id,
+                message.id,
+                reply_to_id(message),
+            )
+
+        async def edit_handler(_, update: UpdateMessageContent):
+            content = decode_content(update.new_content, update.chat_id, 0)
+            if content is None:
+                return
+
+            # Telegram does not deliver the update again
+            if not lifecycle.accepting:
+                await pipeline.hold_edit(update.chat_id, update.message_id, content)
+                return
+
+            await pipeline.edit(update.chat_id, update.message_id, content)
+
+        # Sends that are still in flight during shutdown get confirmed too
+        async def send_succeeded_handler(_, update: UpdateMessageSendSucceeded):
+            await pipeline.sent(
+                update.message.chat_id, update.old_message_id, update.message.id
             )
 
         client.add_event_handler(message_handler, API.Types.UPDATE_NEW_MESSAGE)
+        client.add_event_handler(edit_handler, API.Types.UPDATE_MESSAGE_CONTENT)
+        client.add_event_handler(
+            send_succeeded_handler, API.Types.UPDATE_MESSAGE_SEND_SUCCEEDED
+        )
+
+        async def run_client():
+            async with client:
+                # Check that chat id matches
+                assert (
+                    await get_chat_id(client, admin_chat) == admin_chat_id
+                ), admin_chat
+
+                # Spooled messages would fail before the client is started
+                if lifecycle.accepting:
+                    await pipeline.start()
+
+                # Client stays connected until in-flight sends are done
+                await asyncio.Event().wait()
+
+        api = api_server.make_api_server(bind, root_path, debug_token)
+
+        async def stop_api():
+            api.should_exit = True
+
+        lifecycle.service("telegram", run_client)
+        lifecycle.service("api", api.serve)
+
+        LOOP_MONITOR.threshold = slow_callback
+        lifecycle.service("loop monitor", LOOP_MONITOR.run)
+        if pipeline.supervise is not None:
+            lifecycle.service("workers", pipeline.supervise)
+
+        lifecycle.on_stop_intake(stop_api)
+
+        if len(keys) > 1:
+            rotation_stopped = asyncio.Event()
+            rotation = asyncio.create_task(pipeline.rotate(rotation_stopped))
+
+            # Finish the current step, rotation starts over on the next run
+            async def stop_rotation():
+                rotation_stopped.set()
+                await rotation
+
+            lifecycle.on_drain(stop_rotation)
+
+        lifecycle.on_drain(batcher.flush_all)
+        lifecycle.on_drain(pipeline.drain)
+        # Do not lose registrations that are not written yet
+        lifecycle.on_close(pipeline.close)
+
+        if recorder is not None:
+
+            async def close_recorder():
+                recorder.close()
+
+            lifecycle.on_close(close_recorder)
+
+        return await lifecycle.run()
 
-        async with client:
-            # Check that chat id matches
-            admin_chat_id = await get_chat_id(client, admin_chat)
-            assert admin_chat_id == server_data.admin_chat_id, admin_chat
+    raise typer.Exit(asyncio.run(_entry()))
 
-            await api_server.run_api_server(bind, root_path)
 
-            while True:
-                await asyncio.sleep(1)
+async def _local_pipeline(  # pylint: disable=too-many-arguments,too-many-locals
+    chat_mapping_file: str,
+    key: bytes | tuple[bytes, ...],
+    telegram,
+    randomizer,
+    admin_chat_id: int,
+    max_chat_pending: int,
+    max_pending: int,
+    message_index_size: int,
+    storage: str,
+) -> "Pipeline":
+    """
+    Processing of messages in this process
+    """
+    import functools
+
+    from shroombot.anonymizer import open_mapping_store
+    from shroombot.dispatcher import Dispatcher
+    from shroombot.keyring import rotate_keys
+    from shroombot.message_index import MessageIndex
+    from shroombot.metrics import DISPATCH_QUEUE_DEPTH, MAPPINGS, SPOOL_PENDING
+    from shroombot.server import (
+        ServerData,
+        conversation_key,
+        edit_thread_id,
+        process_edited_message,
+        record_sent_message_id,
+    )
+    from shroombot.spool import open_spool
+
+    anonymizer = await open_mapping_store(chat_mapping_file, key, storage)
+    messages_index = await MessageIndex.from_file(
+        chat_mapping_file + ".messages", key, capacity=message_index_size
+    )
+
+    server_data = ServerData(
+        telegram=telegram,
+        anonymizer=anonymizer,
+        randomizer=randomizer,
+        admin_chat_id=admin_chat_id,
+        messages=messages_index,
+    )
+
+    dispatcher = Dispatcher(max_key_pending=max_chat_pending, max_pending=max_pending)
+
+    DISPATCH_QUEUE_DEPTH.set_function(lambda: dispatcher.num_pending)
+    MAPPINGS.set_function(lambda: len(anonymizer))
+
+    # Messages are recorded before processing and acknowledged after it
+    spool = await open_spool(chat_mapping_file + ".spool", key, server_data, dispatcher)
+    SPOOL_PENDING.set_function(lambda: len(spool))
+
+    async def hold_batch(*args):
+        await spool.submit(*args, hold=True)
+
+    async def submit_edit(chat_id: int, message_id: int, content):
+        # Edits are ordered with the messages of the same conversation
+        thread_id = edit_thread_id(server_data, chat_id, message_id)
+        if thread_id is None:
+            return
+
+        await dispatcher.submit(
+            conversation_key(server_data, chat_id, thread_id),
+            functools.partial(
+                process_edited_message, server_data, chat_id, message_id, content
+            ),
+        )
+
+    async def hold_edit(chat_id: int, message_id: int, content):
+        thread_id = edit_thread_id(server_data, chat_id, message_id)
+        if thread_id is not None:
+            await spool.hold_edit(chat_id, thread_id, message_id, content)
+
+    async def record_sent(chat_id: int, old_message_id: int, new_message_id: int):
+        record_sent_message_id(server_data, chat_id, old_message_id, new_message_id)
+
+    async def drain():
+        # Failed messages are retried on the next start
+        spool.stop_retrying()
+        await dispatcher.join()
+
+    async def close():
+        await spool.close()
+        await anonymizer.close()
+        await messages_index.close()
+        await randomizer.close()
+
+    async def rotate(stopped):
+        steps = anonymizer.rotation_steps() + messages_index.rotation_steps()
+        steps += spool.rotation_steps()
+        await rotate_keys(steps, stopped)
+
+    return Pipeline(
+        spool.submit,
+        hold_batch,
+        submit_edit,
+        hold_edit,
+        record_sent,
+        drain,
+        close,
+        rotate,
+        spool.start,
+    )
+
+
+@app.command()
+def benchmark(
+    num_users: int = typer.Option(1000, help="Users with existing topics"),
+    num_messages: int = typer.Option(10000),
+    new_user_ratio: float = typer.Option(0.1),
+    admin_reply_rate: float = typer.Option(0.3),
+    latency: float = typer.Option(0.01, help="Mean telegram round-trip, seconds"),
+    concurrent: bool = typer.Option(True),
+    seed: int = typer.Option(0),
+):
+    """
+    Measure message processing throughput and latency on synthetic traffic
+    """
+    import asyncio
+
+    from shroombot.benchmark import BenchmarkConfig, run_benchmark
+
+    report = asyncio.run(
+        run_benchmark(
+            BenchmarkConfig(
+                num_users=num_users,
+                num_messages=num_messages,
+                new_user_ratio=new_user_ratio,
+                admin_reply_rate=admin_reply_rate,
+                latency=latency,
+                concurrent=concurrent,
+                seed=seed,
+            )
+        )
+    )
+
+    print(report.format())
+
+
+@app.command()
+def benchmark_index(
+    num_mappings: int = typer.Option(1_000_000),
+    num_lookups: int = typer.Option(100_000),
+):
+    """
+    Compare memory and lookup time of the mapping index with plain dicts
+    """
+    from shroombot.benchmark_index import run_index_benchmark
+
+    print(run_index_benchmark(num_mappings, num_lookups).format())
+
+
+@app.command()
+def benchmark_shards(
+    max_workers: int = typer.Option(4),
+    num_messages: int = typer.Option(2000),
+    cost: float = typer.Option(
+        0.001, help="Cpu time of a telegram call in the front process, seconds"
+    ),
+):
+    """
+    Measure throughput of the sharded mode with 1 to max_workers workers
+    """
+    import asyncio
+
+    from shroombot.benchmark_shards import run_shard_benchmark
+
+    for num_workers in range(1, max_workers + 1):
+        report = asyncio.run(run_shard_benchmark(num_workers, num_messages, cost=cost))
+        print(report.format())
+
+
+@app.command()
+def replay(
+    trace_file: str,
+    speed: float = typer.Option(
+        1.0, help="Multiplier of the recorded pace, 0 replays as fast as possible"
+    ),
+    latency: float = typer.Option(0.01, help="Mean telegram round-trip, seconds"),
+    error_rate: float = typer.Option(0.0, help="Probability of a failed call"),
+    seed: int = typer.Option(0),
+):
+    """
+    Replay a recorded traffic trace against the message processing
+    """
+    import asyncio
+
+    from shroombot.benchmark_replay import run_replay
+    from shroombot.trace import load_trace
+
+    # Injected errors are counted in the report
+    logging.basicConfig(level=logging.CRITICAL)
+
+    events = load_trace(trace_file)
+    report = asyncio.run(run_replay(events, speed, latency, error_rate, seed))
+
+    print(report.format())
+
+
+@app.command()
+def benchmark_codec(num_iterations: int = typer.Option(10_000)):
+    """
+    Measure decoding and encoding time of telegram messages of every type
+    """
+    from shroombot.benchmark_codec import run_codec_benchmark
 
-    asyncio.run(_entry())
+    print(run_codec_benchmark(num_iterations).format())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+"""
+Testing that the CLI starts quickly
+"""
+
+import json
+import subprocess
+import sys
+
+# Import of shroombot.main must stay well below the seconds aiotdlib takes
+IMPORT_BUDGET_MS = 500
+
+HEAVY_MODULES = ["aiotdlib", "pydantic", "cryptography"]
+
+_SCRIPT = """
+import json
+import sys
+import time
+
+started = time.perf_counter()
+
+from shroombot.main import app
+
+elapsed = time.perf_counter() - started
+
+from typer.testing import CliRunner
+
+for args in [["--help"], ["run", "--help"], ["benchmark", "--help"]]:
+    assert CliRunner().invoke(app, args).exit_code == 0, args
+
+print(json.dumps({
+    "elapsed_ms": elapsed * 1000,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+def test_cli_starts_without_heavy_imports():
+    output = subprocess.run(
+        [sys.executable, "-c", _SCRIPT % HEAVY_MODULES],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+    result = json.loads(output.splitlines()[-1])
+
+    assert result["loaded"] == []
+    assert result["elapsed_ms"] < IMPORT_BUDGET_MS
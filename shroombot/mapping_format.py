@@ -0,0 +1,111 @@
+"""
+Compact binary encoding of chat to topic mappings
+
+Snapshot is a header followed by little-endian int64 columns
+of chat ids and topic ids sorted by chat id, optionally zlib-compressed.
+Version 1 stored interleaved (chat id, topic id) pairs instead of columns.
+Journal records are single packed pairs.
+"""
+
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Iterable
+
+MAGIC = b"SHRM"
+VERSION = 2
+
+# Interleaved pairs
+VERSION_PAIRS = 1
+
+FLAG_ZLIB = 1
+
+# Magic, version, flags, number of pairs
+HEADER = struct.Struct("<4sBBQ")
+RECORD = struct.Struct("<qq")
+
+
+class InvalidFormat(ValueError):
+    pass
+
+
+def to_little_endian(values: array):
+    if sys.byteorder == "big":
+        values.byteswap()
+
+
+def is_binary(data: bytes) -> bool:
+    return data.startswith(MAGIC)
+
+
+def encode_columns(chats: array, topics: array, compress: bool = True) -> bytes:
+    """
+    Encode columns of chat ids and topic ids, sorted by chat id
+    """
+    chats = array("q", chats)
+    topics = array("q", topics)
+
+    to_little_endian(chats)
+    to_little_endian(topics)
+    payload = chats.tobytes() + topics.tobytes()
+
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+
+    return HEADER.pack(MAGIC, VERSION, flags, len(chats)) + payload
+
+
+def encode_pairs(items: Iterable[tuple[int, int]], compress: bool = True) -> bytes:
+    """
+    Encode (chat id, topic id) pairs
+    """
+    chats = array("q")
+    topics = array("q")
+    for chat_id, topic_id in sorted(items):
+        chats.append(chat_id)
+        topics.append(topic_id)
+
+    return encode_columns(chats, topics, compress)
+
+
+def decode_columns(data: bytes) -> tuple[array, array]:
+    """
+    Decode snapshot into columns of chat ids and topic ids sorted by chat id
+    """
+    if len(data) < HEADER.size:
+        raise InvalidFormat("Snapshot is too short")
+
+    magic, version, flags, count = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise InvalidFormat("Not a binary snapshot")
+
+    if version not in (VERSION, VERSION_PAIRS):
+        raise InvalidFormat(f"Unsupported snapshot version {version}")
+
+    payload = memoryview(data)[HEADER.size :]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    values = array("q")
+    values.frombytes(payload)
+    to_little_endian(values)
+
+    if len(values) != count * 2:
+        raise InvalidFormat("Snapshot is truncated")
+
+    if version == VERSION_PAIRS:
+        return values[0::2], values[1::2]
+
+    return values[:count], values[count:]
+
+
+def encode_record(chat_id: int, topic_id: int) -> bytes:
+    return RECORD.pack(chat_id, topic_id)
+
+
+def decode_record(data: bytes) -> tuple[int, int]:
+    return RECORD.unpack(data)
@@ -0,0 +1,53 @@
+"""
+Testing binary encoding of mappings
+"""
+
+from array import array
+
+import pytest
+
+from shroombot.mapping_format import (
+    HEADER,
+    MAGIC,
+    VERSION_PAIRS,
+    InvalidFormat,
+    decode_columns,
+    decode_record,
+    encode_pairs,
+    encode_record,
+    is_binary,
+)
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_pairs_roundtrip(compress: bool):
+    items = [(5, 1), (-100123, 2), (2**62, -(2**62))]
+
+    data = encode_pairs(items, compress)
+
+    assert is_binary(data)
+    chats, topics = decode_columns(data)
+    assert list(chats) == [-100123, 5, 2**62]
+    assert list(topics) == [2, 1, -(2**62)]
+
+
+def test_pairs_truncated():
+    data = encode_pairs([(1, 2), (3, 4)], compress=False)
+
+    with pytest.raises(InvalidFormat):
+        decode_columns(data[:-8])
+
+    with pytest.raises(InvalidFormat):
+        decode_columns(b"{}")
+
+
+def test_pairs_version_1():
+    data = HEADER.pack(MAGIC, VERSION_PAIRS, 0, 2) + array("q", [1, 2, 3, 4]).tobytes()
+
+    chats, topics = decode_columns(data)
+    assert list(chats) == [1, 3]
+    assert list(topics) == [2, 4]
+
+
+def test_record_roundtrip():
+    assert decode_record(encode_record(-1, 2)) == (-1, 2)
@@ -0,0 +1,139 @@
+"""
+Compact bidirectional index of chat to topic mappings
+
+Mappings are kept in sorted int64 arrays, one pair of columns per direction,
+with lookups by binary search. Recent inserts go to small dicts
+that are merged into the arrays once they grow.
+"""
+
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+
+
+def merge_sorted(
+    keys: array, values: array, recent: dict[int, int]
+) -> tuple[array, array]:
+    """
+    Merge recent items into sorted columns, recent values win
+    """
+    new_keys = array("q")
+    new_values = array("q")
+
+    start = 0
+    for key, value in sorted(recent.items()):
+        pos = bisect_left(keys, key, start)
+
+        # Untouched run of the old columns is copied at C speed
+        new_keys.extend(keys[start:pos])
+        new_values.extend(values[start:pos])
+
+        new_keys.append(key)
+        new_values.append(value)
+
+        if pos < len(keys) and keys[pos] == key:
+            pos += 1
+        start = pos
+
+    new_keys.extend(keys[start:])
+    new_values.extend(values[start:])
+
+    return new_keys, new_values
+
+
+def _find(keys: array, values: array, key: int) -> int | None:
+    pos = bisect_left(keys, key)
+    if pos < len(keys) and keys[pos] == key:
+        return values[pos]
+    return None
+
+
+@dataclass
+class MappingIndex:
+    """
+    Chat id <-> topic id lookups in O(log n)
+    """
+
+    # Sorted by chat id
+    chats: array = field(default_factory=lambda: array("q"))
+    chat_topics: array = field(default_factory=lambda: array("q"))
+
+    # Sorted by topic id
+    topics: array = field(default_factory=lambda: array("q"))
+    topic_chats: array = field(default_factory=lambda: array("q"))
+
+    recent_chats: dict[int, int] = field(default_factory=dict)
+    recent_topics: dict[int, int] = field(default_factory=dict)
+
+    # Recent inserts are merged once there are more than this many
+    # or more than 1/merge_ratio of the index size
+    min_recent: int = 1024
+    merge_ratio: int = 8
+
+    size: int = 0
+
+    @staticmethod
+    def from_columns(chats: array, topics: array) -> "MappingIndex":
+        """
+        Build index from columns sorted by chat id
+        """
+        order = sorted(range(len(topics)), key=topics.__getitem__)
+
+        return MappingIndex(
+            chats=chats,
+            chat_topics=topics,
+            topics=array("q", (topics[idx] for idx in order)),
+            topic_chats=array("q", (chats[idx] for idx in order)),
+            size=len(chats),
+        )
+
+    def __len__(self) -> int:
+        return self.size
+
+    def get_topic_id(self, chat_id: int) -> int | None:
+        topic_id = self.recent_chats.get(chat_id)
+        if topic_id is not None:
+            return topic_id
+        return _find(self.chats, self.chat_topics, chat_id)
+
+    def get_chat_id(self, topic_id: int) -> int | None:
+        chat_id = self.recent_topics.get(topic_id)
+        if chat_id is not None:
+            return chat_id
+        return _find(self.topics, self.topic_chats, topic_id)
+
+    def add(self, chat_id: int, topic_id: int):
+        if self.get_topic_id(chat_id) is None:
+            self.size += 1
+
+        self.recent_chats[chat_id] = topic_id
+        self.recent_topics[topic_id] = chat_id
+
+        if len(self.recent_chats) > max(
+            self.min_recent, len(self.chats) // self.merge_ratio
+        ):
+            self.merge()
+
+    def merge(self):
+        """
+        Move recent inserts into the sorted columns
+        """
+        if not self.recent_chats:
+            return
+
+        self.chats, self.chat_topics = merge_sorted(
+            self.chats, self.chat_topics, self.recent_chats
+        )
+        self.topics, self.topic_chats = merge_sorted(
+            self.topics, self.topic_chats, self.recent_topics
+        )
+
+        self.recent_chats = {}
+        self.recent_topics = {}
+
+    def columns(self) -> tuple[array, array]:
+        """
+        Copy of chat id and topic id columns sorted by chat id
+        """
+        self.merge()
+        return array("q", self.chats), array("q", self.chat_topics)
@@ -0,0 +1,49 @@
+"""
+Testing of the array-backed mapping index
+"""
+
+from array import array
+
+from shroombot.mapping_index import MappingIndex
+
+
+def test_mapping_index():
+    index = MappingIndex.from_columns(array("q", [1, 5, 9]), array("q", [30, 10, 20]))
+
+    assert len(index) == 3
+    assert index.get_topic_id(5) == 10
+    assert index.get_chat_id(20) == 9
+    assert index.get_topic_id(2) is None
+    assert index.get_chat_id(11) is None
+
+    index.add(3, 40)
+    index.add(5, 50)
+
+    assert len(index) == 4
+    assert index.get_topic_id(3) == 40
+    assert index.get_topic_id(5) == 50
+    assert index.get_chat_id(50) == 5
+
+    index.merge()
+
+    assert not index.recent_chats
+    assert list(index.chats) == [1, 3, 5, 9]
+    assert list(index.chat_topics) == [30, 40, 50, 20]
+    assert index.get_topic_id(3) == 40
+    assert index.get_chat_id(40) == 3
+    assert index.get_chat_id(50) == 5
+
+
+def test_mapping_index_merges_recent():
+    index = MappingIndex(min_recent=10)
+
+    for chat_id in range(100, 0, -1):
+        index.add(chat_id, chat_id + 1000)
+
+    assert len(index) == 100
+    assert len(index.recent_chats) <= 10
+    assert list(index.chats) == sorted(index.chats)
+
+    for chat_id in range(1, 101):
+        assert index.get_topic_id(chat_id) == chat_id + 1000
+        assert index.get_chat_id(chat_id + 1000) == chat_id
@@ -0,0 +1,316 @@
+"""
+Cross-reference of messages in user chats and admin topics
+
+Keeps which admin topic message corresponds to which user message
+so that replies keep their context and edits can be propagated.
+
+The index is a bounded LRU in memory, persisted to encrypted append-only
+segments on disk. The oldest segments are dropped as new ones are written,
+so the disk usage is bounded as well.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from shroombot.anonymizer import (
+    append_encrypted_lines,
+    load_encrypted_lines,
+    rotate_encrypted_lines,
+)
+from shroombot.keyring import EncryptionKey, RotationStep
+
+logger = logging.getLogger(__name__)
+
+# User chat id, user message id, topic id, admin message id, from admin
+_RECORD = struct.Struct("<qqqq?")
+# Admin side, chat id, old message id, new message id
+_REPLACE_RECORD = struct.Struct("<?qqq")
+
+
+@dataclass
+class MessageLink:
+    user_chat_id: int
+    user_message_id: int
+    topic_id: int
+    admin_message_id: int
+    # Whether message was written by admin and copied to the user
+    from_admin: bool
+
+    def encode(self) -> bytes:
+        return _RECORD.pack(
+            self.user_chat_id,
+            self.user_message_id,
+            self.topic_id,
+            self.admin_message_id,
+            self.from_admin,
+        )
+
+    @staticmethod
+    def decode(data: bytes) -> "MessageLink":
+        return MessageLink(*_RECORD.unpack(data))
+
+
+@dataclass
+class MessageIdReplacement:
+    """
+    Temporary id of a sent message replaced with the id assigned by the server
+    """
+
+    admin: bool
+    chat_id: int
+    old_message_id: int
+    new_message_id: int
+
+    def encode(self) -> bytes:
+        return _REPLACE_RECORD.pack(
+            self.admin, self.chat_id, self.old_message_id, self.new_message_id
+        )
+
+    @staticmethod
+    def decode(data: bytes) -> "MessageIdReplacement":
+        return MessageIdReplacement(*_REPLACE_RECORD.unpack(data))
+
+
+def decode_record(data: bytes) -> "MessageLink | MessageIdReplacement":
+    if len(data) == _REPLACE_RECORD.size:
+        return MessageIdReplacement.decode(data)
+    return MessageLink.decode(data)
+
+
+def segment_path(file_path: str, idx: int) -> str:
+    return f"{file_path}.{idx}"
+
+
+def existing_segments(file_path: str) -> list[int]:
+    directory, name = os.path.split(os.path.abspath(file_path))
+
+    segments = []
+    for entry in os.listdir(directory):
+        suffix = entry[len(name) + 1 :]
+        if entry.startswith(name + ".") and suffix.isdigit():
+            segments.append(int(suffix))
+
+    return sorted(segments)
+
+
+@dataclass
+class MessageIndex:  # pylint: disable=too-many-instance-attributes
+    """
+    Maps (user chat, message id) <-> (admin topic, message id)
+    """
+
+    file_path: str
+    encryption_key: EncryptionKey
+
+    # Maximum number of links kept in memory
+    capacity: int = 100_000
+    # Number of links in one segment on disk
+    segment_size: int = 10_000
+    # Links are written to disk at most once per interval
+    flush_interval: float = 1.0
+
+    by_user: OrderedDict[tuple[int, int], MessageLink] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    by_admin: dict[int, MessageLink] = field(default_factory=dict, repr=False)
+
+    segments: list[int] = field(default_factory=list)
+    segment_records: int = 0
+
+    pending: list[MessageLink | MessageIdReplacement] = field(
+        default_factory=list, repr=False
+    )
+    flusher: asyncio.Task | None = field(default=None, repr=False)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    @staticmethod
+    async def from_file(
+        file_path: str, encryption_key: EncryptionKey, **options: Any
+    ) -> "MessageIndex":
+        """
+        Load links from segments on disk, oldest first
+        """
+        index = MessageIndex(file_path, encryption_key, **options)
+        index.segments = existing_segments(file_path)
+
+        for idx in index.segments:
+            lines = await asyncio.to_thread(
+                load_encrypted_lines, segment_path(file_path, idx), encryption_key
+            )
+            for line in lines:
+                index._apply(decode_record(line))  # pylint: disable=protected-access
+            index.segment_records = len(lines)
+
+        return index
+
+    def __len__(self) -> int:
+        return len(self.by_user)
+
+    def user_to_admin(self, chat_id: int, message_id: int) -> MessageLink | None:
+        link = self.by_user.get((chat_id, message_id))
+        if link is not None:
+            self.by_user.move_to_end((chat_id, message_id))
+        return link
+
+    def admin_to_user(self, message_id: int) -> MessageLink | None:
+        link = self.by_admin.get(message_id)
+        if link is not None:
+            key = (link.user_chat_id, link.user_message_id)
+            if self.by_user.get(key) is link:
+                self.by_user.move_to_end(key)
+        return link
+
+    def add(self, link: MessageLink):
+        self._insert(link)
+        self._persist(link)
+
+    def link_sent(  # pylint: disable=too-many-arguments
+        self,
+        user_chat_id: int,
+        topic_id: int,
+        received_ids: list[int],
+        sent_ids: list[int | None],
+        from_admin: bool,
+    ):
+        """
+        Link received messages with their copies sent to the other side
+        """
+        for received_id, sent_id in zip(received_ids, sent_ids):
+            if sent_id is None:
+                continue
+
+            if from_admin:
+                link = MessageLink(
+                    user_chat_id, sent_id, topic_id, received_id, from_admin
+                )
+            else:
+                link = MessageLink(
+                    user_chat_id, received_id, topic_id, sent_id, from_admin
+                )
+
+            self.add(link)
+
+    def replace_message_id(
+        self, admin: bool, chat_id: int, old_message_id: int, new_message_id: int
+    ):
+        """
+        Replace temporary id of a sent message with the one assigned by the server
+        """
+        replacement = MessageIdReplacement(
+            admin, chat_id, old_message_id, new_message_id
+        )
+        link = self._replace(replacement)
+
+        # Links are written with the ids they have at flush time
+        if link is not None and not any(item is link for item in self.pending):
+            self._persist(replacement)
+
+    async def flush(self):
+        """
+        Write pending links to disk
+        """
+        async with self.lock:
+            links, self.pending = self.pending, []
+            if not links:
+                return
+
+            if not self.segments or self.segment_records >= self.segment_size:
+                self.segments.append(self.segments[-1] + 1 if self.segments else 0)
+                self.segment_records = 0
+
+            try:
+                await asyncio.to_thread(
+                    append_encrypted_lines,
+                    segment_path(self.file_path, self.segments[-1]),
+                    [item.encode() for item in links],
+                    self.encryption_key,
+                )
+            except Exception:
+                # Retry with the next flush
+                self.pending = links + self.pending
+                raise
+            self.segment_records += len(links)
+
+            # Older segments hold links that are already evicted from memory
+            max_segments = self.capacity // self.segment_size + 1
+            while len(self.segments) > max_segments:
+                os.remove(segment_path(self.file_path, self.segments.pop(0)))
+
+    def rotation_steps(self) -> list[RotationStep]:
+        """
+        Re-encrypt one segment per step
+        """
+        return [functools.partial(self._rotate_segment, idx) for idx in self.segments]
+
+    async def _rotate_segment(self, idx: int):
+        async with self.lock:
+            # Segment may be dropped since
+            if idx in self.segments:
+                await asyncio.to_thread(
+                    rotate_encrypted_lines,
+                    segment_path(self.file_path, idx),
+                    self.encryption_key,
+                )
+
+    async def close(self):
+        if self.flusher is not None and not self.flusher.done():
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def _apply(self, record: MessageLink | MessageIdReplacement):
+        if isinstance(record, MessageIdReplacement):
+            self._replace(record)
+        else:
+            self._insert(record)
+
+    def _replace(self, replacement: MessageIdReplacement) -> MessageLink | None:
+        if replacement.admin:
+            link = self.by_admin.pop(replacement.old_message_id, None)
+            if link is None:
+                return None
+            link.admin_message_id = replacement.new_message_id
+            self.by_admin[replacement.new_message_id] = link
+        else:
+            key = (replacement.chat_id, replacement.old_message_id)
+            link = self.by_user.pop(key, None)
+            if link is None:
+                return None
+            link.user_message_id = replacement.new_message_id
+            self.by_user[(replacement.chat_id, replacement.new_message_id)] = link
+
+        return link
+
+    def _insert(self, link: MessageLink):
+        key = (link.user_chat_id, link.user_message_id)
+
+        self.by_user[key] = link
+        self.by_user.move_to_end(key)
+        self.by_admin[link.admin_message_id] = link
+
+        while len(self.by_user) > self.capacity:
+            _, evicted = self.by_user.popitem(last=False)
+            if self.by_admin.get(evicted.admin_message_id) is evicted:
+                del self.by_admin[evicted.admin_message_id]
+
+    def _persist(self, record: MessageLink | MessageIdReplacement):
+        self.pending.append(record)
+
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Could not write message links")
@@ -0,0 +1,63 @@
+"""
+Testing of the message cross-reference index
+"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+from cryptography.fernet import Fernet
+
+from shroombot.message_index import MessageIndex, MessageLink, existing_segments
+
+
+@pytest.mark.asyncio
+async def test_message_index_bounded():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.messages")
+        key = Fernet.generate_key()
+
+        index = await MessageIndex.from_file(
+            file_path, key, capacity=10, segment_size=5, flush_interval=10
+        )
+
+        for idx in range(30):
+            index.add(MessageLink(1, idx, 2, 100 + idx, False))
+            if idx % 5 == 4:
+                await index.flush()
+
+        # Oldest links are evicted from memory and from disk
+        assert len(index) == 10
+        assert index.user_to_admin(1, 0) is None
+        assert index.admin_to_user(100) is None
+        assert existing_segments(file_path) == [3, 4, 5]
+
+        await index.close()
+
+        loaded = await MessageIndex.from_file(file_path, key, capacity=10)
+        assert len(loaded) == 10
+        assert loaded.admin_to_user(129) == MessageLink(1, 29, 2, 129, False)
+
+
+@pytest.mark.asyncio
+async def test_message_index_replaced_ids_after_reload():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.messages")
+        key = Fernet.generate_key()
+
+        index = await MessageIndex.from_file(file_path, key, flush_interval=10)
+        index.add(MessageLink(1, 10, 2, 100, False))
+        index.add(MessageLink(1, 20, 2, 200, True))
+        await index.flush()
+
+        # Temporary ids of sent messages, written before the server assigned ids
+        index.replace_message_id(True, 2, 100, 101)
+        index.replace_message_id(False, 1, 20, 21)
+        await index.close()
+
+        loaded = await MessageIndex.from_file(file_path, key)
+        assert len(loaded) == 2
+        assert loaded.admin_to_user(100) is None
+        assert loaded.admin_to_user(101) == MessageLink(1, 10, 2, 101, False)
+        assert loaded.user_to_admin(1, 20) is None
+        assert loaded.user_to_admin(1, 21) == MessageLink(1, 21, 2, 200, True)
@@ -0,0 +1,116 @@
+"""
+Prometheus metrics of the bot pipeline
+
+Exported on the /metrics endpoint of the api server
+"""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+USER_TO_ADMIN = "user_to_admin"
+ADMIN_TO_USER = "admin_to_user"
+
+STAGE_BUCKETS = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+]
+
+STAGE_SECONDS = Histogram(
+    "shroombot_stage_seconds",
+    "Time spent in a stage of message processing",
+    ("stage", "message_type", "direction"),
+    buckets=STAGE_BUCKETS,
+)
+
+REGISTER_SECONDS = Histogram(
+    "shroombot_register_seconds",
+    "Time spent registering chat to topic mapping",
+    buckets=STAGE_BUCKETS,
+)
+
+JOURNAL_WRITE_SECONDS = Histogram(
+    "shroombot_journal_write_seconds",
+    "Time spent writing a batch of registrations to the mapping journal",
+    buckets=STAGE_BUCKETS,
+)
+
+MESSAGES_COUNTER = Counter(
+    "shroombot_messages",
+    "Number of processed messages",
+    ("message_type", "direction"),
+)
+
+FAILED_COUNTER = Counter(
+    "shroombot_failed_messages",
+    "Number of messages that failed processing",
+    ("message_type", "direction"),
+)
+
+DISPATCH_QUEUE_DEPTH = Gauge(
+    "shroombot_dispatch_queue_depth", "Number of messages waiting for processing"
+)
+
+MAPPINGS = Gauge("shroombot_mappings", "Number of known chat to topic mappings")
+
+FILE_CACHE_HITS = Counter(
+    "shroombot_file_cache_hits", "Number of media sends that reused cached file"
+)
+
+FILE_CACHE_MISSES = Counter(
+    "shroombot_file_cache_misses", "Number of media sends that built file anew"
+)
+
+SPOOL_PENDING = Gauge(
+    "shroombot_spool_pending", "Number of spooled messages not processed yet"
+)
+
+SPOOL_RETRIES = Counter(
+    "shroombot_spool_retries", "Number of retried message processings"
+)
+
+SPOOL_DEAD = Counter(
+    "shroombot_spool_dead_letters",
+    "Number of messages moved to dead letters after failing too many times",
+)
+
+LOOP_LAG = Histogram(
+    "shroombot_loop_lag_seconds",
+    "How late the event loop runs scheduled callbacks",
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0],
+)
+
+
+def message_type(messages: list) -> str:
+    """
+    Label of the message type, "Mixed" for batches of different types
+    """
+    names = {message.__class__.__name__ for message in messages}
+    if len(names) == 1:
+        return names.pop()
+    return "Mixed"
+
+
+@contextmanager
+def timed(stage: str, msg_type: str = "", direction: str = "") -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, msg_type, direction).observe(
+            time.perf_counter() - started
+        )
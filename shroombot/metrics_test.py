@@ -0,0 +1,29 @@
+"""
+Testing that pipeline stages are recorded in metrics
+"""
+
+from prometheus_client import REGISTRY
+
+from shroombot.metrics import message_type, timed
+from shroombot.server import MyPhotoMessage, MyTextMessage
+
+
+def test_message_type():
+    assert message_type([MyTextMessage("a"), MyTextMessage("b")]) == "MyTextMessage"
+    assert (
+        message_type([MyTextMessage("a"), MyPhotoMessage(id="1", caption=None)])
+        == "Mixed"
+    )
+
+
+def test_timed():
+    labels = {"stage": "test", "message_type": "MyTextMessage", "direction": "x"}
+
+    before = REGISTRY.get_sample_value("shroombot_stage_seconds_count", labels) or 0
+
+    with timed("test", "MyTextMessage", "x"):
+        pass
+
+    after = REGISTRY.get_sample_value("shroombot_stage_seconds_count", labels)
+
+    assert after == before + 1
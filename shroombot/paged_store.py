@@ -0,0 +1,523 @@
+"""
+Chat to topic mappings in a block encrypted file, paged in on demand
+
+The snapshot of the anonymizer is decrypted and loaded whole on start,
+which takes longer and more memory with every user. Here mappings are kept
+in fixed size blocks sorted by chat id, and once more sorted by topic id,
+every block encrypted on its own. On start only the encrypted index
+of the first id in every block is read. The file is memory mapped and a lookup
+decrypts the one block it falls into, recently used blocks are cached.
+
+Registrations are written to the journal as with the snapshot,
+compaction merges them into a new file a block at a time.
+
+File layout:
+
+    header | blocks by chat id | blocks by topic id | index
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO
+
+from cryptography.fernet import InvalidToken, MultiFernet
+
+from shroombot.anonymizer import (
+    Anonymizer,
+    CouldNotDecrypt,
+    fsync_dir,
+    has_mappings,
+    load_mappings,
+)
+from shroombot.keyring import EncryptionKey, RotationStep, get_cipher
+from shroombot.mapping_format import to_little_endian
+from shroombot.mapping_index import merge_sorted
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SHRPAGED"
+VERSION = 1
+
+# Magic, version, records per block, records by chat and by topic,
+# size of an encrypted block, offset and size of the encrypted index
+_HEADER = struct.Struct("<8sBIQQIQI")
+
+# Sections of the file
+CHATS = 0
+TOPICS = 1
+
+Columns = tuple[array, array]
+
+
+def _num_blocks(records: int, block_records: int) -> int:
+    return -(-records // block_records)
+
+
+@dataclass
+class _SectionWriter:
+    """
+    Splits sorted columns into blocks and writes them encrypted
+    """
+
+    file: BinaryIO
+    cipher: MultiFernet
+    block_records: int
+
+    keys: array = field(default_factory=lambda: array("q"))
+    values: array = field(default_factory=lambda: array("q"))
+    # First key of every written block
+    firsts: array = field(default_factory=lambda: array("q"))
+    records: int = 0
+    token_size: int = 0
+
+    def write(self, keys: array, values: array):
+        start = 0
+        while start < len(keys):
+            end = start + self.block_records - len(self.keys)
+            self.keys.extend(keys[start:end])
+            self.values.extend(values[start:end])
+            start = end
+
+            if len(self.keys) == self.block_records:
+                self._write_block()
+
+    def finish(self):
+        if self.keys:
+            self._write_block()
+
+    def _write_block(self):
+        keys, values = self.keys, self.values
+        self.keys, self.values = array("q"), array("q")
+
+        self.firsts.append(keys[0])
+        self.records += len(keys)
+
+        # Last block is padded, all blocks are encrypted to the same size
+        padding = array("q", bytes(8 * (self.block_records - len(keys))))
+        block = keys + padding + values + padding
+        to_little_endian(block)
+
+        token = self.cipher.encrypt(block.tobytes())
+        assert self.token_size in (0, len(token))
+        self.token_size = len(token)
+        self.file.write(token)
+
+
+def _write_section(
+    file: BinaryIO, cipher: MultiFernet, block_records: int, chunks: Iterable[Columns]
+) -> _SectionWriter:
+    writer = _SectionWriter(file, cipher, block_records)
+    for keys, values in chunks:
+        writer.write(keys, values)
+    writer.finish()
+    return writer
+
+
+def write_paged_file(
+    file_path: str,
+    by_chat: Iterable[Columns],
+    by_topic: Iterable[Columns],
+    encryption_key: EncryptionKey,
+    block_records: int = 256,
+):
+    """
+    Atomically replace the file with mappings given as chunks of sorted columns,
+    chat ids and their topics, and topic ids and their chats
+    """
+    cipher = get_cipher(encryption_key)
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        # Header is written once the sizes are known
+        file.write(bytes(_HEADER.size))
+
+        chats = _write_section(file, cipher, block_records, by_chat)
+        topics = _write_section(file, cipher, block_records, by_topic)
+
+        index = chats.firsts + topics.firsts
+        to_little_endian(index)
+        index_token = cipher.encrypt(index.tobytes())
+
+        index_offset = file.tell()
+        file.write(index_token)
+
+        file.seek(0)
+        file.write(
+            _HEADER.pack(
+                MAGIC,
+                VERSION,
+                block_records,
+                chats.records,
+                topics.records,
+                max(chats.token_size, topics.token_size),
+                index_offset,
+                len(index_token),
+            )
+        )
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, file_path)
+
+    fsync_dir(os.path.dirname(os.path.abspath(file_path)))
+
+
+@dataclass
+class PagedFile:  # pylint: disable=too-many-instance-attributes
+    """
+    Memory mapped paged file, read from the event loop thread.
+
+    Blocks read through the cache must only be read from one thread,
+    merging and copying columns read blocks directly
+    and can run in other threads within reading()
+    """
+
+    data: mmap.mmap | bytes
+    encryption_key: EncryptionKey
+    block_records: int = 256
+    # Number of records by chat and by topic
+    records: tuple[int, int] = (0, 0)
+    token_size: int = 0
+    # First key of every block, by chat and by topic
+    firsts: tuple[array, array] = field(
+        default_factory=lambda: (array("q"), array("q")), repr=False
+    )
+
+    # Decrypted blocks kept in memory
+    cache_blocks: int = 1024
+    cache: OrderedDict[tuple[int, int], Columns] = field(
+        default_factory=OrderedDict, repr=False
+    )
+
+    # Other threads reading the file, it is unmapped once they are done
+    readers: int = 0
+    closed: bool = False
+
+    @staticmethod
+    def open(
+        file_path: str, encryption_key: EncryptionKey, cache_blocks: int = 1024
+    ) -> "PagedFile":
+        """
+        Map the file and decrypt its index, a missing file has no mappings
+        """
+        if not os.path.exists(file_path):
+            return PagedFile(b"", encryption_key, cache_blocks=cache_blocks)
+
+        with open(file_path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            block_records,
+            chat_records,
+            topic_records,
+            token_size,
+            index_offset,
+            index_size,
+        ) = _HEADER.unpack_from(data)
+
+        if magic != MAGIC or version != VERSION:
+            data.close()
+            raise ValueError(f"Not a paged mapping file: {file_path}")
+
+        index = array(
+            "q",
+            get_cipher(encryption_key).decrypt(
+                data[index_offset : index_offset + index_size]
+            ),
+        )
+        to_little_endian(index)
+
+        # Index is first keys of blocks by chat, then of blocks by topic
+        split = _num_blocks(chat_records, block_records)
+
+        return PagedFile(
+            data,
+            encryption_key,
+            block_records,
+            (chat_records, topic_records),
+            token_size,
+            (index[:split], index[split:]),
+            cache_blocks,
+        )
+
+    def _read_block(self, section: int, idx: int) -> Columns:
+        offset = _HEADER.size + self.token_size * (
+            idx + section * len(self.firsts[CHATS])
+        )
+        token = self.data[offset : offset + self.token_size]
+
+        block = array("q", get_cipher(self.encryption_key).decrypt(token))
+        to_little_endian(block)
+
+        size = min(self.block_records, self.records[section] - idx * self.block_records)
+        return block[:size], block[self.block_records : self.block_records + size]
+
+    def _block(self, section: int, idx: int) -> Columns:
+        key = (section, idx)
+
+        block = self.cache.get(key)
+        if block is not None:
+            self.cache.move_to_end(key)
+            return block
+
+        block = self.cache[key] = self._read_block(section, idx)
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return block
+
+    def find(self, section: int, key: int) -> int | None:
+        idx = bisect_right(self.firsts[section], key) - 1
+        if idx < 0:
+            return None
+
+        keys, values = self._block(section, idx)
+        pos = bisect_left(keys, key)
+        if pos < len(keys) and keys[pos] == key:
+            return values[pos]
+        return None
+
+    def merged(self, section: int, recent: dict[int, int]) -> Iterator[Columns]:
+        """
+        Sorted columns of the section with recent items merged in,
+        a block at a time
+        """
+        items = sorted(recent.items())
+        item_keys = [key for key, _ in items]
+        firsts = self.firsts[section]
+
+        start = 0
+        for idx in range(len(firsts)):
+            keys, values = self._read_block(section, idx)
+
+            # Items before the next block go into this one
+            end = len(items)
+            if idx + 1 < len(firsts):
+                end = bisect_left(item_keys, firsts[idx + 1])
+
+            yield merge_sorted(keys, values, dict(items[start:end]))
+            start = end
+
+        if start < len(items):
+            yield (
+                array("q", item_keys[start:]),
+                array("q", (value for _, value in items[start:])),
+            )
+
+    def columns(self, recent: dict[int, int]) -> Columns:
+        """
+        Chat ids and their topic ids with recent items merged in
+        """
+        chats, topics = array("q"), array("q")
+        for keys, values in self.merged(CHATS, recent):
+            chats.extend(keys)
+            topics.extend(values)
+        return chats, topics
+
+    @contextmanager
+    def reading(self) -> Iterator["PagedFile"]:
+        """
+        Keep the file mapped while another thread reads from it
+        """
+        self.readers += 1
+        try:
+            yield self
+        finally:
+            self.readers -= 1
+            if self.closed:
+                self.close()
+
+    def close(self):
+        """
+        Unmap the file, once the last reader is done if there are any
+        """
+        self.closed = True
+        self.cache.clear()
+        if self.readers == 0 and isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+@dataclass
+class PagedIndex:
+    """
+    Lookups in the paged file and in registrations not merged into it yet,
+    used by the anonymizer in place of MappingIndex
+    """
+
+    pages: PagedFile
+    size: int = 0
+
+    recent_chats: dict[int, int] = field(default_factory=dict)
+    recent_topics: dict[int, int] = field(default_factory=dict)
+    # Registrations being merged into a new file
+    merging_chats: dict[int, int] = field(default_factory=dict)
+    merging_topics: dict[int, int] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def get_topic_id(self, chat_id: int) -> int | None:
+        for recent in (self.recent_chats, self.merging_chats):
+            topic_id = recent.get(chat_id)
+            if topic_id is not None:
+                return topic_id
+        return self.pages.find(CHATS, chat_id)
+
+    def get_chat_id(self, topic_id: int) -> int | None:
+        for recent in (self.recent_topics, self.merging_topics):
+            chat_id = recent.get(topic_id)
+            if chat_id is not None:
+                return chat_id
+        return self.pages.find(TOPICS, topic_id)
+
+    def add(self, chat_id: int, topic_id: int):
+        if self.get_topic_id(chat_id) is None:
+            self.size += 1
+
+        self.recent_chats[chat_id] = topic_id
+        self.recent_topics[topic_id] = chat_id
+
+    def unmerged(self) -> tuple[dict[int, int], dict[int, int]]:
+        """
+        Registrations not in the paged file, by chat and by topic
+        """
+        return (
+            self.merging_chats | self.recent_chats,
+            self.merging_topics | self.recent_topics,
+        )
+
+    def start_merge(self) -> tuple[dict[int, int], dict[int, int]]:
+        """
+        Move recent registrations aside to be merged into a new file.
+
+        Registrations of a merge that failed are merged again
+        """
+        self.merging_chats, self.merging_topics = self.unmerged()
+        self.recent_chats, self.recent_topics = {}, {}
+        return dict(self.merging_chats), dict(self.merging_topics)
+
+    def finish_merge(self, pages: PagedFile):
+        old, self.pages = self.pages, pages
+        self.merging_chats, self.merging_topics = {}, {}
+        old.close()
+
+    def columns(self) -> Columns:
+        return self.pages.columns(self.unmerged()[0])
+
+
+@dataclass
+class PagedAnonymizer(Anonymizer):
+    """
+    Anonymizer that keeps mappings in the paged file instead of the snapshot
+    """
+
+    index: PagedIndex  # type: ignore
+    block_records: int = 256
+
+    @staticmethod
+    async def from_file(  # type: ignore
+        file_path: str,
+        encryption_key: EncryptionKey,
+        migrate_from: str | None = None,
+        cache_blocks: int = 1024,
+        **options: Any,
+    ) -> "PagedAnonymizer":
+        """
+        Open the paged file and load the journal.
+
+        Missing file is written from the snapshot and journal files
+        of migrate_from if given, those files are kept as they are
+        """
+        block_records = options.get("block_records", 256)
+        if (
+            migrate_from
+            and not os.path.exists(file_path)
+            and has_mappings(migrate_from)
+        ):
+            await migrate(migrate_from, file_path, encryption_key, block_records)
+
+        try:
+            pages = await asyncio.to_thread(
+                PagedFile.open, file_path, encryption_key, cache_blocks
+            )
+        except (InvalidToken, ValueError) as exc:
+            raise CouldNotDecrypt() from exc
+
+        index = PagedIndex(pages, size=pages.records[CHATS])
+        return await PagedAnonymizer.with_journal(
+            index, file_path, encryption_key, **options
+        )
+
+    async def columns(self) -> Columns:
+        # Decrypts every block, so not on the event loop
+        with self.index.pages.reading() as pages:
+            return await asyncio.to_thread(pages.columns, self.index.unmerged()[0])
+
+    def _start_compaction(self) -> tuple[dict[int, int], dict[int, int]]:
+        # Journaled registrations are merged into a new paged file
+        return self.index.start_merge()
+
+    async def _write_compacted(self, mappings: tuple[dict[int, int], dict[int, int]]):
+        chats, topics = mappings
+
+        with self.index.pages.reading() as pages:
+            await asyncio.to_thread(
+                write_paged_file,
+                self.file_path,
+                pages.merged(CHATS, chats),
+                pages.merged(TOPICS, topics),
+                self.encryption_key,
+                self.block_records,
+            )
+            new_pages = await asyncio.to_thread(
+                PagedFile.open, self.file_path, self.encryption_key, pages.cache_blocks
+            )
+
+            self.index.finish_merge(new_pages)
+
+    def rotation_steps(self) -> list[RotationStep]:
+        """
+        Compaction writes every block with the newest key, there are no backups
+        """
+        return [self._compact_now]
+
+    async def close(self):
+        await super().close()
+        self.index.pages.close()
+
+
+async def migrate(
+    file_path: str,
+    paged_file_path: str,
+    encryption_key: EncryptionKey,
+    block_records: int = 256,
+):
+    """
+    Write mappings of the snapshot and journal files to the paged file,
+    the files are only read
+    """
+    index = await load_mappings(file_path, encryption_key)
+    index.merge()
+
+    await asyncio.to_thread(
+        write_paged_file,
+        paged_file_path,
+        [(index.chats, index.chat_topics)],
+        [(index.topics, index.topic_chats)],
+        encryption_key,
+        block_records,
+    )
+
+    logger.info(
+        "Migrated %d mappings from %s to %s", len(index), file_path, paged_file_path
+    )
@@ -0,0 +1,148 @@
+"""
+Testing of the paged mapping file
+"""
+
+import asyncio
+import os
+import random
+from tempfile import TemporaryDirectory
+
+import pytest
+from cryptography.fernet import Fernet
+
+from shroombot.anonymizer import (
+    open_mapping_store,
+    paged_path,
+    save_encrypted_json_file,
+)
+from shroombot.keyring import rotate_keys
+from shroombot.paged_store import PagedAnonymizer
+
+
+@pytest.mark.asyncio
+async def test_paged_store_compacts():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.paged")
+        key = Fernet.generate_key()
+
+        store = await PagedAnonymizer.from_file(file_path, key)
+        for chat_id in range(1, 11):
+            await store.register_chat_topic_link(chat_id, chat_id + 100)
+        await store.compact()
+        assert not os.path.exists(file_path + ".journal.compacting")
+
+        # Chat gets a new topic, others are added
+        await store.register_chat_topic_link(5, 205)
+        await store.register_chat_topic_link(11, 111)
+        await store.close()
+
+        # Chat ids are not stored in plain text
+        with open(file_path, "rb") as file:
+            assert (7).to_bytes(8, "little") not in file.read()
+
+        store = await PagedAnonymizer.from_file(file_path, key)
+        assert len(store) == 11
+        await store.compact()
+        await store.close()
+
+        store = await PagedAnonymizer.from_file(file_path, key)
+        assert len(store) == 11
+        assert store.journal_records == 0
+        assert await store.find_topic_id(5) == 205
+        assert await store.find_chat_id(205) == 5
+
+        chats, topics = await store.columns()
+        expected = [(idx, idx + 100) for idx in range(1, 12)]
+        expected[4] = (5, 205)
+        assert list(zip(chats, topics)) == expected
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_paged_store_reads_only_cached_blocks():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.paged")
+        key = Fernet.generate_key()
+
+        mappings = {
+            chat_id: topic_id
+            for topic_id, chat_id in enumerate(random.sample(range(10**9), 1000))
+        }
+
+        # Compacted once all mappings are in the journal
+        store = await PagedAnonymizer.from_file(
+            file_path, key, block_records=16, compact_every=1000
+        )
+        await asyncio.gather(
+            *[
+                store.register_chat_topic_link(chat_id, topic_id)
+                for chat_id, topic_id in mappings.items()
+            ]
+        )
+        await store.close()
+
+        store = await PagedAnonymizer.from_file(file_path, key, cache_blocks=4)
+        pages = store.index.pages
+        assert pages.records == (1000, 1000)
+        assert not pages.cache
+
+        for chat_id, topic_id in mappings.items():
+            assert await store.find_topic_id(chat_id) == topic_id
+            assert await store.find_chat_id(topic_id) == chat_id
+            assert len(pages.cache) <= 4
+        assert await store.find_topic_id(-1) is None
+        assert await store.find_chat_id(1000) is None
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_paged_store_key_rotation():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.paged")
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+
+        store = await PagedAnonymizer.from_file(file_path, old, compact_every=10)
+        for chat_id in range(1, 26):
+            await store.register_chat_topic_link(chat_id, chat_id + 100)
+        await store.close()
+
+        store = await PagedAnonymizer.from_file(file_path, (new, old))
+        assert await rotate_keys(store.rotation_steps(), asyncio.Event())
+        await store.close()
+
+        store = await PagedAnonymizer.from_file(file_path, new)
+        assert [await store.find_topic_id(idx) for idx in range(1, 26)] == list(
+            range(101, 126)
+        )
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_paged_store_migration_keeps_legacy_files():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin")
+        key = Fernet.generate_key()
+
+        save_encrypted_json_file(
+            file_path, {"mappings": [{"chat_id": 1, "topic_id": 2}]}, key
+        )
+        with open(file_path, "rb") as file:
+            legacy = file.read()
+
+        store = await open_mapping_store(file_path, key, storage="paged")
+        assert await store.find_topic_id(1) == 2
+
+        # Old file is unmapped once compaction replaced it
+        pages = store.index.pages
+        await store.register_chat_topic_link(3, 4)
+        await store.compact()
+        assert pages.data.closed
+        assert await store.find_chat_id(4) == 3
+        await store.close()
+
+        with open(file_path, "rb") as file:
+            assert file.read() == legacy
+        assert sorted(os.listdir(temp_dir)) == [
+            "mapping.bin",
+            paged_path("mapping.bin"),
+        ]
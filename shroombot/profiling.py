@@ -0,0 +1,148 @@
+"""
+On-demand profiling of the running process
+
+CPU profiles are taken by a thread that samples the stack of the event loop
+thread, so that profiling does not run on the loop itself. Deterministic
+profile of the loop thread with cProfile is available as well, at a higher cost.
+Memory is profiled with tracemalloc, which is only running between start and stop.
+
+Nothing runs unless a profile is requested
+"""
+
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field
+
+
+class ProfilerBusy(RuntimeError):
+    """
+    Another profile is being taken
+    """
+
+
+def sample_stacks(thread_id: int, duration: float, interval: float) -> Counter[str]:
+    """
+    Collapsed stacks of the thread, outermost frame first, with sample counts
+    """
+    stacks: Counter[str] = Counter()
+    deadline = time.monotonic() + duration
+
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)  # pylint: disable=protected-access
+
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+
+        time.sleep(interval)
+
+    return stacks
+
+
+def format_collapsed(stacks: Counter[str]) -> str:
+    """
+    Format accepted by flamegraph tools
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _format_stats(profile: cProfile.Profile, limit: int) -> str:
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    return output.getvalue()
+
+
+def _format_statistics(statistics: list, limit: int) -> list[str]:
+    return [str(stat) for stat in statistics[:limit]]
+
+
+@dataclass
+class Profiler:
+    # Longest profile that can be requested, seconds
+    max_duration: float = 60.0
+
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+    # Snapshot diffs are taken against
+    snapshot: tracemalloc.Snapshot | None = field(default=None, repr=False)
+
+    async def cpu_sampled(self, duration: float, interval: float = 0.005) -> str:
+        """
+        Sample stacks of the event loop thread for the duration
+        """
+        async with self._exclusive():
+            stacks = await asyncio.to_thread(
+                sample_stacks,
+                threading.get_ident(),
+                min(duration, self.max_duration),
+                interval,
+            )
+        return format_collapsed(stacks)
+
+    async def cpu_deterministic(self, duration: float, limit: int = 50) -> str:
+        """
+        Profile every call on the event loop thread for the duration
+        """
+        async with self._exclusive():
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(min(duration, self.max_duration))
+            finally:
+                profile.disable()
+        return await asyncio.to_thread(_format_stats, profile, limit)
+
+    def _exclusive(self) -> asyncio.Lock:
+        if self.lock.locked():
+            raise ProfilerBusy("Profile is already being taken")
+        return self.lock
+
+    def memory_start(self, nframes: int = 10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+        self.snapshot = None
+
+    def memory_stop(self):
+        tracemalloc.stop()
+        self.snapshot = None
+
+    async def memory_top(self, limit: int = 20) -> list[str]:
+        """
+        Allocation sites holding the most memory, the snapshot becomes the baseline
+        """
+        self.snapshot = await asyncio.to_thread(self._take_snapshot)
+        statistics = await asyncio.to_thread(self.snapshot.statistics, "lineno")
+        return _format_statistics(statistics, limit)
+
+    async def memory_diff(self, limit: int = 20) -> list[str]:
+        """
+        Allocation sites that grew the most since the baseline
+        """
+        snapshot = await asyncio.to_thread(self._take_snapshot)
+        if self.snapshot is None:
+            self.snapshot = snapshot
+            return []
+
+        statistics = await asyncio.to_thread(
+            snapshot.compare_to, self.snapshot, "lineno"
+        )
+        return _format_statistics(statistics, limit)
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Memory profiling is not started")
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
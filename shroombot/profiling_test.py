@@ -0,0 +1,75 @@
+"""
+Testing of the on-demand profiler
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from shroombot.api_server import make_app
+from shroombot.profiling import Profiler, ProfilerBusy
+
+
+def _busy_loop_work():
+    deadline = time.perf_counter() + 0.01
+    while time.perf_counter() < deadline:
+        pass
+
+
+async def _keep_loop_busy(duration: float):
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        _busy_loop_work()
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_cpu_profiles():
+    profiler = Profiler()
+
+    profile = asyncio.create_task(profiler.cpu_sampled(0.3, interval=0.001))
+    await asyncio.sleep(0)
+
+    # One profile at a time
+    with pytest.raises(ProfilerBusy):
+        await profiler.cpu_sampled(0.1)
+
+    await _keep_loop_busy(0.3)
+    collapsed = await profile
+
+    assert "_busy_loop_work" in collapsed
+    stack, count = collapsed.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0 and ";" in stack
+
+    stats, _ = await asyncio.gather(
+        profiler.cpu_deterministic(0.1), _keep_loop_busy(0.1)
+    )
+    assert "_busy_loop_work" in stats
+
+
+@pytest.mark.asyncio
+async def test_memory_profile():
+    profiler = Profiler()
+
+    with pytest.raises(RuntimeError):
+        await profiler.memory_top()
+
+    profiler.memory_start()
+    try:
+        assert await profiler.memory_top()
+
+        kept = [bytearray(1000) for _ in range(1000)]
+        diff = await profiler.memory_diff()
+        assert "profiling_test.py" in diff[0]
+        del kept
+    finally:
+        profiler.memory_stop()
+
+
+def test_profiling_off_by_default():
+    def paths(app) -> set[str]:
+        return {route.path for route in app.routes}
+
+    assert not any(path.startswith("/debug/profile") for path in paths(make_app("")))
+    assert "/debug/profile/cpu" in paths(make_app("", debug_token="secret"))
@@ -0,0 +1,267 @@
+"""
+Pacing of outgoing telegram requests
+
+Keeps sends under telegram flood limits using a token bucket per destination
+chat and a global one. Sends that hit the limit anyway are retried after
+the time telegram asks for.
+"""
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    # Replies to users
+    USER = 0
+    # Mirrors of user messages into admin topics
+    ADMIN = 1
+
+
+@dataclass
+class TokenBucket:
+    # Tokens per second
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    # Telegram asked us to wait until this time
+    blocked_until: float = 0.0
+
+    @staticmethod
+    def full(rate: float, capacity: float, now: float) -> "TokenBucket":
+        return TokenBucket(rate=rate, capacity=capacity, tokens=capacity, updated=now)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        Seconds until a token is available
+        """
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+@dataclass(order=True)
+class _Send:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempt: int = field(default=0, compare=False)
+    not_before: float = field(default=0.0, compare=False)
+
+
+@dataclass
+class SendScheduler:  # pylint: disable=too-many-instance-attributes
+    """
+    Orders sends by priority and paces them by destination chat
+    """
+
+    # Extracts number of seconds to wait from the flood error,
+    # None if the error should not be retried
+    retry_after: Callable[[Exception], float | None] = lambda exc: None
+
+    global_rate: float = 30.0
+    global_burst: float = 30.0
+    # Private chats (positive ids)
+    chat_rate: float = 1.0
+    chat_burst: float = 3.0
+    # Groups and supergroups (negative ids)
+    group_rate: float = 20 / 60
+    group_burst: float = 20.0
+
+    max_retries: int = 5
+    # Base of jittered exponential backoff added to retry-after
+    backoff: float = 0.5
+    # Idle chat buckets are dropped above this number
+    max_buckets: int = 10000
+
+    clock: Callable[[], float] = time.monotonic
+
+    # Heap of waiting sends per destination chat
+    queues: dict[int, list[_Send]] = field(default_factory=dict)
+    buckets: dict[int, TokenBucket] = field(default_factory=dict)
+    global_bucket: TokenBucket = field(init=False)
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    task: asyncio.Task | None = None
+    sending: set[asyncio.Task] = field(default_factory=set)
+    seq: int = 0
+
+    def __post_init__(self):
+        self.global_bucket = TokenBucket.full(
+            self.global_rate, self.global_burst, self.clock()
+        )
+
+    async def submit(
+        self,
+        chat_id: int,
+        send: Callable[[], Awaitable[Any]],
+        priority: Priority = Priority.USER,
+    ) -> Any:
+        """
+        Run send when limits allow and return its result
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        self.seq += 1
+        self._push(_Send(priority, self.seq, chat_id, send, future))
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+        return await future
+
+    async def close(self):
+        """
+        Stop sending, submitted sends that are not done are cancelled
+        """
+        tasks = list(self.sending)
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for queue in self.queues.values():
+            for item in queue:
+                item.future.cancel()
+        self.queues.clear()
+
+    def _push(self, item: _Send):
+        heapq.heappush(self.queues.setdefault(item.chat_id, []), item)
+        self.wakeup.set()
+
+    def _pop(self, item: _Send):
+        queue = self.queues[item.chat_id]
+        heapq.heappop(queue)
+        if not queue:
+            del self.queues[item.chat_id]
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets = {
+                    key: value
+                    for key, value in self.buckets.items()
+                    if not value.is_idle(now)
+                }
+            if chat_id < 0:
+                bucket = TokenBucket.full(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket.full(self.chat_rate, self.chat_burst, now)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float) -> tuple[_Send | None, float]:
+        """
+        First send in priority order that is allowed to go now,
+        otherwise time until some send is allowed.
+
+        Only the first send of every chat is looked at, the others
+        wait for the same chat bucket
+        """
+        picked = None
+        wait = float("inf")
+
+        for chat_id, queue in self.queues.items():
+            item = queue[0]
+            if picked is not None and picked < item:
+                continue
+
+            item_wait = max(
+                item.not_before - now, self._bucket(chat_id, now).delay(now)
+            )
+            if item_wait <= 0:
+                picked = item
+            else:
+                wait = min(wait, item_wait)
+
+        if picked is not None:
+            return picked, 0.0
+        return None, wait
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+
+            if not self.queues:
+                await self.wakeup.wait()
+                continue
+
+            now = self.clock()
+
+            wait = self.global_bucket.delay(now)
+            item = None
+            if wait <= 0:
+                item, wait = self._pick(now)
+
+            if item is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except TimeoutError:
+                    pass
+                continue
+
+            self._pop(item)
+
+            self.global_bucket.take(now)
+            self._bucket(item.chat_id, now).take(now)
+
+            task = asyncio.create_task(self._send(item))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def _send(self, item: _Send):
+        try:
+            result = await item.send()
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            retry_after = self.retry_after(exc)
+
+            if retry_after is None or item.attempt >= self.max_retries:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+                return
+
+            now = self.clock()
+            delay = retry_after + random.uniform(0, self.backoff * 2**item.attempt)
+
+            logger.warning(
+                "Flood limit for chat %d, retrying in %.1fs", item.chat_id, delay
+            )
+
+            self._bucket(item.chat_id, now).blocked_until = now + retry_after
+            item.attempt += 1
+            item.not_before = now + delay
+            self._push(item)
+        else:
+            if not item.future.done():
+                item.future.set_result(result)
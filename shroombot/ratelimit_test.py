@@ -0,0 +1,102 @@
+"""
+Testing pacing and retries of outgoing sends
+"""
+
+import asyncio
+
+import pytest
+
+from shroombot.ratelimit import Priority, SendScheduler, TokenBucket
+
+
+class FloodError(Exception):
+    pass
+
+
+def test_token_bucket():
+    bucket = TokenBucket.full(rate=2, capacity=2, now=0)
+
+    bucket.take(0)
+    bucket.take(0)
+
+    assert bucket.delay(0) == pytest.approx(0.5)
+    assert bucket.delay(0.5) == 0
+
+    bucket.blocked_until = 3
+    assert bucket.delay(1) == 2
+
+
+@pytest.mark.asyncio
+async def test_scheduler_priority_and_pacing():
+    scheduler = SendScheduler(global_rate=1000, global_burst=1, chat_rate=1000)
+
+    sent = []
+
+    def make_send(name: str):
+        async def _send():
+            sent.append(name)
+            return name
+
+        return _send
+
+    results = await asyncio.gather(
+        scheduler.submit(1, make_send("admin"), Priority.ADMIN),
+        scheduler.submit(2, make_send("user"), Priority.USER),
+    )
+
+    assert results == ["admin", "user"]
+    assert sent == ["user", "admin"]
+
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_retries_flood():
+    scheduler = SendScheduler(
+        retry_after=lambda exc: 0.01 if isinstance(exc, FloodError) else None,
+        backoff=0.01,
+        chat_burst=10,
+    )
+
+    attempts = 0
+
+    async def _flooded():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise FloodError()
+        return "sent"
+
+    async def _broken():
+        raise ValueError()
+
+    assert await scheduler.submit(1, _flooded) == "sent"
+    assert attempts == 3
+
+    with pytest.raises(ValueError):
+        await scheduler.submit(1, _broken)
+
+    await scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_close_cancels_waiting_sends():
+    scheduler = SendScheduler(chat_rate=0.001, chat_burst=1)
+
+    async def _send():
+        return "sent"
+
+    first = asyncio.ensure_future(scheduler.submit(1, _send))
+    second = asyncio.ensure_future(scheduler.submit(1, _send))
+    other = asyncio.ensure_future(scheduler.submit(2, _send))
+
+    # Chat 1 is out of tokens after the first send
+    assert await first == "sent"
+    assert await other == "sent"
+    assert not second.done()
+
+    await scheduler.close()
+
+    with pytest.raises(asyncio.CancelledError):
+        await second
+    assert not scheduler.queues
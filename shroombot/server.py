@@ -6,10 +6,23 @@ Implementation of the core logic
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
 
-from aiotdlib.api import TextEntity
+from shroombot.metrics import (
+    ADMIN_TO_USER,
+    FAILED_COUNTER,
+    MESSAGES_COUNTER,
+    USER_TO_ADMIN,
+    message_type,
+    timed,
+)
 
-from shroombot.anonymizer import Anonymizer
+# Not imported at runtime so that the module loads without aiotdlib and cryptography
+if TYPE_CHECKING:
+    from aiotdlib.api import TextEntity
+
+    from shroombot.anonymizer import MappingStore
+    from shroombot.message_index import MessageIndex
 
 logger = logging.getLogger(__name__)
 
@@ -17,19 +30,23 @@ logger = logging.getLogger(__name__)
 @dataclass
 class MyTextMessage:
     text: str
-    entities: list[TextEntity] = field(default_factory=list)
+    entities: list["TextEntity"] = field(default_factory=list)
 
 
 @dataclass
 class MyPhotoMessage:
     id: str
     caption: str | None
+    width: int = 0
+    height: int = 0
 
 
 @dataclass
 class MyStickerMessage:
     id: str
     emoji: str
+    width: int = 0
+    height: int = 0
 
 
 @dataclass
@@ -38,7 +55,57 @@ class MyDocumentMessage:
     caption: str | None
 
 
-MyMessageType = MyTextMessage | MyPhotoMessage | MyDocumentMessage | MyStickerMessage
+@dataclass
+class MyVideoMessage:
+    id: str
+    caption: str | None
+    width: int = 0
+    height: int = 0
+    duration: int = 0
+
+
+@dataclass
+class MyAnimationMessage:
+    id: str
+    caption: str | None
+    width: int = 0
+    height: int = 0
+    duration: int = 0
+
+
+@dataclass
+class MyVoiceMessage:
+    id: str
+    caption: str | None
+    duration: int = 0
+    waveform: str | bytes = b""
+
+
+@dataclass
+class MyLocationMessage:
+    latitude: float
+    longitude: float
+
+
+@dataclass
+class MyContactMessage:
+    phone_number: str
+    first_name: str
+    last_name: str = ""
+    vcard: str = ""
+
+
+MyMessageType = (
+    MyTextMessage
+    | MyPhotoMessage
+    | MyDocumentMessage
+    | MyStickerMessage
+    | MyVideoMessage
+    | MyAnimationMessage
+    | MyVoiceMessage
+    | MyLocationMessage
+    | MyContactMessage
+)
 
 
 class TelegramApi(ABC):
@@ -52,9 +119,12 @@ class TelegramApi(ABC):
         self,
         chat_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
+
+        Returns id of the sent message if known
         """
         ...
 
@@ -64,9 +134,12 @@ class TelegramApi(ABC):
         chat_id: int,
         topic_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
+
+        Returns id of the sent message if known
         """
         ...
 
@@ -79,12 +152,61 @@ class TelegramApi(ABC):
         """
         ...
 
+    async def send_messages(
+        self,
+        chat_id: int,
+        messages: list[MyMessageType],
+        reply_to: int | None = None,
+    ) -> list[int | None]:
+        """
+        Send several messages to specific chat.
+
+        Implementations can group them into albums.
+        Returns ids of the sent messages
+        """
+        return [
+            await self.send_message(chat_id, message, reply_to if idx == 0 else None)
+            for idx, message in enumerate(messages)
+        ]
+
+    async def send_topic_messages(
+        self,
+        chat_id: int,
+        topic_id: int,
+        messages: list[MyMessageType],
+        reply_to: int | None = None,
+    ) -> list[int | None]:
+        """
+        Send several messages to specific chat and thread.
+
+        Implementations can group them into albums.
+        Returns ids of the sent messages
+        """
+        return [
+            await self.send_topic_message(
+                chat_id, topic_id, message, reply_to if idx == 0 else None
+            )
+            for idx, message in enumerate(messages)
+        ]
+
+    @abstractmethod
+    async def edit_message(self, chat_id: int, message_id: int, message: MyMessageType):
+        """
+        Replace content of the sent message
+        """
+        ...
+
 
 class NameRandomizer(ABC):
     @abstractmethod
     def get_random_topic_name(self) -> str:
         ...
 
+    async def close(self):
+        """
+        Persist the state, if there is any
+        """
+
 
 @dataclass
 class ServerData:
@@ -93,44 +215,132 @@ class ServerData:
     """
 
     telegram: TelegramApi
-    anonymizer: Anonymizer
+    anonymizer: "MappingStore"
     randomizer: NameRandomizer
     admin_chat_id: int
+    # Links between user and admin messages, not tracked if not set
+    messages: "MessageIndex | None" = None
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def merge_text_messages(
+    messages: list[MyTextMessage], separator: str = "\n"
+) -> MyTextMessage:
+    """
+    Join text messages into one, shifting entities accordingly
+    """
+    text = ""
+    entities = []
+
+    for message in messages:
+        if text:
+            text += separator
+
+        # Telegram entity offsets are in utf-16 code units
+        offset = _utf16_len(text)
+        for entity in message.entities:
+            entities.append(entity.copy(update={"offset": entity.offset + offset}))
+
+        text += message.text
+
+    return MyTextMessage(text=text, entities=entities)
+
+
+def _link_messages(  # pylint: disable=too-many-arguments
+    data: ServerData,
+    chat_id: int,
+    topic_id: int,
+    message_ids: list[int] | None,
+    sent_ids: list[int | None],
+    from_admin: bool,
+):
+    """
+    Remember which sent messages correspond to the received ones
+    """
+    if data.messages is None or message_ids is None:
+        return
+
+    data.messages.link_sent(chat_id, topic_id, message_ids, sent_ids, from_admin)
 
 
 async def _process_admin_message(
-    data: ServerData, thread_id: int, message: MyMessageType
+    data: ServerData,
+    thread_id: int,
+    messages: list[MyMessageType],
+    message_ids: list[int] | None = None,
+    reply_to: int | None = None,
 ):
     """
     Function that handles messages sent by admins
     """
-    chat_id = data.anonymizer.get_chat_id(thread_id)
+    msg_type = message_type(messages)
+
+    with timed("lookup", msg_type, ADMIN_TO_USER):
+        chat_id = await data.anonymizer.find_chat_id(thread_id)
 
     # Chat id must already be known if admin replies to a message
     if chat_id is None:
         logger.error("Chat id for thread %d not found", thread_id)
         return
 
-    await data.telegram.send_message(chat_id, message)
+    # Reply to the user message the admin replied to
+    user_reply_to = None
+    if data.messages is not None and reply_to is not None:
+        link = data.messages.admin_to_user(reply_to)
+        if link is not None and link.user_chat_id == chat_id:
+            user_reply_to = link.user_message_id
 
+    with timed("send", msg_type, ADMIN_TO_USER):
+        sent_ids = await data.telegram.send_messages(chat_id, messages, user_reply_to)
 
-async def _process_user_message(data: ServerData, chat_id: int, message: MyMessageType):
+    _link_messages(data, chat_id, thread_id, message_ids, sent_ids, from_admin=True)
+
+
+async def _process_user_message(
+    data: ServerData,
+    chat_id: int,
+    messages: list[MyMessageType],
+    message_ids: list[int] | None = None,
+    reply_to: int | None = None,
+):
     """
     Function that handles messages sent by users
     """
-    topic_id = data.anonymizer.get_topic_id(chat_id)
 
+    msg_type = message_type(messages)
+
+    async def _create_topic() -> int:
+        with timed("create_topic", msg_type, USER_TO_ADMIN):
+            return await data.telegram.create_topic(
+                data.admin_chat_id, data.randomizer.get_random_topic_name()
+            )
+
+    with timed("lookup", msg_type, USER_TO_ADMIN):
+        topic_id = await data.anonymizer.find_topic_id(chat_id)
+
+    # Messages of the new user arriving together must end up in one topic
     if topic_id is None:
-        topic_id = await data.telegram.create_topic(
-            data.admin_chat_id, data.randomizer.get_random_topic_name()
+        topic_id = await data.anonymizer.get_or_create_topic_id(chat_id, _create_topic)
+
+    # Reply to the admin message the user replied to
+    admin_reply_to = None
+    if data.messages is not None and reply_to is not None:
+        link = data.messages.user_to_admin(chat_id, reply_to)
+        if link is not None:
+            admin_reply_to = link.admin_message_id
+
+    with timed("send", msg_type, USER_TO_ADMIN):
+        sent_ids = await data.telegram.send_topic_messages(
+            data.admin_chat_id, topic_id, messages, admin_reply_to
         )
 
-        await data.anonymizer.register_chat_topic_link(chat_id, topic_id)
-
-    await data.telegram.send_topic_message(data.admin_chat_id, topic_id, message)
+    _link_messages(data, chat_id, topic_id, message_ids, sent_ids, from_admin=False)
 
-    if isinstance(message, MyTextMessage):
-        if "/start" in message.text:
+    for message in messages:
+        if isinstance(message, MyTextMessage) and "/start" in message.text:
             await data.telegram.send_message(
                 chat_id,
                 MyTextMessage(
@@ -145,16 +355,119 @@ async def _process_user_message(data: ServerData, chat_id: int, message: MyMessa
                 topic_id,
                 MyTextMessage("Приветственное сообщение показано"),
             )
+            break
+
 
+def conversation_key(data: ServerData, chat_id: int, thread_id: int) -> tuple[str, int]:
+    """
+    Key of the conversation the message belongs to.
+
+    Messages with the same key must be processed in order
+    """
+    if chat_id == data.admin_chat_id:
+        return ("topic", thread_id)
+    return ("chat", chat_id)
 
-async def process_incomming_message(
-    data: ServerData, chat_id: int, thread_id: int, message: MyMessageType
+
+def edit_thread_id(data: ServerData, chat_id: int, message_id: int) -> int | None:
+    """
+    Thread of the edited message for its conversation key,
+    None if the admin message is not known
+    """
+    if chat_id != data.admin_chat_id:
+        return 0
+    if data.messages is None:
+        return None
+
+    link = data.messages.admin_to_user(message_id)
+    return None if link is None else link.topic_id
+
+
+async def process_incomming_messages(  # pylint: disable=too-many-arguments
+    data: ServerData,
+    chat_id: int,
+    thread_id: int,
+    messages: list[MyMessageType],
+    message_ids: list[int] | None = None,
+    reply_to: int | None = None,
 ):
+    """
+    Process messages that arrived together (album or burst) in one chat and thread
+
+    message_ids are ids of the received messages, reply_to is id
+    of the message the first one replies to
+    """
+    msg_type = message_type(messages)
+    direction = ADMIN_TO_USER if chat_id == data.admin_chat_id else USER_TO_ADMIN
+
     try:
-        if chat_id == data.admin_chat_id:
-            await _process_admin_message(data, thread_id, message)
-        else:
-            await _process_user_message(data, chat_id, message)
+        with timed("total", msg_type, direction):
+            if chat_id == data.admin_chat_id:
+                await _process_admin_message(
+                    data, thread_id, messages, message_ids, reply_to
+                )
+            else:
+                await _process_user_message(
+                    data, chat_id, messages, message_ids, reply_to
+                )
     except Exception:
+        FAILED_COUNTER.labels(msg_type, direction).inc(len(messages))
         logger.exception("Error during processing incomming message")
         raise
+
+    MESSAGES_COUNTER.labels(msg_type, direction).inc(len(messages))
+
+
+async def process_incomming_message(  # pylint: disable=too-many-arguments
+    data: ServerData,
+    chat_id: int,
+    thread_id: int,
+    message: MyMessageType,
+    message_id: int | None = None,
+    reply_to: int | None = None,
+):
+    await process_incomming_messages(
+        data,
+        chat_id,
+        thread_id,
+        [message],
+        None if message_id is None else [message_id],
+        reply_to,
+    )
+
+
+async def process_edited_message(
+    data: ServerData, chat_id: int, message_id: int, message: MyMessageType
+):
+    """
+    Propagate edit of the message to its copy on the other side
+    """
+    if data.messages is None:
+        return
+
+    if chat_id == data.admin_chat_id:
+        link = data.messages.admin_to_user(message_id)
+        if link is None or not link.from_admin:
+            return
+        target_chat_id, target_message_id = link.user_chat_id, link.user_message_id
+    else:
+        link = data.messages.user_to_admin(chat_id, message_id)
+        if link is None or link.from_admin:
+            return
+        target_chat_id, target_message_id = data.admin_chat_id, link.admin_message_id
+
+    await data.telegram.edit_message(target_chat_id, target_message_id, message)
+
+
+def record_sent_message_id(
+    data: ServerData, chat_id: int, old_message_id: int, new_message_id: int
+):
+    """
+    Sent messages get temporary ids, the final one arrives later
+    """
+    if data.messages is None:
+        return
+
+    data.messages.replace_message_id(
+        chat_id == data.admin_chat_id, chat_id, old_message_id, new_message_id
+    )
@@ -2,20 +2,25 @@
 Testing of the primary server functionality
 """
 
+import asyncio
 import os
 from tempfile import TemporaryDirectory
 
 import pytest
 from cryptography.fernet import Fernet
+from prometheus_client import REGISTRY
 
 from shroombot.anonymizer import Anonymizer
+from shroombot.message_index import MessageIndex
 from shroombot.server import (
     MyMessageType,
     MyTextMessage,
     NameRandomizer,
     ServerData,
     TelegramApi,
+    process_edited_message,
     process_incomming_message,
+    record_sent_message_id,
 )
 
 
@@ -25,29 +30,50 @@ class MockTelegramApi(TelegramApi):
     ):
         self.topic_names = topic_names
         self.chats = chats
+        # Message id -> (chat id, topic id, position in the topic)
+        self.sent: dict[int, tuple[int, int, int]] = {}
+        self.replies: dict[int, int] = {}
+
+    def _send(
+        self, chat_id: int, topic_id: int, message: MyMessageType, reply_to: int | None
+    ) -> int:
+        assert isinstance(message, MyTextMessage)
+        self.chats[chat_id][topic_id].append(message.text)
+
+        message_id = 1000 + len(self.sent)
+        self.sent[message_id] = (chat_id, topic_id, len(self.chats[chat_id][topic_id]))
+        if reply_to is not None:
+            self.replies[message_id] = reply_to
+        return message_id
 
     async def send_message(
         self,
         chat_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
         """
-        assert isinstance(message, MyTextMessage)
-        self.chats[chat_id][0].append(message.text)
+        return self._send(chat_id, 0, message, reply_to)
 
     async def send_topic_message(
         self,
         chat_id: int,
         topic_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
         """
+        return self._send(chat_id, topic_id, message, reply_to)
+
+    async def edit_message(self, chat_id: int, message_id: int, message: MyMessageType):
         assert isinstance(message, MyTextMessage)
-        self.chats[chat_id][topic_id].append(message.text)
+        sent_chat_id, topic_id, position = self.sent[message_id]
+        assert sent_chat_id == chat_id
+        self.chats[chat_id][topic_id][position - 1] = message.text
 
     async def create_topic(self, chat_id: int, title: str) -> int:
         """
@@ -122,3 +148,114 @@ async def test_server_default():
             1: {0: ["Hey! I need help!", "No problem!"]},
             2: {0: ["I need money!", "Here you go!"]},
         }
+
+
+@pytest.mark.asyncio
+async def test_server_concurrent_first_contact():
+    topic_names = dict()
+    chats = {
+        0: {0: []},  # admin chat
+        1: {0: []},
+    }
+
+    class SlowTelegramApi(MockTelegramApi):
+        async def create_topic(self, chat_id: int, title: str) -> int:
+            await asyncio.sleep(0.01)
+            return await super().create_topic(chat_id, title)
+
+    with TemporaryDirectory() as temp_dir:
+        mapping_file = os.path.join(temp_dir, "mapping.bin")
+
+        anonymizer = await Anonymizer.from_file(mapping_file, Fernet.generate_key())
+
+        server_data = ServerData(
+            telegram=SlowTelegramApi(topic_names, chats),
+            randomizer=MockRandomizer(),
+            anonymizer=anonymizer,
+            admin_chat_id=0,
+        )
+
+        await asyncio.gather(
+            *(
+                process_incomming_message(server_data, 1, 0, MyTextMessage(text))
+                for text in ["one", "two", "three"]
+            )
+        )
+
+        # Only one topic created for the user
+        assert topic_names == {1: "Name1"}
+        assert sorted(chats[0][1]) == ["one", "three", "two"]
+        assert anonymizer.journal_records == 1
+        assert not anonymizer.pending_topics
+
+        # Pipeline stages are recorded
+        assert (
+            REGISTRY.get_sample_value(
+                "shroombot_stage_seconds_count",
+                {
+                    "stage": "create_topic",
+                    "message_type": "MyTextMessage",
+                    "direction": "user_to_admin",
+                },
+            )
+            or 0
+        ) >= 1
+        assert (REGISTRY.get_sample_value("shroombot_register_seconds_count") or 0) >= 1
+
+
+@pytest.mark.asyncio
+async def test_server_replies_and_edits():
+    chats = {
+        0: {0: []},  # admin chat
+        1: {0: []},
+    }
+
+    with TemporaryDirectory() as temp_dir:
+        mapping_file = os.path.join(temp_dir, "mapping.bin")
+        encryption_key = Fernet.generate_key()
+
+        telegram = MockTelegramApi({}, chats)
+        server_data = ServerData(
+            telegram=telegram,
+            randomizer=MockRandomizer(),
+            anonymizer=await Anonymizer.from_file(mapping_file, encryption_key),
+            admin_chat_id=0,
+            messages=await MessageIndex.from_file(
+                mapping_file + ".messages", encryption_key
+            ),
+        )
+
+        # User message 1 is copied to the topic as 1000
+        await process_incomming_message(
+            server_data, 1, 0, MyTextMessage("question"), message_id=1
+        )
+        # Admin reply 2000 is copied to the user as 1001
+        await process_incomming_message(
+            server_data, 0, 1, MyTextMessage("answer"), message_id=2000, reply_to=1000
+        )
+        assert telegram.replies == {1001: 1}
+
+        # Sent message got its final id
+        record_sent_message_id(server_data, 1, 1001, 3)
+
+        # User replies to the admin answer
+        await process_incomming_message(
+            server_data, 1, 0, MyTextMessage("thanks"), message_id=4, reply_to=3
+        )
+        assert telegram.replies[1002] == 2000
+
+        # Edits are mirrored only from the side the message was written on
+        await process_edited_message(server_data, 1, 1, MyTextMessage("question!"))
+        await process_edited_message(server_data, 0, 1000, MyTextMessage("ignored"))
+
+        assert chats[0][1] == ["question!", "thanks"]
+        assert chats[1][0] == ["answer"]
+
+        await server_data.messages.close()
+
+        # Links survive restart
+        messages = await MessageIndex.from_file(
+            mapping_file + ".messages", encryption_key
+        )
+        link = messages.user_to_admin(1, 3)
+        assert link is not None and link.admin_message_id == 2000
@@ -0,0 +1,714 @@
+"""
+Sharded deployment: one front process and several worker processes
+
+The front process receives telegram updates and routes them by a stable hash
+of the user chat id to worker processes. Admin messages are routed by topic id:
+the front learns which shard owns a topic from the topics every shard reports
+on start and from the topics shards create through it.
+
+Every worker owns its own anonymizer shard file, message index and spool
+and processes messages with its own dispatcher. Workers also encode messages
+into telegram requests, the front process only executes the requests
+with its client, over a separate channel, so that backpressure
+of the work channel never blocks call results.
+
+Workers confirm messages once they spooled them. Workers that exit are
+restarted, messages they did not confirm and messages routed to them
+meanwhile wait in the spool of the front. The front stops the bot
+once workers exited too often.
+
+On shutdown workers drain their queues and keep spooling messages that arrive
+meanwhile. Messages that arrive after workers stopped are spooled by the front
+and routed to the workers on the next start.
+
+The number of shards must not change for existing shard files.
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import pickle
+import socket
+import struct
+import time
+import zlib
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass, field
+from typing import Any
+
+from shroombot.anonymizer import open_mapping_store
+from shroombot.dispatcher import Dispatcher
+from shroombot.keyring import EncryptionKey, rotate_keys
+from shroombot.message_index import MessageIndex
+from shroombot.server import (
+    MyMessageType,
+    NameRandomizer,
+    ServerData,
+    conversation_key,
+    edit_thread_id,
+    process_edited_message,
+    record_sent_message_id,
+)
+from shroombot.shroomgen import ShroomNameRandomizer, default_shroom_names
+from shroombot.spool import Spool, SpoolEntry, open_spool
+from shroombot.telegram import REQUEST_METHODS, EncodingTelegramApi, TelegramRequest
+
+logger = logging.getLogger(__name__)
+
+# Length of a pickled frame
+_FRAME = struct.Struct("<I")
+
+
+class RemoteCallError(RuntimeError):
+    """
+    Telegram call executed by the front process failed
+    """
+
+
+class ShardUnavailable(RuntimeError):
+    """
+    Worker of the shard exited and is not restarted yet
+    """
+
+
+def shard_of(chat_id: int, num_shards: int) -> int:
+    """
+    Stable across processes and restarts, unlike hash()
+    """
+    return zlib.crc32(chat_id.to_bytes(8, "little", signed=True)) % num_shards
+
+
+def shard_path(file_path: str, shard: int) -> str:
+    return f"{file_path}.shard{shard}"
+
+
+def front_spool_path(file_path: str) -> str:
+    return file_path + ".front.spool"
+
+
+@dataclass
+class _Channel:
+    """
+    Stream of pickled tuples between the front and a worker
+    """
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    @staticmethod
+    async def from_socket(sock: socket.socket) -> "_Channel":
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return _Channel(reader, writer)
+
+    async def send(self, *message: Any):
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer.write(_FRAME.pack(len(payload)) + payload)
+        await self.writer.drain()
+
+    async def recv(self) -> tuple | None:
+        """
+        Next message, None once the other side is closed
+        """
+        try:
+            (size,) = _FRAME.unpack(await self.reader.readexactly(_FRAME.size))
+            return pickle.loads(await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+class ProxyTelegramApi(EncodingTelegramApi):
+    """
+    Telegram api of a worker, requests are executed by the front process
+    """
+
+    def __init__(self, channel: _Channel):
+        self.channel = channel
+        self.calls: dict[int, asyncio.Future] = {}
+        self.last_call = 0
+
+    async def execute(self, request: TelegramRequest) -> Any:
+        self.last_call += 1
+        call_id = self.last_call
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = future
+        try:
+            await self.channel.send("call", call_id, request)
+            return await future
+        finally:
+            del self.calls[call_id]
+
+    def resolve(self, call_id: int, result: Any, error: str | None):
+        future = self.calls.get(call_id)
+        if future is None or future.done():
+            return
+
+        if error is not None:
+            future.set_exception(RemoteCallError(error))
+        else:
+            future.set_result(result)
+
+
+@dataclass
+class WorkerConfig:  # pylint: disable=too-many-instance-attributes
+    shard: int
+    num_shards: int
+    mapping_file: str
+    encryption_key: EncryptionKey
+    admin_chat_id: int
+
+    max_chat_pending: int = 100
+    max_pending: int = 10000
+    message_index_size: int = 100_000
+    # Mapping storage: file, sqlite or paged
+    storage: str = "file"
+
+    # Shroom names from a part of the pool that belongs to the shard by default
+    randomizer: Callable[[], NameRandomizer] | None = None
+
+
+def _make_randomizer(config: WorkerConfig, file_path: str) -> NameRandomizer:
+    if config.randomizer is not None:
+        return config.randomizer()
+
+    return ShroomNameRandomizer.from_file(
+        file_path + ".names", default_shroom_names(), config.shard, config.num_shards
+    )
+
+
+def _check_shard(chats: Iterable[int], config: WorkerConfig):
+    misplaced = sum(
+        1 for chat_id in chats if shard_of(chat_id, config.num_shards) != config.shard
+    )
+    if misplaced:
+        raise ValueError(
+            f"{misplaced} chats of shard {config.shard} belong to other shards,"
+            f" number of shards must not change"
+        )
+
+
+async def _worker_main(  # pylint: disable=too-many-locals,too-many-statements
+    config: WorkerConfig, work_sock: socket.socket, calls_sock: socket.socket
+):
+    work = await _Channel.from_socket(work_sock)
+    calls = await _Channel.from_socket(calls_sock)
+
+    file_path = shard_path(config.mapping_file, config.shard)
+
+    anonymizer = await open_mapping_store(
+        file_path, config.encryption_key, config.storage
+    )
+    chats, topics = await anonymizer.columns()
+    _check_shard(chats, config)
+
+    messages = await MessageIndex.from_file(
+        file_path + ".messages",
+        config.encryption_key,
+        capacity=config.message_index_size,
+    )
+
+    proxy = ProxyTelegramApi(calls)
+    data = ServerData(
+        telegram=proxy,
+        anonymizer=anonymizer,
+        randomizer=_make_randomizer(config, file_path),
+        admin_chat_id=config.admin_chat_id,
+        messages=messages,
+    )
+    dispatcher = Dispatcher(
+        max_key_pending=config.max_chat_pending, max_pending=config.max_pending
+    )
+    spool = await open_spool(
+        file_path + ".spool", config.encryption_key, data, dispatcher
+    )
+
+    async def _serve_results():
+        while (message := await calls.recv()) is not None:
+            proxy.resolve(*message[1:])
+
+    results = asyncio.create_task(_serve_results())
+
+    await calls.send("topics", topics)
+
+    rotation_stopped = asyncio.Event()
+    rotation = None
+
+    async def _drain():
+        spool.stop_retrying()
+        # Rotation continues from the start on the next run
+        rotation_stopped.set()
+        if rotation is not None:
+            await rotation
+        await dispatcher.join()
+
+    # Messages are spooled for the next start once draining started
+    draining = False
+
+    try:
+        while (message := await work.recv()) is not None:
+            kind, chat_id, *args = message
+
+            if kind == "start":
+                await spool.start()
+                continue
+            if kind == "drain":
+                draining = True
+                await _drain()
+                await calls.send("drained")
+                continue
+            if kind in ("messages", "hold"):
+                delivery, *args = args
+                await spool.submit(chat_id, *args, hold=draining or kind == "hold")
+                await calls.send("received", delivery)
+                continue
+            if kind == "rotate":
+                steps = anonymizer.rotation_steps() + messages.rotation_steps()
+                steps += spool.rotation_steps()
+                rotation = asyncio.create_task(rotate_keys(steps, rotation_stopped))
+                continue
+            if kind in ("edit", "hold_edit"):
+                message_id, content = args
+                thread_id = edit_thread_id(data, chat_id, message_id)
+                if thread_id is None:
+                    continue
+                if kind == "hold_edit":
+                    await spool.hold_edit(chat_id, thread_id, message_id, content)
+                    continue
+                job = functools.partial(
+                    process_edited_message, data, chat_id, message_id, content
+                )
+            elif kind == "sent":
+                record_sent_message_id(data, chat_id, *args)
+                continue
+            else:
+                break
+
+            await dispatcher.submit(conversation_key(data, chat_id, thread_id), job)
+
+        await _drain()
+        await calls.send("stopped", time.process_time())
+    finally:
+        await spool.close()
+        await anonymizer.close()
+        await messages.close()
+        await data.randomizer.close()
+        results.cancel()
+        work.close()
+        calls.close()
+
+
+def run_worker(
+    config: WorkerConfig, work_sock: socket.socket, calls_sock: socket.socket
+):
+    """
+    Entrypoint of a worker process
+    """
+    asyncio.run(_worker_main(config, work_sock, calls_sock))
+
+
+@dataclass
+class _Worker:  # pylint: disable=too-many-instance-attributes
+    config: WorkerConfig
+    process: Any
+    work: _Channel
+    calls: _Channel
+    server: asyncio.Task | None = None
+    # Resolved once the worker finished queued messages
+    drained: asyncio.Future | None = None
+    # Messages the worker did not confirm to have spooled, by delivery id
+    unconfirmed: dict[int, tuple] = field(default_factory=dict)
+    alive: bool = True
+    # Cpu seconds the worker spent, reported when it stops
+    cpu_time: float = 0.0
+
+
+@dataclass
+class ShardedFront:  # pylint: disable=too-many-instance-attributes
+    """
+    Routes incomming messages to worker processes and runs their telegram requests
+    """
+
+    telegram: EncodingTelegramApi
+    admin_chat_id: int
+    mp_context: Any = field(default=None, repr=False)
+    workers: list[_Worker] = field(default_factory=list)
+    # Topic id -> shard that owns the topic
+    topic_shards: dict[int, int] = field(default_factory=dict)
+
+    running: set[asyncio.Task] = field(default_factory=set, repr=False)
+    # Workers are stopped
+    closed: bool = False
+    # Messages that arrived after workers stopped or while a worker was down
+    spool: Spool | None = field(default=None, repr=False)
+    last_delivery: int = 0
+
+    # Shards of workers that exited while running
+    exited: asyncio.Queue[int] = field(default_factory=asyncio.Queue, repr=False)
+    # Restarts of all workers, the bot stops once there were more
+    max_restarts: int = 3
+    restarts: int = 0
+    # Held by restarts, so that close stops the restarted worker
+    restart_lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    @staticmethod
+    async def start(
+        telegram: EncodingTelegramApi,
+        configs: list[WorkerConfig],
+        context: str = "spawn",
+    ) -> "ShardedFront":
+        """
+        Start worker processes and wait until they report their topics
+        """
+        front = ShardedFront(
+            telegram, configs[0].admin_chat_id, multiprocessing.get_context(context)
+        )
+
+        async def _run_now(_: SpoolEntry, job: Callable[[], Awaitable[None]]):
+            await job()
+
+        front.spool = await Spool.from_file(
+            front_spool_path(configs[0].mapping_file),
+            configs[0].encryption_key,
+            front._forward,  # pylint: disable=protected-access
+            _run_now,
+            # Retried until the worker of the shard is restarted
+            max_attempts=10,
+        )
+
+        spawn = front._spawn  # pylint: disable=protected-access
+        front.workers = list(await asyncio.gather(*map(spawn, configs)))
+        return front
+
+    async def _spawn(self, config: WorkerConfig) -> _Worker:
+        """
+        Start a worker process and wait until it reports its topics
+        """
+        work_sock, worker_work_sock = socket.socketpair()
+        calls_sock, worker_calls_sock = socket.socketpair()
+
+        process = self.mp_context.Process(
+            target=run_worker,
+            args=(config, worker_work_sock, worker_calls_sock),
+            name=f"shroombot-shard-{config.shard}",
+            daemon=True,
+        )
+        process.start()
+        worker_work_sock.close()
+        worker_calls_sock.close()
+
+        worker = _Worker(
+            config,
+            process,
+            await _Channel.from_socket(work_sock),
+            await _Channel.from_socket(calls_sock),
+        )
+
+        started = asyncio.get_running_loop().create_future()
+        worker.server = asyncio.create_task(self._serve_calls(worker, started))
+        await started
+        return worker
+
+    def shard_for(self, chat_id: int, thread_id: int) -> int | None:
+        if chat_id == self.admin_chat_id:
+            return self.topic_shards.get(thread_id)
+        return shard_of(chat_id, len(self.workers))
+
+    async def submit(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        thread_id: int,
+        messages: list[MyMessageType],
+        message_ids: list[int] | None = None,
+        reply_to: int | None = None,
+    ):
+        """
+        Route messages to the worker that owns the conversation
+        """
+        await self._route(
+            "messages", chat_id, thread_id, messages, message_ids, reply_to
+        )
+
+    async def _route(self, kind: str, chat_id: int, thread_id: int, *args: Any):
+        assert self.spool is not None
+        if self.closed:
+            await self.spool.submit(chat_id, thread_id, *args, hold=True)
+            return
+
+        try:
+            await self._deliver(kind, chat_id, thread_id, *args)
+        except ShardUnavailable as exc:
+            logger.warning("%s, message of chat %d is spooled", exc, chat_id)
+            await self.spool.submit(chat_id, thread_id, *args, hold=kind == "hold")
+
+    async def _deliver(self, kind: str, chat_id: int, thread_id: int, *args: Any):
+        """
+        Send messages to the worker that owns the conversation,
+        they are kept until the worker confirms them
+        """
+        shard = self.shard_for(chat_id, thread_id)
+        if shard is None:
+            logger.error("Shard of thread %d not found", thread_id)
+            return
+
+        self.last_delivery += 1
+        delivery = self.last_delivery
+        worker = self.workers[shard]
+        worker.unconfirmed[delivery] = (kind, chat_id, thread_id, *args)
+        try:
+            await self._send(shard, kind, chat_id, delivery, thread_id, *args)
+        except ShardUnavailable:
+            if worker.unconfirmed.pop(delivery, None) is None:
+                # Spooled once the worker exited
+                return
+            raise
+
+    async def _send(self, shard: int, *message: Any):
+        worker = self.workers[shard]
+        if not worker.alive:
+            raise ShardUnavailable(f"Shard {shard} is down")
+
+        try:
+            await worker.work.send(*message)
+        except (ConnectionError, OSError) as exc:
+            raise ShardUnavailable(f"Shard {shard} is down") from exc
+
+    async def edit(self, chat_id: int, message_id: int, message: MyMessageType):
+        if self.closed:
+            await self.hold_edit(chat_id, message_id, message)
+            return
+
+        # Owner of an admin message is not known, shards ignore unknown ids
+        for shard in self._shards_of_chat(chat_id):
+            try:
+                await self._send(shard, "edit", chat_id, message_id, message)
+            except ShardUnavailable as exc:
+                logger.warning("%s, edit in chat %d is spooled", exc, chat_id)
+                assert self.spool is not None
+                await self.spool.hold_edit(chat_id, 0, message_id, message)
+
+    async def hold_edit(self, chat_id: int, message_id: int, message: MyMessageType):
+        """
+        Let the owning worker spool the edit for processing after restart
+        """
+        assert self.spool is not None
+        if self.closed:
+            # Thread is looked up by the worker once the edit is routed
+            await self.spool.hold_edit(chat_id, 0, message_id, message)
+            return
+
+        for shard in self._shards_of_chat(chat_id):
+            try:
+                await self._send(shard, "hold_edit", chat_id, message_id, message)
+            except ShardUnavailable:
+                await self.spool.hold_edit(chat_id, 0, message_id, message)
+
+    async def sent(self, chat_id: int, old_message_id: int, new_message_id: int):
+        if self.closed:
+            logger.warning("Id of message sent to chat %d arrived after stop", chat_id)
+            return
+
+        for shard in self._shards_of_chat(chat_id):
+            try:
+                await self._send(shard, "sent", chat_id, old_message_id, new_message_id)
+            except ShardUnavailable as exc:
+                logger.warning("%s, id of message sent to chat %d lost", exc, chat_id)
+
+    async def hold(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        thread_id: int,
+        messages: list[MyMessageType],
+        message_ids: list[int] | None = None,
+        reply_to: int | None = None,
+    ):
+        """
+        Let the owning worker spool messages for processing after restart
+        """
+        await self._route("hold", chat_id, thread_id, messages, message_ids, reply_to)
+
+    async def start_processing(self):
+        """
+        Let workers process spooled messages, once telegram is connected,
+        then route messages the front spooled
+        """
+        for worker in self.workers:
+            await worker.work.send("start", 0)
+
+        assert self.spool is not None
+        await self.spool.start()
+
+    async def _forward(self, entry: SpoolEntry):
+        if entry.edit_of is not None:
+            await self.edit(entry.chat_id, entry.edit_of, entry.messages[0])
+            return
+
+        # Failures are retried by the spool until the worker is back
+        await self._deliver(
+            "messages",
+            entry.chat_id,
+            entry.thread_id,
+            entry.messages,
+            entry.message_ids,
+            entry.reply_to,
+        )
+
+    async def rotate(self, _: asyncio.Event | None = None):
+        """
+        Start key rotation in workers, they rotate until they are stopped
+        """
+        for shard in range(len(self.workers)):
+            try:
+                await self._send(shard, "rotate", 0)
+            except ShardUnavailable as exc:
+                logger.warning("%s, its keys are rotated on the next run", exc)
+
+    async def drain(self):
+        """
+        Let workers finish queued messages, messages routed meanwhile
+        are spooled by the workers
+        """
+        loop = asyncio.get_running_loop()
+        for shard, worker in enumerate(self.workers):
+            worker.drained = loop.create_future()
+            try:
+                await self._send(shard, "drain", 0)
+            except ShardUnavailable:
+                # Nothing queued, the restarted worker drains when stopped
+                worker.drained = None
+
+        await asyncio.gather(
+            *(worker.drained for worker in self.workers if worker.drained is not None)
+        )
+
+    async def supervise(self):
+        """
+        Restart workers that exit while the front runs, fails once
+        they exited more than max_restarts times, so that the bot stops
+        """
+        while True:
+            shard = await self.exited.get()
+
+            async with self.restart_lock:
+                if self.closed:
+                    return
+
+                self.restarts += 1
+                if self.restarts > self.max_restarts:
+                    raise RuntimeError(
+                        f"Shard {shard} exited, workers exited {self.restarts} times"
+                    )
+
+                logger.warning("Restarting shard %d", shard)
+                old = self.workers[shard]
+                await asyncio.to_thread(old.process.join)
+                old.work.close()
+                old.calls.close()
+
+                worker = await self._spawn(old.config)
+                self.workers[shard] = worker
+
+                assert self.spool is not None
+                if self.spool.started:
+                    await worker.work.send("start", 0)
+
+    async def close(self):
+        """
+        Let workers finish queued messages and stop them,
+        messages that arrive later are spooled by the front
+        """
+        if self.spool is not None:
+            self.spool.stop_retrying()
+
+        self.closed = True
+        async with self.restart_lock:
+            for shard in range(len(self.workers)):
+                try:
+                    await self._send(shard, "stop", 0)
+                except ShardUnavailable:
+                    pass
+
+            for worker in self.workers:
+                await asyncio.to_thread(worker.process.join)
+                if worker.server is not None:
+                    await worker.server
+                worker.work.close()
+                worker.calls.close()
+
+        if self.spool is not None:
+            await self.spool.close()
+
+    def _shards_of_chat(self, chat_id: int) -> list[int]:
+        if chat_id == self.admin_chat_id:
+            return list(range(len(self.workers)))
+        return [shard_of(chat_id, len(self.workers))]
+
+    async def _serve_calls(self, worker: _Worker, started: asyncio.Future):
+        shard = worker.config.shard
+
+        while (message := await worker.calls.recv()) is not None:
+            kind, *args = message
+
+            if kind == "topics":
+                for topic_id in args[0]:
+                    self.topic_shards[topic_id] = shard
+                started.set_result(None)
+                continue
+            if kind == "received":
+                worker.unconfirmed.pop(args[0], None)
+                continue
+            if kind == "drained":
+                if worker.drained is not None and not worker.drained.done():
+                    worker.drained.set_result(None)
+                continue
+            if kind == "stopped":
+                worker.cpu_time = args[0]
+                continue
+
+            call = asyncio.create_task(self._call(shard, worker, *args))
+            self.running.add(call)
+            call.add_done_callback(self.running.discard)
+
+        worker.alive = False
+
+        if not started.done():
+            started.set_exception(RuntimeError(f"Shard {shard} failed to start"))
+            return
+        if worker.drained is not None and not worker.drained.done():
+            worker.drained.set_exception(RuntimeError(f"Shard {shard} exited"))
+
+        if not self.closed:
+            logger.error("Shard %d exited", shard)
+
+        # Messages the worker did not spool
+        assert self.spool is not None
+        unconfirmed, worker.unconfirmed = worker.unconfirmed, {}
+        for kind, chat_id, thread_id, *args in unconfirmed.values():
+            await self.spool.submit(
+                chat_id, thread_id, *args, hold=kind == "hold" or self.closed
+            )
+
+        if not self.closed:
+            self.exited.put_nowait(shard)
+
+    async def _call(
+        self, shard: int, worker: _Worker, call_id: int, request: TelegramRequest
+    ):
+        result, error = None, None
+        try:
+            if request.method not in REQUEST_METHODS:
+                raise ValueError(f"Unknown method {request.method}")
+            result = await self.telegram.execute(request)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            error = repr(exc)
+
+        if request.returns == "topic_id" and result is not None:
+            self.topic_shards[result] = shard
+
+        try:
+            await worker.calls.send("result", call_id, result, error)
+        except (ConnectionError, OSError):
+            logger.warning("Shard %d exited before result of a call", shard)
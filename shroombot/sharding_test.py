@@ -0,0 +1,193 @@
+"""
+Testing of the sharded multi-process mode
+"""
+
+import asyncio
+import os
+from collections import Counter
+from tempfile import TemporaryDirectory
+from typing import Any
+
+import pytest
+from cryptography.fernet import Fernet
+
+from shroombot.benchmark import CountingRandomizer
+from shroombot.benchmark_shards import run_shard_benchmark
+from shroombot.server import MyTextMessage
+from shroombot.sharding import ShardedFront, WorkerConfig, shard_of
+from shroombot.telegram import EncodingTelegramApi, TelegramRequest
+
+
+class RecordingTelegramApi(EncodingTelegramApi):
+    def __init__(self):
+        self.sent: list[tuple[int, int, str]] = []
+        self.num_topics = 0
+
+    async def execute(self, request: TelegramRequest) -> Any:
+        if request.method == "create_forum_topic":
+            self.num_topics += 1
+            return self.num_topics
+
+        assert request.method == "send_message"
+        content = request.args[1]
+        topic_id = request.kwargs.get("message_thread_id", 0)
+        self.sent.append((request.chat_id, topic_id, content.text.text))
+        return len(self.sent)
+
+
+def test_shard_of():
+    shards = Counter(shard_of(chat_id, 4) for chat_id in range(10_000))
+
+    assert shard_of(123456789, 4) == shard_of(123456789, 4)
+    assert sorted(shards) == [0, 1, 2, 3]
+    assert min(shards.values()) > 2000
+
+
+def _configs(temp_dir: str, num_shards: int) -> list[WorkerConfig]:
+    return [
+        WorkerConfig(
+            shard=shard,
+            num_shards=num_shards,
+            mapping_file=os.path.join(temp_dir, "mapping.bin"),
+            encryption_key=Fernet.generate_key(),
+            admin_chat_id=0,
+            randomizer=CountingRandomizer,
+        )
+        for shard in range(num_shards)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sharded_front_routing():
+    with TemporaryDirectory() as temp_dir:
+        telegram = RecordingTelegramApi()
+        configs = _configs(temp_dir, 2)
+
+        front = await ShardedFront.start(telegram, configs, context="fork")
+        await front.start_processing()
+
+        # Users land on both shards
+        users = [1, 2, 3, 4]
+        assert {shard_of(user, 2) for user in users} == {0, 1}
+
+        for user in users:
+            await front.submit(user, 0, [MyTextMessage(f"from {user}")])
+        await front.close()
+
+        topics = {text: topic for _, topic, text in telegram.sent}
+        assert sorted(front.topic_shards) == [1, 2, 3, 4]
+
+        # Topics are known to the front after restart
+        front = await ShardedFront.start(telegram, configs, context="fork")
+        await front.start_processing()
+        assert sorted(front.topic_shards) == [1, 2, 3, 4]
+
+        for user in users:
+            await front.submit(0, topics[f"from {user}"], [MyTextMessage(f"to {user}")])
+        await front.close()
+
+        assert sorted(telegram.sent[len(users) :]) == [
+            (user, 0, f"to {user}") for user in users
+        ]
+
+
+@pytest.mark.asyncio
+async def test_sharded_front_keeps_messages_during_shutdown():
+    with TemporaryDirectory() as temp_dir:
+        telegram = RecordingTelegramApi()
+        configs = _configs(temp_dir, 2)
+
+        front = await ShardedFront.start(telegram, configs, context="fork")
+        await front.start_processing()
+        await front.submit(1, 0, [MyTextMessage("before")])
+
+        # Spooled by the worker while it drains
+        await front.drain()
+        await front.hold(2, 0, [MyTextMessage("draining")])
+        await front.close()
+
+        # Spooled by the front once workers stopped
+        await front.hold(3, 0, [MyTextMessage("stopped")])
+        assert [text for *_, text in telegram.sent] == ["before"]
+
+        front = await ShardedFront.start(telegram, configs, context="fork")
+        await front.start_processing()
+        await front.close()
+
+        assert sorted(text for *_, text in telegram.sent) == [
+            "before",
+            "draining",
+            "stopped",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_shard_benchmark_calls_through_front():
+    report = await run_shard_benchmark(
+        2, num_messages=100, num_users=10, cost=0.0, context="fork"
+    )
+
+    # A topic for every user and every message
+    assert report.telegram_calls == 110
+
+
+@pytest.mark.asyncio
+async def test_sharded_capacity_scales():
+    # Cpu time per process, so that the test does not need several cpus
+    single = await run_shard_benchmark(1, num_messages=500, cost=0.0, context="fork")
+    double = await run_shard_benchmark(2, num_messages=500, cost=0.0, context="fork")
+
+    assert double.capacity > single.capacity * 1.5
+
+
+async def _wait_for(condition, timeout: float = 10.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_sharded_front_restarts_exited_worker():
+    with TemporaryDirectory() as temp_dir:
+        telegram = RecordingTelegramApi()
+        configs = _configs(temp_dir, 2)
+
+        front = await ShardedFront.start(telegram, configs, context="fork")
+        await front.start_processing()
+        supervisor = asyncio.create_task(front.supervise())
+
+        await front.submit(1, 0, [MyTextMessage("before")])
+        await _wait_for(lambda: len(telegram.sent) == 1)
+
+        front.workers[shard_of(1, 2)].process.kill()
+        # Spooled by the front until the worker is back
+        await front.submit(1, 0, [MyTextMessage("after")])
+
+        await _wait_for(lambda: len(telegram.sent) == 2)
+        assert front.restarts == 1
+        assert [text for *_, text in telegram.sent] == ["before", "after"]
+
+        await front.close()
+        supervisor.cancel()
+
+
+@pytest.mark.asyncio
+async def test_sharded_front_fails_when_workers_keep_exiting():
+    with TemporaryDirectory() as temp_dir:
+        configs = _configs(temp_dir, 2)
+
+        front = await ShardedFront.start(
+            RecordingTelegramApi(), configs, context="fork"
+        )
+        front.max_restarts = 0
+        await front.start_processing()
+
+        front.workers[0].process.kill()
+        with pytest.raises(RuntimeError, match="Shard 0 exited"):
+            await asyncio.wait_for(front.supervise(), 10)
+
+        # Messages of the shard are kept for the next start
+        await front.submit(1 if shard_of(1, 2) == 0 else 2, 0, [MyTextMessage("x")])
+        await front.close()
+        assert len(front.spool) == 1
@@ -1,26 +1,132 @@
 """
 Generates names of random mushrooms from a file
-"""
 
+Names are handed out in a shuffled order without repetition. Once every name
+is used, the same order is repeated with a suffix: "Name #2", "Name #3" and so on.
+The cursor is persisted in the background, so names are not repeated
+after restart either (except the last few if the process is killed)
+"""
 
+import asyncio
+import functools
+import logging
+import os
 import random
-from dataclasses import dataclass
+import struct
+from collections.abc import Sequence
+from dataclasses import dataclass, field
 from importlib.resources import files
 
 import shroombot
 from shroombot.server import NameRandomizer
 
+logger = logging.getLogger(__name__)
+
 FILES = files(shroombot)
 
+# Seed of the shuffle, number of names handed out
+_STATE = struct.Struct("<QQ")
 
-def default_shroom_names() -> list[str]:
+
+@functools.cache
+def default_shroom_names() -> tuple[str, ...]:
     with FILES.joinpath("shrooms.csv").open() as file:
-        return [line.strip() for line in file.readlines()]
+        names = (line.strip() for line in file)
+        # Keep the first occurence of duplicates
+        return tuple(dict.fromkeys(name for name in names if name))
 
 
 @dataclass
 class ShroomNameRandomizer(NameRandomizer):
-    pool: list[str]
+    pool: Sequence[str]
+    # Cursor is written to this file after every name, if given
+    state_file: str | None = None
+    # Shards hand out disjoint parts of the pool
+    shard: int = 0
+    num_shards: int = 1
+
+    seed: int = field(default_factory=lambda: random.getrandbits(63))
+    # Number of names handed out
+    counter: int = 0
+    order: list[str] = field(init=False, repr=False)
+
+    # Counter in the state file
+    saved: int = field(init=False, repr=False)
+    saver: asyncio.Task | None = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self.saved = self.counter
+        self.order = list(self.pool[self.shard :: self.num_shards])
+        if not self.order:
+            raise ValueError(f"No names for shard {self.shard}")
+        random.Random(self.seed).shuffle(self.order)
+
+    @staticmethod
+    def from_file(
+        state_file: str, pool: Sequence[str], shard: int = 0, num_shards: int = 1
+    ) -> "ShroomNameRandomizer":
+        """
+        Continue from the persisted cursor, start a new order if there is none
+        """
+        if not os.path.exists(state_file):
+            return ShroomNameRandomizer(pool, state_file, shard, num_shards)
+
+        with open(state_file, "rb") as file:
+            seed, counter = _STATE.unpack(file.read())
+
+        return ShroomNameRandomizer(
+            pool, state_file, shard, num_shards, seed=seed, counter=counter
+        )
 
     def get_random_topic_name(self) -> str:
-        return random.choice(self.pool)
+        cycle, idx = divmod(self.counter, len(self.order))
+        self.counter += 1
+
+        if self.state_file is not None:
+            self._schedule_save()
+
+        if cycle == 0:
+            return self.order[idx]
+        return f"{self.order[idx]} #{cycle + 1}"
+
+    async def close(self):
+        """
+        Wait until the cursor is on disk
+        """
+        if self.saver is not None:
+            await self.saver
+
+        if self.state_file is not None and self.saved != self.counter:
+            await asyncio.to_thread(self._save, self.counter)
+
+    def _schedule_save(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to block
+            self._save(self.counter)
+            return
+
+        if self.saver is None or self.saver.done():
+            self.saver = asyncio.create_task(self._save_loop())
+
+    async def _save_loop(self):
+        # Names handed out during a write are saved together by the next one
+        while self.saved != self.counter:
+            try:
+                await asyncio.to_thread(self._save, self.counter)
+            except OSError:
+                # Saved again with the next name or on close
+                logger.exception("Could not save topic name cursor")
+                return
+
+    def _save(self, counter: int):
+        assert self.state_file is not None
+
+        temp_path = self.state_file + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(_STATE.pack(self.seed, counter))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.state_file)
+        self.saved = counter
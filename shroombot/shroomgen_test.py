@@ -0,0 +1,75 @@
+"""
+Testing of the non-repeating topic name allocator
+"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from shroombot.shroomgen import ShroomNameRandomizer, default_shroom_names
+
+
+def test_default_shroom_names_cached():
+    names = default_shroom_names()
+
+    assert names is default_shroom_names()
+    assert len(names) == len(set(names)) > 1000
+    assert all(name and name == name.strip() for name in names)
+
+
+def test_names_not_repeated():
+    pool = ["Boletus", "Amanita", "Russula"]
+
+    randomizer = ShroomNameRandomizer(pool)
+    names = [randomizer.get_random_topic_name() for _ in range(7)]
+
+    assert sorted(names[:3]) == sorted(pool)
+    assert names[3:6] == [f"{name} #2" for name in names[:3]]
+    assert names[6] == f"{names[0]} #3"
+
+
+def test_cursor_persisted():
+    with TemporaryDirectory() as temp_dir:
+        state_file = os.path.join(temp_dir, "mapping.bin.names")
+        pool = [f"Shroom {idx}" for idx in range(10)]
+
+        randomizer = ShroomNameRandomizer.from_file(state_file, pool)
+        before = [randomizer.get_random_topic_name() for _ in range(4)]
+
+        randomizer = ShroomNameRandomizer.from_file(state_file, pool)
+        after = [randomizer.get_random_topic_name() for _ in range(6)]
+
+        assert sorted(before + after) == sorted(pool)
+
+
+def test_shards_use_disjoint_names():
+    pool = [f"Shroom {idx}" for idx in range(10)]
+
+    shards = [
+        ShroomNameRandomizer(pool, shard=shard, num_shards=3) for shard in range(3)
+    ]
+    names = [shard.get_random_topic_name() for shard in shards for _ in range(8)]
+
+    assert len(names) == len(set(names))
+
+
+@pytest.mark.asyncio
+async def test_cursor_saved_in_background():
+    with TemporaryDirectory() as temp_dir:
+        state_file = os.path.join(temp_dir, "mapping.bin.names")
+        pool = [f"Shroom {idx}" for idx in range(10)]
+
+        randomizer = ShroomNameRandomizer.from_file(state_file, pool)
+        before = [randomizer.get_random_topic_name() for _ in range(4)]
+
+        # Names handed out together are written once
+        assert not os.path.exists(state_file)
+        await randomizer.close()
+
+        randomizer = ShroomNameRandomizer.from_file(state_file, pool)
+        assert randomizer.counter == 4
+        after = [randomizer.get_random_topic_name() for _ in range(6)]
+        await randomizer.close()
+
+        assert sorted(before + after) == sorted(pool)
@@ -0,0 +1,613 @@
+"""
+Durable spool of incomming messages
+
+Messages are recorded in an encrypted append-only file before processing
+and acknowledged once processing succeeded. Messages that failed are retried
+with exponential backoff, and the ones that keep failing are moved
+to a dead-letter file. Later messages of the conversation wait
+for the failed one, so that the order is kept. Messages that were not acknowledged,
+because of a crash or a shutdown, are processed again on the next start.
+Edits that arrive during shutdown are kept for the next start as well.
+
+Processing is at-least-once: a message that failed half-way may be sent twice.
+Telegram ids of recent messages are remembered, so a message
+that is delivered again is not processed again.
+
+Records are versioned json, messages are stored by stable type names,
+so that the spool stays readable when the code changes between deploys.
+"""
+
+import asyncio
+import base64
+import heapq
+import json
+import logging
+import os
+import random
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field, fields
+from typing import TYPE_CHECKING, Any
+
+from shroombot.anonymizer import (
+    append_encrypted_lines,
+    fsync_dir,
+    load_encrypted_lines,
+    rotate_encrypted_lines,
+)
+from shroombot.keyring import EncryptionKey, RotationStep
+from shroombot.metrics import SPOOL_DEAD, SPOOL_RETRIES
+from shroombot.server import (
+    MyAnimationMessage,
+    MyContactMessage,
+    MyDocumentMessage,
+    MyLocationMessage,
+    MyMessageType,
+    MyPhotoMessage,
+    MyStickerMessage,
+    MyTextMessage,
+    MyVideoMessage,
+    MyVoiceMessage,
+    conversation_key,
+    process_edited_message,
+    process_incomming_messages,
+)
+
+if TYPE_CHECKING:
+    from shroombot.dispatcher import Dispatcher
+    from shroombot.server import ServerData
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SpoolEntry:  # pylint: disable=too-many-instance-attributes
+    seq: int
+    chat_id: int
+    thread_id: int
+    messages: list["MyMessageType"]
+    message_ids: list[int] | None = None
+    reply_to: int | None = None
+    # Failed processing attempts since start
+    attempts: int = 0
+    # Id of the edited message, the only message is its new content
+    edit_of: int | None = None
+
+    @property
+    def dedup_key(self) -> tuple[int, int] | None:
+        if not self.message_ids:
+            return None
+        return (self.chat_id, self.message_ids[0])
+
+
+# Version of the record encoding
+RECORD_VERSION = 1
+
+# Names of message types in records, kept when classes are renamed
+_MESSAGE_TYPES: dict[str, type] = {
+    "text": MyTextMessage,
+    "photo": MyPhotoMessage,
+    "sticker": MyStickerMessage,
+    "document": MyDocumentMessage,
+    "video": MyVideoMessage,
+    "animation": MyAnimationMessage,
+    "voice": MyVoiceMessage,
+    "location": MyLocationMessage,
+    "contact": MyContactMessage,
+}
+_MESSAGE_NAMES = {cls: name for name, cls in _MESSAGE_TYPES.items()}
+
+
+def _encode_message(message: MyMessageType) -> dict:
+    data: dict[str, Any] = {"type": _MESSAGE_NAMES[type(message)]}
+    for item in fields(message):
+        value = getattr(message, item.name)
+        if item.name == "entities":
+            # Text entities are stored in the tdlib json format
+            value = [entity.dict(by_alias=True) for entity in value]
+        elif isinstance(value, bytes):
+            value = {"base64": base64.b64encode(value).decode("ascii")}
+        data[item.name] = value
+    return data
+
+
+def _decode_message(data: dict) -> MyMessageType:
+    values = {}
+    for name, value in data.items():
+        if name == "entities" and value:
+            # pylint: disable-next=import-outside-toplevel
+            from aiotdlib.utils import parse_tdlib_object
+
+            value = [parse_tdlib_object(entity) for entity in value]
+        elif isinstance(value, dict) and "base64" in value:
+            value = base64.b64decode(value["base64"])
+        values[name] = value
+
+    return _MESSAGE_TYPES[values.pop("type")](**values)
+
+
+def _encode_entry(entry: SpoolEntry) -> dict:
+    return {
+        "seq": entry.seq,
+        "chat_id": entry.chat_id,
+        "thread_id": entry.thread_id,
+        "messages": [_encode_message(message) for message in entry.messages],
+        "message_ids": entry.message_ids,
+        "reply_to": entry.reply_to,
+        "attempts": entry.attempts,
+        "edit_of": entry.edit_of,
+    }
+
+
+def _decode_entry(data: dict) -> SpoolEntry:
+    return SpoolEntry(
+        seq=data["seq"],
+        chat_id=data["chat_id"],
+        thread_id=data["thread_id"],
+        messages=[_decode_message(message) for message in data["messages"]],
+        message_ids=data["message_ids"],
+        reply_to=data["reply_to"],
+        attempts=data["attempts"],
+        edit_of=data.get("edit_of"),
+    )
+
+
+def encode_record(kind: str, **values: Any) -> bytes:
+    """
+    Record of the spool file: "add" with an entry, "ack" with seq and dedup_key,
+    "seen" with dedup_key. Dead letters are "dead" records with an entry
+    """
+    if "entry" in values:
+        values["entry"] = _encode_entry(values["entry"])
+    return json.dumps({"version": RECORD_VERSION, "kind": kind, **values}).encode()
+
+
+def decode_record(data: bytes) -> dict:
+    record = json.loads(data)
+
+    version = record.get("version")
+    if version != RECORD_VERSION:
+        raise ValueError(f"Unsupported spool record version {version}")
+
+    if "entry" in record:
+        record["entry"] = _decode_entry(record["entry"])
+    if record.get("dedup_key") is not None:
+        record["dedup_key"] = tuple(record["dedup_key"])
+    return record
+
+
+# Runs processing of the entry, raises on failure
+Process = Callable[[SpoolEntry], Awaitable[None]]
+# Queues a job for processing of the entry
+Schedule = Callable[[SpoolEntry, Callable[[], Awaitable[None]]], Awaitable[None]]
+
+
+def dead_letter_path(file_path: str) -> str:
+    return file_path + ".dead"
+
+
+def load_dead_letters(
+    file_path: str, encryption_key: EncryptionKey
+) -> list[SpoolEntry]:
+    """
+    Entries that failed processing too many times
+    """
+    path = dead_letter_path(file_path)
+    if not os.path.exists(path):
+        return []
+    return [
+        decode_record(line)["entry"]
+        for line in load_encrypted_lines(path, encryption_key)
+    ]
+
+
+def _rewrite_lines(
+    file_path: str, payloads: list[bytes], encryption_key: EncryptionKey
+):
+    temp_path = file_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    append_encrypted_lines(temp_path, payloads, encryption_key)
+    os.replace(temp_path, file_path)
+    fsync_dir(os.path.dirname(os.path.abspath(file_path)))
+
+
+@dataclass
+class Spool:  # pylint: disable=too-many-instance-attributes
+    file_path: str
+    encryption_key: EncryptionKey
+    process: Process
+    schedule: Schedule
+
+    # Failed attempts before the entry is moved to the dead-letter file
+    max_attempts: int = 5
+    # Delay before the first retry, doubled with every attempt
+    backoff: float = 1.0
+    max_backoff: float = 300.0
+    # Number of processed telegram message ids remembered for deduplication
+    max_seen: int = 100_000
+    # Rewrite the file once it has this many records
+    compact_every: int = 10_000
+
+    # Entries that are not acknowledged yet, by sequence number
+    entries: dict[int, SpoolEntry] = field(default_factory=dict, repr=False)
+    seen: OrderedDict[tuple[int, int], None] = field(
+        default_factory=OrderedDict, repr=False
+    )
+    next_seq: int = 0
+    # Entries are processed once started
+    started: bool = False
+
+    # Min-heap of (due time, seq, entry)
+    retries: list[tuple[float, int, SpoolEntry]] = field(
+        default_factory=list, repr=False
+    )
+    retry_added: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    # Conversations waiting for the retry of a failed entry, by (chat, thread),
+    # sequence number of the failed entry and entries parked behind it
+    failing: dict[tuple[int, int], int] = field(default_factory=dict, repr=False)
+    parked: dict[tuple[int, int], deque[SpoolEntry]] = field(
+        default_factory=dict, repr=False
+    )
+    retrier: asyncio.Task | None = field(default=None, repr=False)
+
+    # Group commit of records
+    pending: list[bytes] = field(default_factory=list, repr=False)
+    flushed: asyncio.Future | None = field(default=None, repr=False)
+    flusher: asyncio.Task | None = field(default=None, repr=False)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+    records: int = 0
+
+    @staticmethod
+    async def from_file(
+        file_path: str,
+        encryption_key: EncryptionKey,
+        process: Process,
+        schedule: Schedule,
+        **options: Any,
+    ) -> "Spool":
+        """
+        Load entries that were not acknowledged before the last stop
+        """
+        spool = Spool(file_path, encryption_key, process, schedule, **options)
+
+        if os.path.exists(file_path):
+            lines = await asyncio.to_thread(
+                load_encrypted_lines, file_path, encryption_key
+            )
+            for line in lines:
+                spool._apply(decode_record(line))  # pylint: disable=protected-access
+            spool.records = len(lines)
+
+        if spool.entries:
+            logger.info("Spool has %d unprocessed entries", len(spool.entries))
+
+        return spool
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _apply(self, record: dict):
+        kind = record["kind"]
+        if kind == "add":
+            entry = record["entry"]
+            self.entries[entry.seq] = entry
+            self.next_seq = max(self.next_seq, entry.seq + 1)
+            self._remember(entry.dedup_key)
+        elif kind == "ack":
+            self.entries.pop(record["seq"], None)
+            self._remember(record["dedup_key"])
+        elif kind == "seen":
+            self._remember(record["dedup_key"])
+
+    def _remember(self, dedup_key: tuple[int, int] | None):
+        if dedup_key is None:
+            return
+        self.seen[dedup_key] = None
+        self.seen.move_to_end(dedup_key)
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+    async def start(self):
+        """
+        Process entries left from the last run and the ones submitted
+        before start, in order, and start retrying failures.
+
+        Must be called once processing can succeed, that is once
+        the telegram client is connected
+        """
+        self.started = True
+        self.retrier = asyncio.create_task(self._retry_loop())
+        for seq in sorted(self.entries):
+            await self.schedule(self.entries[seq], self._job(self.entries[seq]))
+
+    def stop_retrying(self):
+        """
+        Failed entries left are processed on the next start
+        """
+        if self.retrier is not None:
+            self.retrier.cancel()
+            self.retrier = None
+
+    async def submit(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        thread_id: int,
+        messages: list["MyMessageType"],
+        message_ids: list[int] | None = None,
+        reply_to: int | None = None,
+        hold: bool = False,
+    ):
+        """
+        Record messages and queue them for processing once started,
+        held messages are only processed after restart
+        """
+        entry = SpoolEntry(
+            self.next_seq, chat_id, thread_id, messages, message_ids, reply_to
+        )
+
+        dedup_key = entry.dedup_key
+        if dedup_key is not None and dedup_key in self.seen:
+            logger.info(
+                "Message %d of chat %d was already received, skipped",
+                dedup_key[1],
+                chat_id,
+            )
+            return
+
+        self.next_seq += 1
+        self.entries[entry.seq] = entry
+        self._remember(dedup_key)
+
+        try:
+            await self._append(encode_record("add", entry=entry))
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Processing without the record is better than not processing
+            logger.exception("Could not record message to the spool")
+
+        if self.started and not hold:
+            await self.schedule(entry, self._job(entry))
+
+    async def hold_edit(
+        self, chat_id: int, thread_id: int, message_id: int, message: MyMessageType
+    ):
+        """
+        Record edit of the message for processing after restart
+        """
+        entry = SpoolEntry(
+            self.next_seq, chat_id, thread_id, [message], edit_of=message_id
+        )
+        self.next_seq += 1
+        self.entries[entry.seq] = entry
+
+        await self._append(encode_record("add", entry=entry))
+
+    def _job(self, entry: SpoolEntry) -> Callable[[], Awaitable[None]]:
+        async def _run():
+            key = (entry.chat_id, entry.thread_id)
+
+            failing = self.failing.get(key)
+            if failing is not None and failing != entry.seq:
+                # Processed once the failed entry before it is done
+                self.parked.setdefault(key, deque()).append(entry)
+                return
+
+            await self._process_in_order(key, entry)
+
+        return _run
+
+    async def _process_in_order(self, key: tuple[int, int], entry: SpoolEntry):
+        """
+        Process the entry, then the entries parked behind it,
+        until one of them is retried
+        """
+        while True:
+            try:
+                await self.process(entry)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Failure is logged by the processing
+                if await self._failed(entry):
+                    self.failing[key] = entry.seq
+                    return
+            else:
+                await self._ack(entry)
+
+            self.failing.pop(key, None)
+
+            parked = self.parked.get(key)
+            if not parked:
+                self.parked.pop(key, None)
+                return
+            entry = parked.popleft()
+
+    async def _failed(self, entry: SpoolEntry) -> bool:
+        """
+        Schedule retry of the entry or move it to dead letters,
+        returns whether it is retried
+        """
+        entry.attempts += 1
+
+        if entry.attempts >= self.max_attempts:
+            await self._dead(entry)
+            return False
+
+        delay = min(self.max_backoff, self.backoff * 2 ** (entry.attempts - 1))
+        delay *= random.uniform(0.5, 1.5)
+
+        SPOOL_RETRIES.inc()
+        logger.warning(
+            "Retrying message of chat %d in %.1fs, attempt %d",
+            entry.chat_id,
+            delay,
+            entry.attempts + 1,
+        )
+
+        due = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self.retries, (due, entry.seq, entry))
+        self.retry_added.set()
+        return True
+
+    async def _retry_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.retry_added.clear()
+
+            if not self.retries:
+                await self.retry_added.wait()
+                continue
+
+            delay = self.retries[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.retry_added.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            _, _, entry = heapq.heappop(self.retries)
+            await self.schedule(entry, self._job(entry))
+
+    async def _ack(self, entry: SpoolEntry):
+        self.entries.pop(entry.seq, None)
+        await self._append(
+            encode_record("ack", seq=entry.seq, dedup_key=entry.dedup_key)
+        )
+
+    async def _dead(self, entry: SpoolEntry):
+        SPOOL_DEAD.inc()
+        logger.error(
+            "Message of chat %d failed %d times, moved to dead letters",
+            entry.chat_id,
+            entry.attempts,
+        )
+
+        async with self.lock:
+            await asyncio.to_thread(
+                append_encrypted_lines,
+                dead_letter_path(self.file_path),
+                [encode_record("dead", entry=entry)],
+                self.encryption_key,
+            )
+        await self._ack(entry)
+
+    async def _append(self, record: bytes):
+        """
+        Write the record durably, records written concurrently share one fsync
+        """
+        self.pending.append(record)
+
+        if self.flushed is None:
+            self.flushed = asyncio.get_running_loop().create_future()
+            self.flusher = asyncio.create_task(self._flush())
+
+        await asyncio.shield(self.flushed)
+
+    async def _flush(self):
+        async with self.lock:
+            payloads, self.pending = self.pending, []
+            flushed, self.flushed = self.flushed, None
+            assert flushed is not None
+
+            try:
+                await asyncio.to_thread(
+                    append_encrypted_lines,
+                    self.file_path,
+                    payloads,
+                    self.encryption_key,
+                )
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                flushed.set_exception(exc)
+                return
+
+            flushed.set_result(None)
+            self.records += len(payloads)
+
+            if self.records >= self.compact_every:
+                await self._compact()
+
+    async def _compact(self):
+        """
+        Rewrite the file with only unacknowledged entries and remembered ids,
+        must be called under the lock
+        """
+        records = [
+            encode_record("add", entry=self.entries[seq])
+            for seq in sorted(self.entries)
+        ]
+        records += [encode_record("seen", dedup_key=key) for key in self.seen]
+
+        await asyncio.to_thread(
+            _rewrite_lines, self.file_path, records, self.encryption_key
+        )
+        self.records = len(records)
+
+    def rotation_steps(self) -> list[RotationStep]:
+        """
+        Spool is re-encrypted by compaction, dead letters are rewritten
+        """
+        return [self._rotate_spool, self._rotate_dead_letters]
+
+    async def _rotate_spool(self):
+        async with self.lock:
+            await self._compact()
+
+    async def _rotate_dead_letters(self):
+        path = dead_letter_path(self.file_path)
+        async with self.lock:
+            if os.path.exists(path):
+                await asyncio.to_thread(
+                    rotate_encrypted_lines, path, self.encryption_key
+                )
+
+    async def close(self):
+        """
+        Write down entries that are left for the next start
+        """
+        self.stop_retrying()
+
+        if self.flusher is not None:
+            await asyncio.gather(self.flusher, return_exceptions=True)
+
+        async with self.lock:
+            await self._compact()
+
+        if self.entries:
+            logger.info("Spool keeps %d unprocessed entries", len(self.entries))
+
+
+async def open_spool(
+    file_path: str,
+    encryption_key: EncryptionKey,
+    data: "ServerData",
+    dispatcher: "Dispatcher",
+    **options: Any,
+) -> Spool:
+    """
+    Spool that processes messages with the dispatcher, ordered by conversation
+    """
+
+    async def _process(entry: SpoolEntry):
+        if entry.edit_of is not None:
+            await process_edited_message(
+                data, entry.chat_id, entry.edit_of, entry.messages[0]
+            )
+            return
+
+        await process_incomming_messages(
+            data,
+            entry.chat_id,
+            entry.thread_id,
+            entry.messages,
+            entry.message_ids,
+            entry.reply_to,
+        )
+
+    async def _schedule(entry: SpoolEntry, job: Callable[[], Awaitable[None]]):
+        await dispatcher.submit(
+            conversation_key(data, entry.chat_id, entry.thread_id), job
+        )
+
+    return await Spool.from_file(
+        file_path, encryption_key, _process, _schedule, **options
+    )
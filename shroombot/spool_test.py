@@ -0,0 +1,223 @@
+"""
+Testing of the durable spool of incomming messages
+"""
+
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+from aiotdlib.api import TextEntity, TextEntityTypeTextUrl
+from cryptography.fernet import Fernet
+
+from shroombot.server import (
+    MyContactMessage,
+    MyPhotoMessage,
+    MyTextMessage,
+    MyVoiceMessage,
+)
+from shroombot.spool import Spool, SpoolEntry, load_dead_letters
+
+
+class Recorder:
+    def __init__(self, failures: int = 0):
+        self.processed: list[str] = []
+        self.failures = failures
+        self.client_started = True
+
+    async def process(self, entry: SpoolEntry):
+        if not self.client_started:
+            raise RuntimeError("Client not started")
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("telegram is down")
+        self.processed.extend(message.text for message in entry.messages)
+
+    async def schedule(self, _: SpoolEntry, job):
+        await job()
+
+
+async def _open(file_path: str, key: bytes, recorder: Recorder, **options) -> Spool:
+    return await Spool.from_file(
+        file_path, key, recorder.process, recorder.schedule, **options
+    )
+
+
+@pytest.mark.asyncio
+async def test_spool_replay_is_idempotent():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        recorder = Recorder()
+        spool = await _open(file_path, key, recorder)
+        await spool.start()
+
+        await spool.submit(1, 0, [MyTextMessage("processed")], [10])
+        # Arrived during shutdown
+        await spool.submit(1, 0, [MyTextMessage("held")], [11], hold=True)
+        await spool.close()
+
+        assert recorder.processed == ["processed"]
+
+        # Held message is processed after restart
+        recorder = Recorder()
+        spool = await _open(file_path, key, recorder)
+        assert len(spool) == 1
+        await spool.start()
+
+        # Messages delivered again are skipped
+        await spool.submit(1, 0, [MyTextMessage("processed")], [10])
+        await spool.submit(1, 0, [MyTextMessage("held")], [11])
+        await spool.submit(1, 0, [MyTextMessage("new")], [12])
+        await spool.close()
+
+        assert recorder.processed == ["held", "new"]
+
+        recorder = Recorder()
+        spool = await _open(file_path, key, recorder)
+        assert len(spool) == 0
+        await spool.submit(1, 0, [MyTextMessage("new")], [12])
+        assert not recorder.processed
+
+
+@pytest.mark.asyncio
+async def test_spool_retries_and_dead_letters():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        recorder = Recorder(failures=2)
+        spool = await _open(file_path, key, recorder, backoff=0.01, max_attempts=3)
+        await spool.start()
+
+        await spool.submit(1, 0, [MyTextMessage("retried")], [10])
+        while len(spool):
+            await asyncio.sleep(0.01)
+        assert recorder.processed == ["retried"]
+
+        recorder.failures = 3
+        await spool.submit(1, 0, [MyTextMessage("dead")], [11])
+        while len(spool):
+            await asyncio.sleep(0.01)
+        await spool.close()
+
+        assert not recorder.processed[1:]
+        assert [
+            message.text
+            for entry in load_dead_letters(file_path, key)
+            for message in entry.messages
+        ] == ["dead"]
+
+        # Dead letters are not processed again
+        spool = await _open(file_path, key, Recorder())
+        assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_order_after_failure():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        recorder = Recorder(failures=1)
+        spool = await _open(file_path, key, recorder, backoff=0.01, max_attempts=2)
+        await spool.start()
+
+        await spool.submit(1, 0, [MyTextMessage("A")], [10])
+        await spool.submit(1, 0, [MyTextMessage("B")], [11])
+        # Other conversations are not blocked
+        await spool.submit(2, 0, [MyTextMessage("other")], [12])
+        assert recorder.processed == ["other"]
+
+        while len(spool):
+            await asyncio.sleep(0.01)
+        assert recorder.processed == ["other", "A", "B"]
+
+        # Dead letter lets the rest of the conversation through
+        recorder.failures = 2
+        await spool.submit(1, 0, [MyTextMessage("dead")], [13])
+        await spool.submit(1, 0, [MyTextMessage("C")], [14])
+
+        while len(spool):
+            await asyncio.sleep(0.01)
+        await spool.close()
+
+        assert recorder.processed[3:] == ["C"]
+        assert not spool.failing and not spool.parked
+
+
+@pytest.mark.asyncio
+async def test_spool_processes_once_started():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        spool = await _open(file_path, key, Recorder())
+        await spool.submit(1, 0, [MyTextMessage("left")], [10], hold=True)
+        await spool.close()
+
+        # Telegram client is started after the spool
+        recorder = Recorder()
+        recorder.client_started = False
+        spool = await _open(file_path, key, recorder, max_attempts=1)
+
+        await spool.submit(1, 0, [MyTextMessage("new")], [11])
+        assert len(spool) == 2
+
+        recorder.client_started = True
+        await spool.start()
+        await spool.close()
+
+        # Nothing is retried or dead, order is kept
+        assert recorder.processed == ["left", "new"]
+        assert not load_dead_letters(file_path, key)
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_messages_of_every_type():
+    messages = [
+        MyTextMessage(
+            "link",
+            [TextEntity(offset=0, length=4, type=TextEntityTypeTextUrl(url="x.org"))],
+        ),
+        MyPhotoMessage("photo", None, width=10, height=20),
+        MyVoiceMessage("voice", "caption", duration=3, waveform=b"\x00\x7b\xff"),
+        MyContactMessage("+100", "Shroom"),
+    ]
+
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        spool = await _open(file_path, key, Recorder())
+        await spool.submit(1, 2, messages, [10, 11, 12, 13], reply_to=5, hold=True)
+        await spool.close()
+
+        spool = await _open(file_path, key, Recorder())
+        (entry,) = spool.entries.values()
+        assert entry.messages == messages
+        assert (entry.chat_id, entry.thread_id, entry.reply_to) == (1, 2, 5)
+
+
+@pytest.mark.asyncio
+async def test_spool_keeps_edits_for_restart():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.bin.spool")
+        key = Fernet.generate_key()
+
+        spool = await _open(file_path, key, Recorder())
+        await spool.start()
+        # Arrived during shutdown
+        await spool.hold_edit(1, 0, 10, MyTextMessage("edited"))
+        await spool.close()
+
+        recorder = Recorder()
+        spool = await _open(file_path, key, recorder)
+        (entry,) = spool.entries.values()
+        assert entry.edit_of == 10
+
+        await spool.start()
+        await spool.close()
+        assert recorder.processed == ["edited"]
+        assert len(spool) == 0
@@ -0,0 +1,370 @@
+"""
+Chat to topic mappings in an sqlite database
+
+Alternative to the snapshot and journal files of the anonymizer: mappings
+are not loaded into memory on start and a registration is a single row insert.
+
+Chat ids are never stored in plain text. Every row keeps the chat id encrypted,
+to look up topics of chats, and a keyed hash of the chat id, to find rows by chat.
+Topic ids are stored as is, they are visible in the admin group anyway.
+
+The database runs in WAL mode, all calls run on a dedicated thread.
+Recently used mappings are cached in memory
+"""
+
+import asyncio
+import functools
+import hashlib
+import hmac
+import logging
+import sqlite3
+from array import array
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from shroombot.anonymizer import MappingStore, has_mappings, load_mappings
+from shroombot.keyring import EncryptionKey, RotationStep, get_cipher, key_tuple
+from shroombot.metrics import REGISTER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mappings (
+    chat_hash BLOB PRIMARY KEY,
+    topic_id INTEGER NOT NULL UNIQUE,
+    chat BLOB NOT NULL
+) WITHOUT ROWID
+"""
+
+_HASH_BYTES = 16
+
+
+@functools.lru_cache(maxsize=16)
+def _hash_keys(keys: tuple[bytes, ...]) -> tuple[bytes, ...]:
+    # Hash keys are derived, so that they differ from encryption keys
+    return tuple(
+        hmac.new(key, b"shroombot chat id", hashlib.sha256).digest() for key in keys
+    )
+
+
+def chat_hashes(encryption_key: EncryptionKey, chat_id: int) -> tuple[bytes, ...]:
+    """
+    Keyed hashes of the chat id, newest key first
+    """
+    data = chat_id.to_bytes(8, "little", signed=True)
+    return tuple(
+        hmac.new(hash_key, data, hashlib.sha256).digest()[:_HASH_BYTES]
+        for hash_key in _hash_keys(key_tuple(encryption_key))
+    )
+
+
+@dataclass
+class _Connection:
+    """
+    Connection to the database, used only from the database thread
+    """
+
+    db: sqlite3.Connection
+    encryption_key: EncryptionKey
+
+    @staticmethod
+    def connect(file_path: str, encryption_key: EncryptionKey) -> "_Connection":
+        db = sqlite3.connect(file_path, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        # Registration is on disk when insert returns
+        db.execute("PRAGMA synchronous=FULL")
+        db.execute(_SCHEMA)
+        return _Connection(db, encryption_key)
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM mappings").fetchone()[0]
+
+    def topic_of(self, chat_id: int) -> int | None:
+        hashes = chat_hashes(self.encryption_key, chat_id)
+        row = self.db.execute(
+            "SELECT topic_id FROM mappings WHERE chat_hash IN"
+            f" ({','.join('?' * len(hashes))})",
+            hashes,
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def chat_of(self, topic_id: int) -> int | None:
+        row = self.db.execute(
+            "SELECT chat FROM mappings WHERE topic_id = ?", (topic_id,)
+        ).fetchone()
+        return None if row is None else self._decrypt(row[0])
+
+    def insert(self, mappings: list[tuple[int, int]]) -> int:
+        """
+        Returns number of chats that were not registered before
+        """
+        with self.db:
+            self.db.execute("BEGIN")
+            return self._insert(mappings)
+
+    def _insert(self, mappings: list[tuple[int, int]]) -> int:
+        cipher = get_cipher(self.encryption_key)
+
+        added = 0
+        for chat_id, topic_id in mappings:
+            hashes = chat_hashes(self.encryption_key, chat_id)
+
+            # Chat may be registered again with a new topic,
+            # its row may be hashed with an older key
+            deleted = self.db.execute(
+                "DELETE FROM mappings WHERE chat_hash IN"
+                f" ({','.join('?' * len(hashes))})",
+                hashes,
+            ).rowcount
+            if not deleted:
+                added += 1
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO mappings VALUES (?, ?, ?)",
+                (
+                    hashes[0],
+                    topic_id,
+                    cipher.encrypt(chat_id.to_bytes(8, "little", signed=True)),
+                ),
+            )
+
+        return added
+
+    def columns(self) -> tuple[array, array]:
+        chats, topics = array("q"), array("q")
+        for chat, topic_id in self.db.execute("SELECT chat, topic_id FROM mappings"):
+            chats.append(self._decrypt(chat))
+            topics.append(topic_id)
+        return chats, topics
+
+    def rotate(self, after_topic: int, limit: int) -> int | None:
+        """
+        Re-encrypt and re-hash rows with the newest key in the order of topics,
+        returns the last rotated topic or None if there are no more rows
+        """
+        rows = self.db.execute(
+            "SELECT topic_id, chat FROM mappings WHERE topic_id > ?"
+            " ORDER BY topic_id LIMIT ?",
+            (after_topic, limit),
+        ).fetchall()
+        if not rows:
+            return None
+
+        chats = [self._decrypt(chat) for _, chat in rows]
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "DELETE FROM mappings WHERE topic_id = ?",
+                [(topic_id,) for topic_id, _ in rows],
+            )
+            self._insert([(chat, topic_id) for chat, (topic_id, _) in zip(chats, rows)])
+
+        return rows[-1][0]
+
+    def _decrypt(self, chat: bytes) -> int:
+        data = get_cipher(self.encryption_key).decrypt(chat)
+        return int.from_bytes(data, "little", signed=True)
+
+    def close(self):
+        self.db.close()
+
+
+@dataclass
+class SqliteMappingStore(MappingStore):
+    connection: _Connection
+    executor: ThreadPoolExecutor
+    size: int = 0
+
+    # Mappings cached in memory, by chat and by topic
+    capacity: int = 100_000
+    by_chat: OrderedDict[int, int] = field(default_factory=OrderedDict, repr=False)
+    by_topic: dict[int, int] = field(default_factory=dict, repr=False)
+
+    # Chats whose topic is being looked up or created right now
+    pending_topics: dict[int, asyncio.Future[int]] = field(
+        default_factory=dict, repr=False
+    )
+    # Registrations that are not on disk yet
+    writes: set[asyncio.Future] = field(default_factory=set, repr=False)
+    # Rows rotated in one step
+    rotation_chunk: int = 1000
+
+    @staticmethod
+    async def from_file(
+        file_path: str,
+        encryption_key: EncryptionKey,
+        migrate_from: str | None = None,
+        **options: Any,
+    ) -> "SqliteMappingStore":
+        """
+        Open the database, an empty one is filled from the mapping files if given
+        """
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        loop = asyncio.get_running_loop()
+
+        connection = await loop.run_in_executor(
+            executor, _Connection.connect, file_path, encryption_key
+        )
+        store = SqliteMappingStore(connection, executor, **options)
+        store.size = await loop.run_in_executor(executor, connection.count)
+
+        if store.size == 0 and migrate_from and has_mappings(migrate_from):
+            await store.migrate(migrate_from)
+
+        return store
+
+    async def _run(self, func: Callable, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def migrate(self, file_path: str):
+        """
+        Copy mappings from the snapshot and journal files,
+        the files are kept as they are
+        """
+        index = await load_mappings(file_path, self.connection.encryption_key)
+        chats, topics = index.columns()
+
+        await self._run(self.connection.insert, list(zip(chats, topics)))
+        self.size = await self._run(self.connection.count)
+
+        logger.info("Migrated %d mappings from %s to sqlite", self.size, file_path)
+
+    def _cache(self, chat_id: int, topic_id: int):
+        # Previous topic of the chat is not linked to it anymore
+        old_topic = self.by_chat.get(chat_id)
+        if (
+            old_topic not in (None, topic_id)
+            and self.by_topic.get(old_topic) == chat_id
+        ):
+            del self.by_topic[old_topic]
+
+        self.by_chat[chat_id] = topic_id
+        self.by_chat.move_to_end(chat_id)
+        self.by_topic[topic_id] = chat_id
+
+        while len(self.by_chat) > self.capacity:
+            evicted_chat, evicted_topic = self.by_chat.popitem(last=False)
+            if self.by_topic.get(evicted_topic) == evicted_chat:
+                del self.by_topic[evicted_topic]
+
+    async def find_topic_id(self, chat_id: int) -> int | None:
+        topic_id = self.by_chat.get(chat_id)
+        if topic_id is not None:
+            self.by_chat.move_to_end(chat_id)
+            return topic_id
+
+        topic_id = await self._run(self.connection.topic_of, chat_id)
+        if topic_id is not None:
+            self._cache(chat_id, topic_id)
+        return topic_id
+
+    async def find_chat_id(self, topic_id: int) -> int | None:
+        chat_id = self.by_topic.get(topic_id)
+        if chat_id is not None:
+            self.by_chat.move_to_end(chat_id)
+            return chat_id
+
+        chat_id = await self._run(self.connection.chat_of, topic_id)
+        if chat_id is not None:
+            self._cache(chat_id, topic_id)
+        return chat_id
+
+    async def get_or_create_topic_id(
+        self, chat_id: int, create_topic: Callable[[], Awaitable[int]]
+    ) -> int:
+        """
+        Return topic id of the chat, creating and registering topic if not known.
+
+        Concurrent calls for the same chat share one lookup and topic creation
+        """
+        topic_id = self.by_chat.get(chat_id)
+        if topic_id is not None:
+            self.by_chat.move_to_end(chat_id)
+            return topic_id
+
+        pending = self.pending_topics.get(chat_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        pending = asyncio.get_running_loop().create_future()
+        self.pending_topics[chat_id] = pending
+
+        try:
+            found = await self.find_topic_id(chat_id)
+            if found is None:
+                found = await create_topic()
+                await self.register_chat_topic_link(chat_id, found)
+        except BaseException as exc:
+            pending.set_exception(exc)
+            # Mark as retrieved, the exception is raised to the caller below
+            pending.exception()
+            raise
+        else:
+            pending.set_result(found)
+        finally:
+            del self.pending_topics[chat_id]
+
+        return found
+
+    async def register_chat_topic_link(
+        self, chat_id: int, topic_id: int, wait: bool = True
+    ):
+        """
+        Link chat and topic.
+
+        The link is visible right away. If wait is set,
+        returns only after the link is on disk
+        """
+        with REGISTER_SECONDS.time():
+            self._cache(chat_id, topic_id)
+
+            write = asyncio.ensure_future(
+                self._run(self.connection.insert, [(chat_id, topic_id)])
+            )
+            self.writes.add(write)
+            write.add_done_callback(self._written)
+
+            if wait:
+                await asyncio.shield(write)
+
+    def _written(self, write: asyncio.Future):
+        self.writes.discard(write)
+        if write.cancelled():
+            return
+        if write.exception() is not None:
+            logger.error("Could not write mapping", exc_info=write.exception())
+            return
+        self.size += write.result()
+
+    async def columns(self) -> tuple[array, array]:
+        return await self._run(self.connection.columns)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def rotation_steps(self) -> list[RotationStep]:
+        """
+        Re-encrypt rows in chunks, rows registered meanwhile use the newest key
+        """
+        cursor: list[int | None] = [-(2**63)]
+
+        async def _step():
+            if cursor[0] is not None:
+                cursor[0] = await self._run(
+                    self.connection.rotate, cursor[0], self.rotation_chunk
+                )
+
+        return [_step] * (self.size // self.rotation_chunk + 1)
+
+    async def flush(self):
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        await self._run(self.connection.close)
+        self.executor.shutdown()
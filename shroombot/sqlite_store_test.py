@@ -0,0 +1,135 @@
+"""
+Testing of the sqlite mapping storage
+"""
+
+import asyncio
+import os
+import sqlite3
+from tempfile import TemporaryDirectory
+
+import pytest
+from cryptography.fernet import Fernet
+
+from shroombot.keyring import rotate_keys
+from shroombot.sqlite_store import SqliteMappingStore
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_hashes_chat_ids():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.sqlite")
+
+        store = await SqliteMappingStore.from_file(file_path, Fernet.generate_key())
+        for chat_id in range(1, 12):
+            await store.register_chat_topic_link(chat_id, chat_id + 100)
+        await store.close()
+
+        # Chat ids are not stored in plain text
+        with sqlite3.connect(file_path) as db:
+            rows = db.execute(
+                "SELECT chat_hash, topic_id, chat FROM mappings"
+            ).fetchall()
+        assert len(rows) == 11
+        assert all(
+            (11).to_bytes(8, "little") not in chat_hash + chat
+            for chat_hash, _, chat in rows
+        )
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_creates_topic_once():
+    with TemporaryDirectory() as temp_dir:
+        store = await SqliteMappingStore.from_file(
+            os.path.join(temp_dir, "mapping.sqlite"), Fernet.generate_key(), capacity=2
+        )
+        created = []
+
+        async def _create_topic() -> int:
+            await asyncio.sleep(0.01)
+            created.append(len(created) + 1)
+            return created[-1]
+
+        topics = await asyncio.gather(
+            *[store.get_or_create_topic_id(7, _create_topic) for _ in range(5)]
+        )
+        assert topics == [1] * 5 and created == [1]
+
+        # Evicted from the cache, found in the database
+        for chat_id in (8, 9, 10):
+            await store.get_or_create_topic_id(chat_id, _create_topic)
+        assert 7 not in store.by_chat
+        assert await store.get_or_create_topic_id(7, _create_topic) == 1
+        assert len(created) == 4
+
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_key_rotation():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.sqlite")
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+
+        store = await SqliteMappingStore.from_file(file_path, old)
+        for chat_id in range(1, 26):
+            await store.register_chat_topic_link(chat_id, chat_id + 100)
+        await store.close()
+
+        store = await SqliteMappingStore.from_file(
+            file_path, (new, old), rotation_chunk=10
+        )
+        # Rows under the old key are found during rotation
+        assert await store.find_topic_id(25) == 125
+        assert await rotate_keys(store.rotation_steps(), asyncio.Event())
+        await store.close()
+
+        store = await SqliteMappingStore.from_file(file_path, new)
+        assert [await store.find_topic_id(idx) for idx in range(1, 26)] == list(
+            range(101, 126)
+        )
+        assert await store.find_chat_id(101) == 1
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_registers_chat_again():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "mapping.sqlite")
+        old, new = Fernet.generate_key(), Fernet.generate_key()
+
+        store = await SqliteMappingStore.from_file(file_path, old)
+        await store.register_chat_topic_link(1, 10)
+        await store.close()
+
+        # Row of the chat is hashed with the old key
+        store = await SqliteMappingStore.from_file(file_path, (new, old))
+        await store.register_chat_topic_link(1, 10)
+        await store.register_chat_topic_link(1, 20)
+
+        # Same answers from the cache and from the database
+        for _ in range(2):
+            assert len(store) == 1
+            assert await store.find_topic_id(1) == 20
+            assert await store.find_chat_id(20) == 1
+            assert await store.find_chat_id(10) is None
+
+            await store.close()
+            store = await SqliteMappingStore.from_file(file_path, (new, old))
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_keeps_recently_found_chats():
+    with TemporaryDirectory() as temp_dir:
+        store = await SqliteMappingStore.from_file(
+            os.path.join(temp_dir, "mapping.sqlite"), Fernet.generate_key(), capacity=2
+        )
+        await store.register_chat_topic_link(1, 101)
+        await store.register_chat_topic_link(2, 102)
+
+        # Found by topic, so chat 2 is evicted instead
+        assert await store.find_chat_id(101) == 1
+        await store.register_chat_topic_link(3, 103)
+        assert list(store.by_chat) == [1, 3]
+
+        await store.close()
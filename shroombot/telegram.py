@@ -2,93 +2,182 @@
 Connection to the telegram service
 """
 
-from aiotdlib.api import (
-    FormattedText,
-    ForumTopicIcon,
-    InputFileRemote,
-    InputMessageDocument,
-    InputMessagePhoto,
-    InputMessageSticker,
-    InputMessageText,
-    TextEntity,
-)
+import logging
+import re
+from abc import abstractmethod
+from dataclasses import dataclass
+from typing import Any
+
+from aiotdlib.api import AioTDLibError, ForumTopicIcon, MessageReplyToMessage
 from aiotdlib.client import Client
 
+from shroombot.adapter import InputMessageContent, as_maybe_fmt, encode_message
+from shroombot.ratelimit import Priority, SendScheduler
 from shroombot.server import (
+    MyAnimationMessage,
     MyDocumentMessage,
     MyMessageType,
     MyPhotoMessage,
-    MyStickerMessage,
     MyTextMessage,
+    MyVideoMessage,
+    MyVoiceMessage,
     TelegramApi,
 )
 
+logger = logging.getLogger(__name__)
+
+_RETRY_AFTER = re.compile(r"retry after (\d+)", re.IGNORECASE)
+
+
+def flood_retry_after(exc: Exception) -> float | None:
+    """
+    Number of seconds telegram asks to wait before retrying, None for other errors
+    """
+    if not isinstance(exc, AioTDLibError) or exc.code != 429:
+        return None
+
+    match = _RETRY_AFTER.search(exc.message or "")
+    if match is None:
+        return 1.0
+    return float(match.group(1))
+
 
 async def get_chat_id(client: Client, username: str) -> int:
     chat = await client.api.search_public_chat(username)
     return chat.id
 
 
-def _as_fmt(text: str, entities: list[TextEntity]) -> FormattedText:
-    return FormattedText(
-        text=text, entities=entities
+def _reply_to(chat_id: int, message_id: int | None) -> MessageReplyToMessage | None:
+    if message_id is None:
+        return None
+    return MessageReplyToMessage(
+        chat_id=chat_id, message_id=message_id
     )  # pyright: ignore[reportCallIssue]
 
 
-def _as_maybe_fmt(text: str | None) -> FormattedText | None:
-    if text is None:
-        return None
-    return FormattedText(text=text, entities=[])  # pyright: ignore[reportCallIssue]
-
-
-def message_to_content(  # pylint: disable=inconsistent-return-statements
-    message: MyMessageType,
-) -> InputMessageText | InputMessagePhoto | InputMessageDocument | InputMessageSticker:
-    if isinstance(message, MyTextMessage):
-        return InputMessageText(
-            text=_as_fmt(message.text, message.entities)
-        )  # pyright: ignore[reportCallIssue]
-
-    if isinstance(message, MyPhotoMessage):
-        return InputMessagePhoto(
-            photo=InputFileRemote(id=message.id),  # pyright: ignore[reportCallIssue]
-            width=40,
-            height=40,
-            added_sticker_file_ids=[],
-            caption=_as_maybe_fmt(message.caption),
-        )  # pyright: ignore[reportCallIssue]
-
-    if isinstance(message, MyDocumentMessage):
-        return InputMessageDocument(
-            document=InputFileRemote(id=message.id),  # pyright: ignore[reportCallIssue]
-            disable_content_type_detection=True,
-            caption=_as_maybe_fmt(message.caption),
-        )  # pyright: ignore[reportCallIssue]
-    if isinstance(message, MyStickerMessage):
-        return InputMessageSticker(
-            sticker=InputFileRemote(id=message.id),  # pyright: ignore[reportCallIssue]
-            width=40,
-            height=40,
-            emoji=message.emoji,
-        )
+def message_to_content(message: MyMessageType) -> InputMessageContent:
+    """
+    Telegram input message content of the bot message, see adapter.ENCODERS
+    """
+    return encode_message(message)
 
 
-class LiveTelegramApi(TelegramApi):
-    def __init__(self, client: Client):
-        self.client = client
+# Maximum number of messages in an album
+MAX_ALBUM_SIZE = 10
+
+# Messages that can be sent together in one album
+_ALBUM_KINDS: dict[type, str] = {
+    MyPhotoMessage: "media",
+    MyVideoMessage: "media",
+    MyDocumentMessage: "document",
+}
+
+# Messages with editable caption
+_CAPTIONED = (
+    MyPhotoMessage,
+    MyDocumentMessage,
+    MyVideoMessage,
+    MyAnimationMessage,
+    MyVoiceMessage,
+)
+
+
+def album_groups(messages: list[MyMessageType]) -> list[list[MyMessageType]]:
+    """
+    Split messages into groups that can be sent as one album.
+
+    Photos and videos can be mixed in an album, documents only go with documents,
+    other messages are sent one by one
+    """
+    groups: list[list[MyMessageType]] = []
+
+    for message in messages:
+        kind = _ALBUM_KINDS.get(message.__class__)
+        if (
+            groups
+            and kind is not None
+            and _ALBUM_KINDS.get(groups[-1][0].__class__) == kind
+            and len(groups[-1]) < MAX_ALBUM_SIZE
+        ):
+            groups[-1].append(message)
+        else:
+            groups.append([message])
+
+    return groups
+
+
+# Methods of the telegram client api that requests may call
+REQUEST_METHODS = frozenset(
+    [
+        "send_message",
+        "send_message_album",
+        "edit_message_text",
+        "edit_message_caption",
+        "create_forum_topic",
+    ]
+)
+
+
+@dataclass
+class TelegramRequest:
+    """
+    Call of the telegram client api with encoded arguments.
+
+    Requests are built where messages are processed, the process
+    that owns the client only executes them
+    """
+
+    # One of REQUEST_METHODS
+    method: str
+    chat_id: int
+    args: tuple
+    kwargs: dict[str, Any]
+    priority: Priority
+    # Part of the response the caller gets: message_id, message_ids or topic_id
+    returns: str | None = None
+
+
+def request_result(request: TelegramRequest, response: Any) -> Any:
+    if request.returns == "message_id":
+        return int(response.id)
+    if request.returns == "message_ids":
+        return [int(item.id) for item in response.messages]
+    if request.returns == "topic_id":
+        return int(response.message_thread_id)
+    return None
+
+
+class EncodingTelegramApi(TelegramApi):
+    """
+    Encodes messages into requests of the telegram client api,
+    subclasses execute the requests
+    """
+
+    @abstractmethod
+    async def execute(self, request: TelegramRequest) -> Any:
+        """
+        Run the request, returns request_result of the response
+        """
+        ...
 
     async def send_message(
         self,
         chat_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
         """
-
-        await self.client.api.send_message(
-            chat_id,
-            message_to_content(message),
+        return await self.execute(
+            TelegramRequest(
+                "send_message",
+                chat_id,
+                (chat_id, message_to_content(message)),
+                {"reply_to": _reply_to(chat_id, reply_to)},
+                Priority.USER,
+                "message_id",
+            )
         )
 
     async def send_topic_message(
@@ -96,25 +185,152 @@ class LiveTelegramApi(TelegramApi):
         chat_id: int,
         topic_id: int,
         message: MyMessageType,
-    ):
+        reply_to: int | None = None,
+    ) -> int | None:
         """
         Send message to specific chat and thread
         """
-        await self.client.api.send_message(
-            chat_id,
-            message_to_content(message),
-            message_thread_id=topic_id,
+        return await self.execute(
+            TelegramRequest(
+                "send_message",
+                chat_id,
+                (chat_id, message_to_content(message)),
+                {
+                    "message_thread_id": topic_id,
+                    "reply_to": _reply_to(chat_id, reply_to),
+                },
+                Priority.ADMIN,
+                "message_id",
+            )
+        )
+
+    async def send_messages(
+        self, chat_id: int, messages: list[MyMessageType], reply_to: int | None = None
+    ) -> list[int | None]:
+        """
+        Send several messages to specific chat, grouping media into albums
+        """
+        return await self._send_groups(chat_id, 0, messages, reply_to, Priority.USER)
+
+    async def send_topic_messages(
+        self,
+        chat_id: int,
+        topic_id: int,
+        messages: list[MyMessageType],
+        reply_to: int | None = None,
+    ) -> list[int | None]:
+        """
+        Send several messages to specific chat and thread, grouping media into albums
+        """
+        return await self._send_groups(
+            chat_id, topic_id, messages, reply_to, Priority.ADMIN
         )
 
+    async def _send_groups(  # pylint: disable=too-many-arguments
+        self,
+        chat_id: int,
+        topic_id: int,
+        messages: list[MyMessageType],
+        reply_to: int | None,
+        priority: Priority,
+    ) -> list[int | None]:
+        sent_ids: list[int | None] = []
+
+        for group in album_groups(messages):
+            # Only the first message replies
+            group_reply_to = None if sent_ids else reply_to
+
+            if len(group) == 1:
+                if priority == Priority.USER:
+                    sent_ids.append(
+                        await self.send_message(chat_id, group[0], group_reply_to)
+                    )
+                else:
+                    sent_ids.append(
+                        await self.send_topic_message(
+                            chat_id, topic_id, group[0], group_reply_to
+                        )
+                    )
+                continue
+
+            sent_ids.extend(
+                await self.execute(
+                    TelegramRequest(
+                        "send_message_album",
+                        chat_id,
+                        (chat_id, [message_to_content(message) for message in group]),
+                        {
+                            "message_thread_id": topic_id,
+                            "reply_to": _reply_to(chat_id, group_reply_to),
+                        },
+                        priority,
+                        "message_ids",
+                    )
+                )
+            )
+
+        return sent_ids
+
+    async def edit_message(self, chat_id: int, message_id: int, message: MyMessageType):
+        """
+        Replace text or caption of a sent message
+        """
+        if isinstance(message, MyTextMessage):
+            await self.execute(
+                TelegramRequest(
+                    "edit_message_text",
+                    chat_id,
+                    (chat_id, message_id, message_to_content(message)),
+                    {},
+                    Priority.ADMIN,
+                )
+            )
+        elif isinstance(message, _CAPTIONED):
+            await self.execute(
+                TelegramRequest(
+                    "edit_message_caption",
+                    chat_id,
+                    (chat_id, message_id),
+                    {"caption": as_maybe_fmt(message.caption)},
+                    Priority.ADMIN,
+                )
+            )
+        else:
+            logger.info("Edit of %s is not mirrored", type(message).__name__)
+
     async def create_topic(self, chat_id: int, title: str) -> int:
         """
         Creates topic in a chat.
 
         Returns topic id
         """
-
         icon = ForumTopicIcon(color=0)  # pyright: ignore[reportCallIssue]
 
-        topic_info = await self.client.api.create_forum_topic(chat_id, title, icon)
+        return await self.execute(
+            TelegramRequest(
+                "create_forum_topic",
+                chat_id,
+                (chat_id, title, icon),
+                {},
+                Priority.ADMIN,
+                "topic_id",
+            )
+        )
+
 
-        return int(topic_info.message_thread_id)
+class LiveTelegramApi(EncodingTelegramApi):
+    def __init__(self, client: Client, scheduler: SendScheduler | None = None):
+        self.client = client
+        self.scheduler = scheduler or SendScheduler(retry_after=flood_retry_after)
+
+    async def execute(self, request: TelegramRequest) -> Any:
+        if request.method not in REQUEST_METHODS:
+            raise ValueError(f"Unknown method {request.method}")
+
+        method = getattr(self.client.api, request.method)
+        response = await self.scheduler.submit(
+            request.chat_id,
+            lambda: method(*request.args, **request.kwargs),
+            request.priority,
+        )
+        return request_result(request, response)
@@ -1,5 +1,5 @@
 """
-Testing of the telegram adapter over LIVE api
+Testing of the telegram adapter, the test over LIVE api is skipped
 """
 
 # Importing telegram takes too long!
@@ -7,10 +7,19 @@ Testing of the telegram adapter over LIVE api
 # pylint: disable=import-outside-toplevel
 
 import os
+import time
+from types import SimpleNamespace
 
 import pytest
 
-from shroombot.server import MyTextMessage
+from shroombot.server import (
+    MyAnimationMessage,
+    MyDocumentMessage,
+    MyMessageType,
+    MyPhotoMessage,
+    MyTextMessage,
+    MyVideoMessage,
+)
 
 
 @pytest.mark.skip
@@ -36,3 +45,149 @@ async def test_telegram_api():
         await telegram.send_topic_message(
             admin_chat, topic_id, MyTextMessage("Test message")
         )
+
+
+@pytest.mark.parametrize(
+    "code, message, expected",
+    [
+        (429, "Too Many Requests: retry after 17", 17.0),
+        (429, "FLOOD_WAIT: Retry After 3", 3.0),
+        (429, "Too Many Requests", 1.0),
+        (400, "Bad Request: retry after 5", None),
+        (500, "Internal Server Error", None),
+    ],
+)
+def test_flood_retry_after(code: int, message: str, expected: float | None):
+    from aiotdlib.api import AioTDLibError
+
+    from .telegram import flood_retry_after
+
+    assert flood_retry_after(AioTDLibError(code, message)) == expected
+
+
+def test_flood_retry_after_other_errors():
+    from .telegram import flood_retry_after
+
+    assert flood_retry_after(ValueError("retry after 5")) is None
+    assert flood_retry_after(TimeoutError()) is None
+
+
+@pytest.mark.asyncio
+async def test_scheduler_waits_for_flood_limit():
+    from aiotdlib.api import AioTDLibError
+
+    from .ratelimit import SendScheduler
+    from .telegram import flood_retry_after
+
+    scheduler = SendScheduler(retry_after=flood_retry_after, backoff=0, chat_burst=10)
+    attempts: list[float] = []
+
+    async def _flooded():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise AioTDLibError(429, "Too Many Requests: retry after 1")
+        return "sent"
+
+    assert await scheduler.submit(1, _flooded) == "sent"
+
+    # Sent again, after the delay telegram asked for
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 1.0
+
+    await scheduler.close()
+
+
+_KINDS = {
+    "P": lambda: MyPhotoMessage("photo", None),
+    "V": lambda: MyVideoMessage("video", None),
+    "D": lambda: MyDocumentMessage("document", None),
+    "A": lambda: MyAnimationMessage("animation", None),
+    "T": lambda: MyTextMessage("text"),
+}
+
+
+def _kinds(messages: list[MyMessageType]) -> str:
+    letters = {type(make()): letter for letter, make in _KINDS.items()}
+    return "".join(letters[type(message)] for message in messages)
+
+
+@pytest.mark.parametrize(
+    "messages, groups",
+    [
+        ("PV", ["PV"]),
+        ("PVDD", ["PV", "DD"]),
+        ("PDV", ["P", "D", "V"]),
+        ("DD", ["DD"]),
+        ("PTP", ["P", "T", "P"]),
+        ("AA", ["A", "A"]),
+        ("TT", ["T", "T"]),
+        ("P" * 12, ["P" * 10, "PP"]),
+        ("D" * 21, ["D" * 10, "D" * 10, "D"]),
+    ],
+)
+def test_album_groups(messages: str, groups: list[str]):
+    from .telegram import album_groups
+
+    grouped = album_groups([_KINDS[letter]() for letter in messages])
+    assert [_kinds(group) for group in grouped] == groups
+
+
+class _FakeClientApi:
+    def __init__(self):
+        self.calls: list[tuple[str, int, int, int | None, int]] = []
+        self.last_id = 0
+
+    def _sent(self) -> SimpleNamespace:
+        self.last_id += 1
+        return SimpleNamespace(id=self.last_id)
+
+    def _record(self, method, chat_id, num_messages, message_thread_id, reply_to):
+        reply_id = None if reply_to is None else reply_to.message_id
+        self.calls.append((method, chat_id, message_thread_id, reply_id, num_messages))
+
+    async def send_message(self, chat_id, content, message_thread_id=0, reply_to=None):
+        assert content is not None
+        self._record("message", chat_id, 1, message_thread_id, reply_to)
+        return self._sent()
+
+    async def send_message_album(
+        self, chat_id, contents, message_thread_id=0, reply_to=None
+    ):
+        self._record("album", chat_id, len(contents), message_thread_id, reply_to)
+        return SimpleNamespace(messages=[self._sent() for _ in contents])
+
+
+@pytest.mark.asyncio
+async def test_send_messages_in_albums():
+    from .ratelimit import SendScheduler
+    from .telegram import LiveTelegramApi
+
+    api = _FakeClientApi()
+    scheduler = SendScheduler(chat_burst=100, group_burst=100)
+    telegram = LiveTelegramApi(SimpleNamespace(api=api), scheduler)
+
+    messages = [_KINDS[letter]() for letter in "TPVDD"]
+    assert await telegram.send_messages(5, messages, reply_to=42) == [1, 2, 3, 4, 5]
+
+    # Only the first group replies
+    assert api.calls == [
+        ("message", 5, 0, 42, 1),
+        ("album", 5, 0, None, 2),
+        ("album", 5, 0, None, 2),
+    ]
+
+    api.calls.clear()
+    messages = [_KINDS[letter]() for letter in "PVT"]
+    assert await telegram.send_topic_messages(-100, 7, messages, reply_to=9) == [
+        6,
+        7,
+        8,
+    ]
+
+    # Messages stay in the topic
+    assert api.calls == [
+        ("album", -100, 7, 9, 2),
+        ("message", -100, 7, None, 1),
+    ]
+
+    await scheduler.close()
@@ -0,0 +1,86 @@
+"""
+Anonymized traces of incomming traffic
+
+A trace keeps the shape of the traffic, not its content: hashed chat
+and topic ids, message types, sizes and arrival times. Ids are hashed
+with a random salt that is never written down, so they can not be linked
+back to users, but messages of one conversation stay together.
+
+Traces are newline-delimited json, replayed by the replay command.
+The trace file is overwritten when recording starts
+"""
+
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import IO, Any
+
+# Hashed ids fit into the signed 64-bit ids of the mapping file
+_ID_BYTES = 7
+
+
+@dataclass
+class TraceEvent:
+    # Seconds since start of the recording
+    offset: float
+    # Hashed user chat id, 0 for admin messages
+    chat: int
+    # Hashed admin topic id, 0 for user messages
+    thread: int
+    message_type: str
+    # Bytes of text or caption
+    size: int
+
+
+def message_size(message: Any) -> int:
+    text = getattr(message, "text", None) or getattr(message, "caption", None) or ""
+    return len(text.encode())
+
+
+@dataclass
+class TraceRecorder:
+    file_path: str
+    admin_chat_id: int
+    salt: bytes = field(default_factory=lambda: os.urandom(16), repr=False)
+    started: float = field(default_factory=time.monotonic)
+    file: IO[str] | None = field(default=None, repr=False)
+
+    def hash_id(self, value: int) -> int:
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "little", signed=True),
+            digest_size=_ID_BYTES,
+            key=self.salt,
+        ).digest()
+        # Zero is reserved for absent ids
+        return int.from_bytes(digest, "little") or 1
+
+    def record(self, chat_id: int, thread_id: int, message: Any):
+        if chat_id == self.admin_chat_id:
+            chat, thread = 0, self.hash_id(thread_id)
+        else:
+            chat, thread = self.hash_id(chat_id), 0
+
+        event = TraceEvent(
+            offset=round(time.monotonic() - self.started, 6),
+            chat=chat,
+            thread=thread,
+            message_type=message.__class__.__name__,
+            size=message_size(message),
+        )
+
+        if self.file is None:
+            # pylint: disable-next=consider-using-with
+            self.file = open(self.file_path, "w", encoding="utf-8")
+        self.file.write(json.dumps(asdict(event)) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def load_trace(file_path: str) -> list[TraceEvent]:
+    with open(file_path, encoding="utf-8") as file:
+        return [TraceEvent(**json.loads(line)) for line in file if line.strip()]
@@ -0,0 +1,57 @@
+"""
+Testing of recording and replay of traffic traces
+"""
+
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from shroombot.benchmark_replay import run_replay
+from shroombot.server import MyPhotoMessage, MyTextMessage
+from shroombot.trace import TraceEvent, TraceRecorder, load_trace
+
+
+def test_trace_recorder_anonymizes():
+    with TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "trace.jsonl")
+
+        recorder = TraceRecorder(file_path, admin_chat_id=-100)
+        recorder.record(12345, 0, MyTextMessage("secret text"))
+        recorder.record(12345, 0, MyPhotoMessage("file", "капча"))
+        recorder.record(-100, 7, MyTextMessage("answer"))
+        recorder.close()
+
+        with open(file_path, encoding="utf-8") as file:
+            content = file.read()
+        assert "secret" not in content and "12345" not in content
+
+        first, second, admin = load_trace(file_path)
+
+        assert first.chat == second.chat != 0 and first.thread == 0
+        assert (first.message_type, first.size) == ("MyTextMessage", 11)
+        assert (second.message_type, second.size) == ("MyPhotoMessage", 10)
+        assert admin.chat == 0 and admin.thread != 0
+        assert first.offset <= second.offset <= admin.offset
+
+        # Salt is not shared between recordings
+        assert TraceRecorder(file_path, -100).hash_id(12345) != first.chat
+
+
+@pytest.mark.asyncio
+async def test_replay_speed_and_errors():
+    events = [
+        TraceEvent(idx * 0.01, chat=idx % 5 + 1, thread=0, message_type="X", size=3)
+        for idx in range(20)
+    ] + [TraceEvent(0.2, chat=0, thread=99, message_type="MyPhotoMessage", size=0)]
+
+    realtime = await run_replay(events, speed=1.0, latency=0.001)
+    fastest = await run_replay(events, speed=0, latency=0.001)
+
+    assert realtime.num_messages == fastest.num_messages == 21
+    assert realtime.num_errors == fastest.num_errors == 0
+    assert len(realtime.latencies) == 21
+    assert realtime.elapsed >= 0.2 > fastest.elapsed
+
+    failing = await run_replay(events, speed=0, latency=0.0, error_rate=1.0)
+    assert failing.num_errors == 21